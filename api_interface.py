@@ -1,13 +1,129 @@
-from flask import Flask, request, jsonify
-from main_controller import StarkAssistant
+import json
+import time
+from flask import Flask, Response, request, jsonify, g
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import HTTPException
+from assistant_pool import AssistantPool, UserIdError, check_auth_config, resolve_user_id
+from commands import CommandError, parse_batch
+import logging_setup
+import metrics
+import tracing
+from profiler import ProfilerError, check_admin, check_admin_config, parse_seconds, profiler
+from pubsub import SSE_KEEP_ALIVE, format_sse, format_sse_reset, parse_event_query
+from rate_limit import AdmissionController, RateLimiter, retry_after_header
+from serialization import compress, dumps, entity_tag, negotiate_encoding, not_modified
 import config
 from datetime import datetime
 
+
+class FastJSONProvider(JSONProvider):
+    """jsonify() through serialization.dumps, skipping the str round trip for response bodies"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return json.loads(s)
+
+    def response(self, *args, **kwargs):
+        return self._app.response_class(dumps(self._prepare_response_obj(args, kwargs)), mimetype='application/json')
+
+
 app = Flask(__name__)
-app.config['JSON_SORT_KEYS'] = False
+app.json = FastJSONProvider(app)
+
+# Refuse to start with settings every request would fail on
+check_auth_config()
+check_admin_config()
+logging_setup.configure()
+
+# Per-user assistant instances, created on demand
+pool = AssistantPool()
+limiter = RateLimiter()
+admission = AdmissionController()
+metrics.register_admission(limiter, admission)
+
+def page_query():
+    """The limit, cursor, since and fields query parameters of a list request"""
+    return [request.args.get(name) for name in ('limit', 'cursor', 'since', 'fields')]
+
+PUBLIC_ENDPOINTS = {'health_check', 'list_commands', 'get_metrics', 'scrape_metrics', 'profile'}
+# Event requests mostly wait on the broker, so they do not hold admission slots
+UNMETERED_ENDPOINTS = {'health_check', 'poll_events', 'stream_events', 'scrape_metrics'}
+JSON_BODY_ENDPOINTS = {'add_task', 'send_message', 'send_notification', 'store_memory', 'search_memories',
+                       'execute_command', 'execute_batch'}
+
+@app.before_request
+def start_timer():
+    g.started_at = time.perf_counter()
+    g.trace = tracing.tracer.start(f"api_interface.{request.endpoint or 'unmatched'}",
+                                   config.TRACE_HEADER in request.headers)
 
-# Initialize assistant instance
-assistant = StarkAssistant(config.DEFAULT_USER_ID)
+@app.before_request
+def admit_request():
+    """Turn requests away with 503 while the process is saturated"""
+    if request.endpoint is None or request.endpoint in UNMETERED_ENDPOINTS:
+        return None
+    if not admission.enter():
+        return jsonify({'error': 'Server is busy, please retry shortly', 'status': 'error'}), 503, {'Retry-After': '1'}
+    g.admitted_at = time.perf_counter()
+    return None
+
+@app.before_request
+def resolve_assistant():
+    """Pick the calling user's assistant from the user id header, within the user's rate limit"""
+    if request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    try:
+        user_id = resolve_user_id(request.headers.get(config.USER_ID_HEADER), request.headers.get(config.AUTH_HEADER))
+    except UserIdError as e:
+        return jsonify({'error': str(e), 'status': 'error'}), e.status
+    if config.RATE_LIMIT_ENABLED:
+        wait = limiter.check(user_id, request.endpoint)
+        if wait:
+            return (jsonify({'error': 'Rate limit exceeded', 'status': 'error'}), 429,
+                    {'Retry-After': retry_after_header(wait)})
+    g.assistant = pool.get(user_id)
+    return None
+
+@app.before_request
+def require_json_body():
+    """Answer 400 when an endpoint that reads a JSON object is sent anything else"""
+    if request.endpoint in JSON_BODY_ENDPOINTS and not isinstance(request.get_json(silent=True), dict):
+        return jsonify({'error': 'request body must be a JSON object', 'status': 'error'}), 400
+    return None
+
+@app.after_request
+def record_latency(response):
+    started_at = g.get('started_at')
+    if started_at is not None:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - started_at, request.endpoint or 'unmatched', request.method,
+                                     response.status_code)
+    return response
+
+@app.teardown_request
+def release_admission(exc):
+    admitted_at = g.pop('admitted_at', None)
+    if admitted_at is not None:
+        admission.exit(time.perf_counter() - admitted_at)
+    tracing.tracer.finish(g.pop('trace', None))
+
+@app.after_request
+def negotiate_response(response):
+    """Tag successful JSON responses, answer a matching If-None-Match with 304 and compress large bodies"""
+    if response.is_streamed or response.status_code != 200 or response.mimetype != 'application/json':
+        return response
+    body = response.get_data()
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), len(body))
+    response.vary.add('Accept-Encoding')
+    if request.method == 'GET':
+        response.headers['ETag'] = etag = entity_tag(body, encoding)
+        if not_modified(request.headers.get('If-None-Match'), etag):
+            return app.response_class(status=304, headers={'ETag': etag, 'Vary': 'Accept-Encoding'})
+    if encoding is not None:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 # Health Check
 @app.route('/api/health', methods=['GET'])
@@ -24,173 +140,211 @@ def health_check():
 @app.route('/api/task/add', methods=['POST'])
 def add_task():
     """Add a new task"""
-    try:
-        data = request.get_json()
-        task_name = data.get('task_name')
-        due_date = data.get('due_date', None)
-        
-        if not task_name:
-            return jsonify({'error': 'task_name is required'}), 400
-        
-        result = assistant.process_command('add_task', task_name, due_date)
-        return jsonify({'message': result, 'status': 'success'}), 201
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    data = request.get_json()
+    task_name = data.get('task_name')
+    due_date = data.get('due_date', None)
+    
+    if not task_name:
+        return jsonify({'error': 'task_name is required'}), 400
+    
+    result = g.assistant.process_command('add_task', task_name, due_date)
+    return jsonify({'message': result, 'status': 'success'}), 201
 
 @app.route('/api/task/list', methods=['GET'])
 def list_tasks():
     """List all tasks for the user"""
-    try:
-        tasks = assistant.process_command('list_tasks')
-        return jsonify({'tasks': tasks, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    page = g.assistant.process_command('page_tasks', *page_query())
+    return jsonify({'tasks': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}), 200
 
 @app.route('/api/task/complete/<int:task_id>', methods=['PUT'])
 def complete_task(task_id):
     """Mark a task as completed"""
-    try:
-        result = assistant.process_command('complete_task', task_id)
-        return jsonify({'message': result, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    result = g.assistant.process_command('complete_task', task_id)
+    return jsonify({'message': result, 'status': 'success'}), 200
 
 @app.route('/api/task/delete/<int:task_id>', methods=['DELETE'])
 def delete_task(task_id):
     """Delete a task"""
-    try:
-        result = assistant.process_command('delete_task', task_id)
-        return jsonify({'message': result, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    result = g.assistant.process_command('delete_task', task_id)
+    return jsonify({'message': result, 'status': 'success'}), 200
 
 @app.route('/api/task/overdue', methods=['GET'])
 def get_overdue_tasks():
     """Get overdue tasks"""
-    try:
-        tasks = assistant.process_command('get_overdue_tasks')
-        return jsonify({'tasks': tasks, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    tasks = g.assistant.process_command('get_overdue_tasks')
+    return jsonify({'tasks': tasks, 'status': 'success'}), 200
 
 # Communication Endpoints
 @app.route('/api/message/send', methods=['POST'])
 def send_message():
     """Send a message"""
-    try:
-        data = request.get_json()
-        recipient = data.get('recipient')
-        message = data.get('message')
-        
-        if not recipient or not message:
-            return jsonify({'error': 'recipient and message are required'}), 400
-        
-        result = assistant.process_command('send_message', recipient, message)
-        return jsonify({'message': result, 'status': 'success'}), 201
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    data = request.get_json()
+    recipient = data.get('recipient')
+    message = data.get('message')
+    
+    if not recipient or not message:
+        return jsonify({'error': 'recipient and message are required'}), 400
+    
+    result = g.assistant.process_command('send_message', recipient, message)
+    return jsonify({'message': result, 'status': 'success'}), 201
 
 @app.route('/api/message/list', methods=['GET'])
 def get_messages():
     """Get all messages for the user"""
-    try:
-        messages = assistant.process_command('get_messages')
-        return jsonify({'messages': messages, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    page = g.assistant.process_command('page_messages', *page_query())
+    return jsonify({'messages': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}), 200
 
 @app.route('/api/notification/send', methods=['POST'])
 def send_notification():
     """Send a notification"""
-    try:
-        data = request.get_json()
-        notification = data.get('notification')
-        notification_type = data.get('type', 'notification')
-        
-        if not notification:
-            return jsonify({'error': 'notification is required'}), 400
-        
-        result = assistant.process_command('send_notification', notification, notification_type)
-        return jsonify({'message': result, 'status': 'success'}), 201
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    data = request.get_json()
+    notification = data.get('notification')
+    notification_type = data.get('type', 'notification')
+    
+    if not notification:
+        return jsonify({'error': 'notification is required'}), 400
+    
+    result = g.assistant.process_command('send_notification', notification, notification_type)
+    return jsonify({'message': result, 'status': 'success'}), 201
 
 @app.route('/api/notification/list', methods=['GET'])
 def get_notifications():
     """Get all notifications"""
+    page = g.assistant.process_command('page_notifications', *page_query())
+    return jsonify({'notifications': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}), 200
+
+# Event Endpoints
+@app.route('/api/events', methods=['GET'])
+def poll_events():
+    """Long-poll for messages and notifications newer than a cursor"""
     try:
-        notifications = assistant.process_command('get_notifications')
-        return jsonify({'notifications': notifications, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+        cursor, kinds, timeout = parse_event_query(request.args.get('cursor'), request.args.get('types'),
+                                                   request.args.get('timeout'))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'status': 'error'}), 400
+    events, cursor, missed = pool.services.events.wait(g.assistant.user_id, cursor, timeout, kinds)
+    return jsonify({'events': events, 'cursor': cursor, 'reset': missed, 'status': 'success'}), 200
+
+@app.route('/api/events/stream', methods=['GET'])
+def stream_events():
+    """Stream messages and notifications as server-sent events"""
+    try:
+        cursor, kinds, _ = parse_event_query(request.headers.get('Last-Event-ID') or request.args.get('cursor'),
+                                             request.args.get('types'))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'status': 'error'}), 400
+    user_id = g.assistant.user_id
+    broker = pool.services.events
+    dumps = app.json.dumps
+
+    def generate():
+        position = cursor
+        while True:
+            events, position, missed = broker.wait(user_id, position, config.SSE_HEARTBEAT_INTERVAL, kinds)
+            if missed:
+                yield format_sse_reset(position)
+            for event in events:
+                yield format_sse(event, dumps)
+            if not events and not missed:
+                yield SSE_KEEP_ALIVE
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Memory Management Endpoints
 @app.route('/api/memory/store', methods=['POST'])
 def store_memory():
     """Store user memory"""
-    try:
-        data = request.get_json()
-        category = data.get('category')
-        key = data.get('key')
-        value = data.get('value')
-        
-        if not category or not key:
-            return jsonify({'error': 'category and key are required'}), 400
-        
-        result = assistant.process_command('store_memory', category, key, value)
-        return jsonify({'message': result, 'status': 'success'}), 201
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    data = request.get_json()
+    category = data.get('category')
+    key = data.get('key')
+    value = data.get('value')
+    
+    if not category or not key:
+        return jsonify({'error': 'category and key are required'}), 400
+    
+    result = g.assistant.process_command('store_memory', category, key, value)
+    return jsonify({'message': result, 'status': 'success'}), 201
 
 @app.route('/api/memory/retrieve/<category>', methods=['GET'])
 def retrieve_memory(category):
     """Retrieve memories by category"""
-    try:
-        memories = assistant.process_command('retrieve_memory', category)
-        return jsonify({'memories': memories, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    page = g.assistant.process_command('page_memories', category, *page_query())
+    return jsonify({'memories': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}), 200
 
 @app.route('/api/memory/search', methods=['POST'])
 def search_memories():
     """Search memories by keyword"""
-    try:
-        data = request.get_json()
-        keyword = data.get('keyword')
-        
-        if not keyword:
-            return jsonify({'error': 'keyword is required'}), 400
-        
-        results = assistant.process_command('search_memories', keyword)
-        return jsonify({'results': results, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    data = request.get_json()
+    keyword = data.get('keyword')
+    
+    if not keyword:
+        return jsonify({'error': 'keyword is required'}), 400
+    
+    if data.get('semantic'):
+        results = g.assistant.process_command('recall_memories', keyword, data.get('limit', 5))
+    else:
+        results = g.assistant.process_command('search_memories', keyword)
+    return jsonify({'results': results, 'status': 'success'}), 200
 
 # System Endpoints
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get overall system status"""
-    try:
-        status = assistant.get_status()
-        return jsonify({'status': status}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+    status = g.assistant.get_status()
+    return jsonify({'status': status}), 200
 
 @app.route('/api/command', methods=['POST'])
 def execute_command():
     """Execute a custom command"""
+    data = request.get_json()
+    command = data.get('command')
+    args = data.get('args', [])
+    
+    if not command:
+        return jsonify({'error': 'command is required'}), 400
+    
+    result = g.assistant.process_command(command, *args)
+    return jsonify({'result': result, 'status': 'success'}), 200
+
+@app.route('/api/batch', methods=['POST'])
+def execute_batch():
+    """Execute an ordered list of commands in one request"""
+    data = request.get_json()
+    atomic = bool(data.get('atomic', False))
+    results = g.assistant.process_batch(parse_batch(data.get('commands')), atomic)
+    failed = any(result['status'] != 'success' for result in results)
+    if atomic and failed:
+        return jsonify({'results': results, 'status': 'error'}), 400
+    return jsonify({'results': results, 'status': 'success'}), 200
+
+@app.route('/api/commands', methods=['GET'])
+def list_commands():
+    """List available commands with their arguments and call statistics"""
+    return jsonify({'commands': pool.services.commands.describe(), 'status': 'success'}), 200
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Response cache counters"""
+    return jsonify({'cache': pool.services.responses.stats(), 'status': 'success'}), 200
+
+@app.route('/metrics', methods=['GET'])
+def scrape_metrics():
+    """Every metric in the Prometheus text format"""
+    if not config.ENABLE_ANALYTICS:
+        return jsonify({'error': 'Analytics are disabled', 'status': 'error'}), 404
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/admin/profile', methods=['POST'])
+def profile():
+    """Sample every thread for `seconds` and download the collapsed stacks for a flame graph"""
     try:
-        data = request.get_json()
-        command = data.get('command')
-        args = data.get('args', [])
-        
-        if not command:
-            return jsonify({'error': 'command is required'}), 400
-        
-        result = assistant.process_command(command, *args)
-        return jsonify({'result': result, 'status': 'success'}), 200
-    except Exception as e:
-        return jsonify({'error': str(e), 'status': 'error'}), 500
+        check_admin(request.headers.get(config.ADMIN_TOKEN_HEADER))
+        stacks = profiler.sample(parse_seconds(request.args.get('seconds')))
+    except ProfilerError as e:
+        return jsonify({'error': str(e), 'status': 'error'}), e.status
+    return Response(stacks, content_type='text/plain; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename="{profiler.filename()}"'})
 
 # Error Handlers
 @app.errorhandler(404)
@@ -203,5 +357,17 @@ def internal_error(error):
     """Handle 500 errors"""
     return jsonify({'error': 'Internal server error', 'status': 'error'}), 500
 
+@app.errorhandler(CommandError)
+def invalid_command(error):
+    """Answer a command the registry rejected, e.g. for a bad argument, with 400 as the ASGI app does"""
+    return jsonify({'error': str(error), 'status': 'error'}), 400
+
+@app.errorhandler(Exception)
+def unhandled_error(error):
+    """Answer any other exception from an endpoint with 500; HTTP errors such as 405 keep their own status"""
+    if isinstance(error, HTTPException):
+        return error
+    return jsonify({'error': str(error), 'status': 'error'}), 500
+
 if __name__ == '__main__':
     app.run(host=config.API_HOST, port=config.API_PORT, debug=config.API_DEBUG)
\ No newline at end of file
@@ -0,0 +1,466 @@
+"""asyncio-native variant of api_interface, served by any ASGI server:
+
+    uvicorn asgi_interface:app --host 127.0.0.1 --port 5000
+
+It exposes the same routes, request bodies and responses as the Flask app.
+The event loop never touches storage itself: every call into the assistant
+runs on a bounded thread pool (ASYNC_EXECUTOR_WORKERS threads), so slow
+SQLite or network work occupies a worker thread rather than the loop, and
+idle connections cost only a coroutine.
+"""
+import asyncio
+import contextvars
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl
+from assistant_pool import AssistantPool, UserIdError, check_auth_config, resolve_user_id
+from commands import CommandError, parse_batch
+import logging_setup
+import metrics
+import tracing
+from profiler import ProfilerError, check_admin, check_admin_config, parse_seconds, profiler
+from pubsub import SSE_KEEP_ALIVE, format_sse, format_sse_reset, parse_event_query
+from rate_limit import AdmissionController, RateLimiter, retry_after_header
+from serialization import compress, dumps, entity_tag, negotiate_encoding, not_modified
+import config
+
+# Refuse to start with settings every request would fail on
+check_auth_config()
+check_admin_config()
+logging_setup.configure()
+pool = AssistantPool()
+limiter = RateLimiter()
+admission = AdmissionController()
+metrics.register_admission(limiter, admission)
+executor = ThreadPoolExecutor(max_workers=config.ASYNC_EXECUTOR_WORKERS, thread_name_prefix='asgi-storage')
+routes = []
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.assistant = None
+        self.response_headers = []
+        self.endpoint = 'unmatched'
+        self.trace = None
+
+    def get_json(self):
+        """The body as a JSON object; anything else is a CommandError, answered with 400"""
+        try:
+            data = json.loads(self.body) if self.body else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            raise CommandError('request body must be a JSON object')
+        return data
+
+
+class Text:
+    """A plain response body that is sent as is rather than as JSON"""
+
+    def __init__(self, body, content_type, headers=()):
+        self.body = body
+        self.content_type = content_type
+        self.headers = list(headers)
+
+
+class Stream:
+    """A response whose body is produced piece by piece by an async iterator of strings"""
+
+    def __init__(self, chunks, content_type):
+        self.chunks = chunks
+        self.content_type = content_type
+
+
+def route(path, methods=('GET',), public=False, metered=True):
+    """Register a handler; `<int:name>` and `<name>` segments become keyword arguments.
+
+    Unmetered handlers skip admission control; they are the event routes,
+    which mostly wait on the broker.
+    """
+    pattern = re.sub(r'<(int:)?(\w+)>', lambda m: '(?P<%s>%s)' % (m[2], r'\d+' if m[1] else '[^/]+'), path)
+
+    def decorator(handler):
+        routes.append((re.compile(pattern + '$'), set(methods), public, metered, handler))
+        return handler
+    return decorator
+
+
+def page_query(request):
+    """The limit, cursor, since and fields query parameters of a list request"""
+    return [request.args.get(name) for name in ('limit', 'cursor', 'since', 'fields')]
+
+
+async def run_blocking(function, *args):
+    """Run a blocking call on the storage executor and wait for it without blocking the loop.
+
+    The call runs in a copy of the caller's context, so it adds its trace
+    spans to the request's trace.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, function, *args)
+
+
+# Health Check
+@route('/api/health', public=True, metered=False)
+async def health_check(request):
+    """Check API health status"""
+    return {
+        'status': 'healthy',
+        'service': config.APP_NAME,
+        'version': config.APP_VERSION,
+        'timestamp': datetime.now().isoformat()
+    }, 200
+
+# Task Management Endpoints
+@route('/api/task/add', methods=['POST'])
+async def add_task(request):
+    """Add a new task"""
+    data = request.get_json()
+    task_name = data.get('task_name')
+    due_date = data.get('due_date', None)
+
+    if not task_name:
+        return {'error': 'task_name is required'}, 400
+
+    result = await run_blocking(request.assistant.process_command, 'add_task', task_name, due_date)
+    return {'message': result, 'status': 'success'}, 201
+
+@route('/api/task/list')
+async def list_tasks(request):
+    """List all tasks for the user"""
+    page = await run_blocking(request.assistant.process_command, 'page_tasks', *page_query(request))
+    return {'tasks': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}, 200
+
+@route('/api/task/complete/<int:task_id>', methods=['PUT'])
+async def complete_task(request, task_id):
+    """Mark a task as completed"""
+    result = await run_blocking(request.assistant.process_command, 'complete_task', int(task_id))
+    return {'message': result, 'status': 'success'}, 200
+
+@route('/api/task/delete/<int:task_id>', methods=['DELETE'])
+async def delete_task(request, task_id):
+    """Delete a task"""
+    result = await run_blocking(request.assistant.process_command, 'delete_task', int(task_id))
+    return {'message': result, 'status': 'success'}, 200
+
+@route('/api/task/overdue')
+async def get_overdue_tasks(request):
+    """Get overdue tasks"""
+    tasks = await run_blocking(request.assistant.process_command, 'get_overdue_tasks')
+    return {'tasks': tasks, 'status': 'success'}, 200
+
+# Communication Endpoints
+@route('/api/message/send', methods=['POST'])
+async def send_message(request):
+    """Send a message"""
+    data = request.get_json()
+    recipient = data.get('recipient')
+    message = data.get('message')
+
+    if not recipient or not message:
+        return {'error': 'recipient and message are required'}, 400
+
+    result = await run_blocking(request.assistant.process_command, 'send_message', recipient, message)
+    return {'message': result, 'status': 'success'}, 201
+
+@route('/api/message/list')
+async def get_messages(request):
+    """Get all messages for the user"""
+    page = await run_blocking(request.assistant.process_command, 'page_messages', *page_query(request))
+    return {'messages': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}, 200
+
+@route('/api/notification/send', methods=['POST'])
+async def send_notification(request):
+    """Send a notification"""
+    data = request.get_json()
+    notification = data.get('notification')
+    notification_type = data.get('type', 'notification')
+
+    if not notification:
+        return {'error': 'notification is required'}, 400
+
+    result = await run_blocking(request.assistant.process_command, 'send_notification', notification,
+                                notification_type)
+    return {'message': result, 'status': 'success'}, 201
+
+@route('/api/notification/list')
+async def get_notifications(request):
+    """Get all notifications"""
+    page = await run_blocking(request.assistant.process_command, 'page_notifications', *page_query(request))
+    return {'notifications': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}, 200
+
+# Event Endpoints
+@route('/api/events', metered=False)
+async def poll_events(request):
+    """Long-poll for messages and notifications newer than a cursor"""
+    try:
+        cursor, kinds, timeout = parse_event_query(request.args.get('cursor'), request.args.get('types'),
+                                                   request.args.get('timeout'))
+    except ValueError as e:
+        return {'error': str(e), 'status': 'error'}, 400
+    events, cursor, missed = await pool.services.events.wait_async(request.assistant.user_id, cursor, timeout, kinds)
+    return {'events': events, 'cursor': cursor, 'reset': missed, 'status': 'success'}, 200
+
+@route('/api/events/stream', metered=False)
+async def stream_events(request):
+    """Stream messages and notifications as server-sent events"""
+    try:
+        cursor, kinds, _ = parse_event_query(request.headers.get('last-event-id') or request.args.get('cursor'),
+                                             request.args.get('types'))
+    except ValueError as e:
+        return {'error': str(e), 'status': 'error'}, 400
+    user_id = request.assistant.user_id
+    broker = pool.services.events
+
+    def dumps(value):
+        return encode(value).decode('utf-8')
+
+    async def generate():
+        position = cursor
+        while True:
+            events, position, missed = await broker.wait_async(user_id, position, config.SSE_HEARTBEAT_INTERVAL,
+                                                               kinds)
+            if missed:
+                yield format_sse_reset(position)
+            for event in events:
+                yield format_sse(event, dumps)
+            if not events and not missed:
+                yield SSE_KEEP_ALIVE
+
+    return Stream(generate(), 'text/event-stream'), 200
+
+# Memory Management Endpoints
+@route('/api/memory/store', methods=['POST'])
+async def store_memory(request):
+    """Store user memory"""
+    data = request.get_json()
+    category = data.get('category')
+    key = data.get('key')
+    value = data.get('value')
+
+    if not category or not key:
+        return {'error': 'category and key are required'}, 400
+
+    result = await run_blocking(request.assistant.process_command, 'store_memory', category, key, value)
+    return {'message': result, 'status': 'success'}, 201
+
+@route('/api/memory/retrieve/<category>')
+async def retrieve_memory(request, category):
+    """Retrieve memories by category"""
+    page = await run_blocking(request.assistant.process_command, 'page_memories', category, *page_query(request))
+    return {'memories': page['items'], 'next_cursor': page['next_cursor'], 'status': 'success'}, 200
+
+@route('/api/memory/search', methods=['POST'])
+async def search_memories(request):
+    """Search memories by keyword"""
+    data = request.get_json()
+    keyword = data.get('keyword')
+
+    if not keyword:
+        return {'error': 'keyword is required'}, 400
+
+    if data.get('semantic'):
+        results = await run_blocking(request.assistant.process_command, 'recall_memories', keyword,
+                                     data.get('limit', 5))
+    else:
+        results = await run_blocking(request.assistant.process_command, 'search_memories', keyword)
+    return {'results': results, 'status': 'success'}, 200
+
+# System Endpoints
+@route('/api/status')
+async def get_status(request):
+    """Get overall system status"""
+    status = await run_blocking(request.assistant.get_status)
+    return {'status': status}, 200
+
+@route('/api/command', methods=['POST'])
+async def execute_command(request):
+    """Execute a custom command"""
+    data = request.get_json()
+    command = data.get('command')
+    args = data.get('args', [])
+
+    if not command:
+        return {'error': 'command is required'}, 400
+
+    result = await run_blocking(request.assistant.process_command, command, *args)
+    return {'result': result, 'status': 'success'}, 200
+
+@route('/api/batch', methods=['POST'])
+async def execute_batch(request):
+    """Execute an ordered list of commands in one request"""
+    data = request.get_json()
+    atomic = bool(data.get('atomic', False))
+    results = await run_blocking(request.assistant.process_batch, parse_batch(data.get('commands')), atomic)
+    failed = any(result['status'] != 'success' for result in results)
+    if atomic and failed:
+        return {'results': results, 'status': 'error'}, 400
+    return {'results': results, 'status': 'success'}, 200
+
+@route('/api/commands', public=True)
+async def list_commands(request):
+    """List available commands with their arguments and call statistics"""
+    return {'commands': pool.services.commands.describe(), 'status': 'success'}, 200
+
+@route('/api/metrics', public=True)
+async def get_metrics(request):
+    """Response cache counters"""
+    return {'cache': pool.services.responses.stats(), 'status': 'success'}, 200
+
+@route('/metrics', public=True, metered=False)
+async def scrape_metrics(request):
+    """Every metric in the Prometheus text format"""
+    if not config.ENABLE_ANALYTICS:
+        return {'error': 'Analytics are disabled', 'status': 'error'}, 404
+    return Text(metrics.registry.render(), metrics.CONTENT_TYPE), 200
+
+@route('/api/admin/profile', methods=['POST'], public=True)
+async def profile(request):
+    """Sample every thread for `seconds` and download the collapsed stacks for a flame graph"""
+    try:
+        check_admin(request.headers.get(config.ADMIN_TOKEN_HEADER.lower()))
+        stacks = await run_blocking(profiler.sample, parse_seconds(request.args.get('seconds')))
+    except ProfilerError as e:
+        return {'error': str(e), 'status': 'error'}, e.status
+    disposition = f'attachment; filename="{profiler.filename()}"'.encode()
+    return Text(stacks, 'text/plain; charset=utf-8', [(b'content-disposition', disposition)]), 200
+
+
+async def dispatch(request):
+    """Find the handler for a request and turn its outcome into (payload, status)"""
+    path = request.scope['path']
+    allowed = False
+    for pattern, methods, public, metered, handler in routes:
+        match = pattern.match(path)
+        if match is None:
+            continue
+        if request.scope['method'] not in methods:
+            allowed = True
+            continue
+        request.endpoint = handler.__name__
+        request.trace = tracing.tracer.start(f'asgi_interface.{handler.__name__}',
+                                             config.TRACE_HEADER.lower() in request.headers)
+        if not metered:
+            return await _handle(request, public, handler, match)
+        if not admission.enter():
+            request.response_headers.append((b'retry-after', b'1'))
+            return {'error': 'Server is busy, please retry shortly', 'status': 'error'}, 503
+        start = time.perf_counter()
+        try:
+            return await _handle(request, public, handler, match)
+        finally:
+            admission.exit(time.perf_counter() - start)
+    if allowed:
+        return {'error': 'Method not allowed', 'status': 'error'}, 405
+    return {'error': 'Endpoint not found', 'status': 'error'}, 404
+
+async def _handle(request, public, handler, match):
+    try:
+        if not public:
+            user_id = resolve_user_id(request.headers.get(config.USER_ID_HEADER.lower()),
+                                      request.headers.get(config.AUTH_HEADER.lower()))
+            if config.RATE_LIMIT_ENABLED:
+                wait = limiter.check(user_id, handler.__name__)
+                if wait:
+                    request.response_headers.append((b'retry-after', retry_after_header(wait).encode()))
+                    return {'error': 'Rate limit exceeded', 'status': 'error'}, 429
+            request.assistant = await run_blocking(pool.get, user_id)
+        return await handler(request, **match.groupdict())
+    except UserIdError as e:
+        return {'error': str(e), 'status': 'error'}, e.status
+    except CommandError as e:
+        return {'error': str(e), 'status': 'error'}, 400
+    except Exception as e:
+        return {'error': str(e), 'status': 'error'}, 500
+
+
+def encode(payload):
+    """Serialize a response body the way the Flask app does"""
+    return dumps(payload)
+
+
+def negotiate(request, status, content):
+    """Apply the Flask app's ETag, 304 and compression rules; returns (status, extra headers, body)"""
+    if status != 200:
+        return status, [], content
+    encoding = negotiate_encoding(request.headers.get('accept-encoding'), len(content))
+    headers = [(b'vary', b'Accept-Encoding')]
+    if request.scope['method'] == 'GET':
+        etag = entity_tag(content, encoding)
+        headers.append((b'etag', etag.encode('ascii')))
+        if not_modified(request.headers.get('if-none-match'), etag):
+            return 304, headers, b''
+    if encoding is not None:
+        content = compress(content, encoding)
+        headers.append((b'content-encoding', encoding.encode('ascii')))
+    return status, headers, content
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    request = Request(scope, body)
+    started_at = time.perf_counter()
+    payload, status = await dispatch(request)
+    tracing.tracer.finish(request.trace)
+    if isinstance(payload, Stream):
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - started_at, request.endpoint, scope['method'], status)
+        await _stream(payload, status, receive, send)
+        return
+    if isinstance(payload, Text):
+        content = payload.body.encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', payload.content_type.encode()),
+                                (b'content-length', str(len(content)).encode())] + payload.headers})
+        await send({'type': 'http.response.body', 'body': content})
+        return
+    status, headers, content = negotiate(request, status, encode(payload))
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - started_at, request.endpoint, scope['method'], status)
+    headers += request.response_headers
+    if status != 304:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
+
+async def _stream(stream, status, receive, send):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', stream.content_type.encode()), (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        async for chunk in stream.chunks:
+            if disconnected.done():
+                break
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await stream.chunks.aclose()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_blocking(pool.close)
+            executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,218 @@
+import base64
+import hashlib
+import hmac
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+import config
+import tracing
+from main_controller import AssistantServices, StarkAssistant
+
+logger = logging.getLogger(__name__)
+
+USER_ID_PATTERN = re.compile(r'[A-Za-z0-9_.@-]{1,64}')
+
+class UserIdError(ValueError):
+    """A request's credentials or user id header are missing or invalid; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def issue_token(user_id, secret=None):
+    """Bearer token that proves `user_id` to the API, signed with config.AUTH_SECRET unless given a secret"""
+    if not USER_ID_PATTERN.fullmatch(user_id):
+        raise ValueError(f'invalid user id {user_id!r}')
+    return f'{user_id}.{_sign(user_id, secret or config.AUTH_SECRET)}'
+
+
+def check_auth_config():
+    """Raise RuntimeError at startup when ENABLE_AUTHENTICATION is on but no AUTH_SECRET is configured"""
+    if config.ENABLE_AUTHENTICATION and not config.AUTH_SECRET:
+        raise RuntimeError('ENABLE_AUTHENTICATION is on but AUTH_SECRET is not set; '
+                           'set it in the environment or in .env (see .env.example)')
+
+
+def resolve_user_id(header_value, authorization=None):
+    """The user id for a request given its USER_ID_HEADER and AUTH_HEADER values (None when absent).
+
+    With ENABLE_AUTHENTICATION the user is the one named by an
+    issue_token() bearer token, and a USER_ID_HEADER naming anyone else is
+    refused. Without it the header alone names the user, which is only safe
+    behind a proxy that authenticates callers and sets the header itself.
+    """
+    if config.ENABLE_AUTHENTICATION:
+        user_id = _authenticate(authorization)
+        if header_value and header_value != user_id:
+            raise UserIdError(f'{config.USER_ID_HEADER} does not match the bearer token', 403)
+        return user_id
+    if not header_value:
+        return config.DEFAULT_USER_ID
+    if not USER_ID_PATTERN.fullmatch(header_value):
+        raise UserIdError(f'invalid {config.USER_ID_HEADER} header', 400)
+    return header_value
+
+
+def _authenticate(authorization):
+    if not config.AUTH_SECRET:
+        raise UserIdError('Authentication is enabled but AUTH_SECRET is not set', 500)
+    scheme, _, token = (authorization or '').partition(' ')
+    user_id, _, signature = token.strip().rpartition('.')
+    if scheme.lower() != 'bearer' or not USER_ID_PATTERN.fullmatch(user_id) \
+            or not hmac.compare_digest(signature.encode(), _sign(user_id, config.AUTH_SECRET).encode()):
+        raise UserIdError(f'a valid bearer token is required in the {config.AUTH_HEADER} header', 401)
+    return user_id
+
+
+def _sign(user_id, secret):
+    digest = hmac.new(secret.encode(), user_id.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+class AssistantPool:
+    """Per-user StarkAssistant instances built on one shared AssistantServices.
+
+    Assistants are created on a user's first request and kept in least
+    recently used order, so the pool never holds more than `max_size` of
+    them and the ones idle for longer than `idle_timeout` seconds sit at the
+    front, where a periodic sweep shuts them down. Shutting one down writes
+    out and drops that user's tasks; the next request reads them back from
+    the database.
+
+    The lock only guards the table. Each entry holds a Future for the
+    user's assistant, which is built, like the assistants it displaces are
+    shut down, after the lock is released; other requests for that user
+    wait on the Future, and everyone else carries on. A user being shut
+    down is listed in `retiring` until it is done, and a new assistant for
+    them is not built before then.
+    """
+
+    def __init__(self, services=None, max_size=config.ASSISTANT_POOL_SIZE, idle_timeout=config.SESSION_TIMEOUT,
+                 clock=time.monotonic):
+        self.services = services or AssistantServices()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.assistants = OrderedDict()
+        self.retiring = {}
+        self.lock = threading.Lock()
+        self.sweep_job = self.services.scheduler.schedule(time.time() + config.ASSISTANT_POOL_SWEEP_INTERVAL,
+                                                          self.evict_idle,
+                                                          interval=config.ASSISTANT_POOL_SWEEP_INTERVAL)
+
+    def __len__(self):
+        return len(self.assistants)
+
+    def __contains__(self, user_id):
+        return user_id in self.assistants
+
+    @tracing.traced('assistant_pool.get')
+    def get(self, user_id):
+        """Return the user's assistant, creating it and loading its tasks if needed"""
+        with self.lock:
+            now = self.clock()
+            entry = self.assistants.get(user_id)
+            if entry is not None:
+                self.assistants.move_to_end(user_id)
+                entry[1] = now
+                victims = None
+            else:
+                entry = self.assistants[user_id] = [Future(), now]
+                retiring = self.retiring.get(user_id)
+                victims = [self._take(other) for other in self._oldest_built(len(self.assistants) - self.max_size)]
+        if victims is None:
+            return entry[0].result()
+        return self._build(user_id, entry, victims, retiring)
+
+    def evict_idle(self):
+        """Shut down assistants unused for longer than the idle timeout; returns how many.
+
+        Users idle that long with no event subscribers also lose their event buffers.
+        """
+        with self.lock:
+            cutoff = self.clock() - self.idle_timeout
+            idle = []
+            for user_id, (future, last_used) in self.assistants.items():
+                if last_used > cutoff:
+                    break
+                if future.done():
+                    idle.append(user_id)
+            victims = [self._take(user_id) for user_id in idle]
+        self._retire(victims)
+        self.services.events.evict_idle(self.idle_timeout)
+        return len(victims)
+
+    def close(self):
+        """Shut down every assistant and the shared services"""
+        self.services.scheduler.cancel(self.sweep_job)
+        with self.lock:
+            victims = [self._take(user_id) for user_id in list(self.assistants)]
+        self._retire(victims)
+        self.services.close()
+
+    def _build(self, user_id, entry, victims, retiring):
+        """Make room, wait out any earlier shutdown of the user, then fill the entry's Future"""
+        self._retire(victims)
+        if retiring is not None:
+            retiring.wait()
+        try:
+            assistant = StarkAssistant(user_id, self.services)
+        except BaseException as e:
+            with self.lock:
+                if self.assistants.get(user_id) is entry:
+                    del self.assistants[user_id]
+            entry[0].set_exception(e)
+            raise
+        entry[0].set_result(assistant)
+        return assistant
+
+    def _oldest_built(self, count):
+        """Up to `count` least recently used users whose assistants are built; call with the lock held.
+
+        Entries still being built are passed over, so two requests making
+        room for new users never wait on each other's half-built assistant.
+        """
+        users = []
+        for user_id, (future, _) in self.assistants.items():
+            if len(users) >= count:
+                break
+            if future.done():
+                users.append(user_id)
+        return users
+
+    def _take(self, user_id):
+        """Remove a user's entry and mark them retiring; call with the lock held"""
+        future, _ = self.assistants.pop(user_id)
+        done = self.retiring[user_id] = threading.Event()
+        return user_id, future, done
+
+    def _retire(self, victims):
+        """Shut down assistants removed by _take(), outside the lock"""
+        for user_id, future, done in victims:
+            try:
+                if future.exception() is None:
+                    future.result().shutdown()
+            except Exception:
+                logger.exception('Shutting down the assistant of %s failed', user_id)
+            finally:
+                with self.lock:
+                    if self.retiring.get(user_id) is done:
+                        del self.retiring[user_id]
+                done.set()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Print a bearer token for a user, signed with AUTH_SECRET')
+    parser.add_argument('user_id')
+    args = parser.parse_args()
+    if not config.AUTH_SECRET:
+        parser.error('AUTH_SECRET is not set; set it in the environment or in .env (see .env.example)')
+    try:
+        print(issue_token(args.user_id))
+    except ValueError as e:
+        parser.error(str(e))
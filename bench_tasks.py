@@ -0,0 +1,57 @@
+"""Benchmark for the task endpoints.
+
+Seeds one user with 10k pending tasks, a fraction of them overdue, and
+measures the latency of /api/task/overdue through the Flask test client.
+
+    python bench_tasks.py [--tasks 10000] [--overdue 0.01] [--requests 200]
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import config
+config.DATABASE_NAME = ':memory:'
+config.RATE_LIMIT_ENABLED = False
+config.AUTH_SECRET = 'bench-tasks'
+from api_interface import app, pool
+from assistant_pool import issue_token
+
+HEADERS = {config.AUTH_HEADER: f'Bearer {issue_token(config.DEFAULT_USER_ID)}'}
+
+
+def seed_tasks(count, overdue_ratio):
+    assistant = pool.get(config.DEFAULT_USER_ID)
+    now = datetime.now()
+    overdue = int(count * overdue_ratio)
+    for i in range(count):
+        offset = timedelta(hours=i - overdue + 1)
+        assistant.task_manager.add_task(f"Task {i}", config.DEFAULT_USER_ID, now + offset)
+
+
+def run(count, overdue_ratio, requests):
+    seed_tasks(count, overdue_ratio)
+    client = app.test_client()
+    client.get('/api/task/overdue', headers=HEADERS)
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get('/api/task/overdue', headers=HEADERS)
+        samples.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+    tasks = response.get_json()['tasks']
+    overdue = len(tasks) if isinstance(tasks, list) else 0
+    samples.sort()
+    print(f"/api/task/overdue with {count} tasks ({overdue} overdue), {requests} requests")
+    print(f"  median {statistics.median(samples):.2f} ms")
+    print(f"  p95    {samples[int(len(samples) * 0.95) - 1]:.2f} ms")
+    print(f"  max    {samples[-1]:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--overdue', type=float, default=0.01)
+    parser.add_argument('--requests', type=int, default=200)
+    options = parser.parse_args()
+    run(options.tasks, options.overdue, options.requests)
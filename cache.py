@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+import config
+
+class ResponseCache:
+    """Read-through cache of per-user read results, invalidated by version.
+
+    Every user has a version number that writes bump. Entries are stored
+    under (user, version, key), so a bump makes all of the user's older
+    entries unreachable at once without finding them; they age out of the
+    least-recently-used order as new entries push past `max_entries`.
+
+    A reader takes the version before computing, so a result computed while
+    a write was in progress lands under the old version and is never served.
+    """
+
+    def __init__(self, max_entries=config.RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, user_id, key, compute):
+        """Return the cached result for the user's key, calling compute() to fill it on a miss"""
+        try:
+            hash(key)
+        except TypeError:
+            return compute()
+        with self.lock:
+            entry_key = (user_id, self.versions.get(user_id, 0), key)
+            if entry_key in self.entries:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return self.entries[entry_key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.entries[entry_key] = value
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, user_id):
+        """Forget everything cached for a user"""
+        with self.lock:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self.entries)
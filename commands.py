@@ -0,0 +1,252 @@
+import threading
+import time
+from contextlib import contextmanager
+import config
+import metrics
+import tracing
+
+COMMAND_SECONDS = metrics.histogram('stark_command_duration_seconds', 'Command handler latency by command',
+                                    ('command',))
+COMMAND_ERRORS = metrics.counter('stark_command_errors_total', 'Command handlers that raised, by command', ('command',))
+
+class CommandError(ValueError):
+    """Raised when a command is called with arguments that do not fit its schema"""
+
+
+def parse_batch(items):
+    """Turn a request's list of {command, args} objects into (name, args) calls"""
+    if not isinstance(items, list) or not items:
+        raise CommandError('commands must be a non-empty list')
+    if len(items) > config.MAX_BATCH_COMMANDS:
+        raise CommandError(f'at most {config.MAX_BATCH_COMMANDS} commands per batch')
+    calls = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('command'), str) \
+                or not isinstance(item.get('args', []), list):
+            raise CommandError('each command needs a command name and an args list')
+        calls.append((item['command'], item.get('args', [])))
+    return calls
+
+
+class UndoLog:
+    """Per-thread log of compensating actions for all-or-nothing command batches.
+
+    Managers call record(action, *args) after each change a command makes;
+    outside recording() this is a no-op. Side effects that cannot be taken
+    back, such as publishing an event, go through defer(), which holds them
+    until the batch has succeeded. Recording is per thread, so changes made
+    concurrently by other requests or by scheduler callbacks are never
+    undone by someone else's batch.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def record(self, action, *args):
+        entries = getattr(self._local, 'entries', None)
+        if entries is not None:
+            entries.append((action, args))
+
+    def defer(self, action, *args):
+        """Run action(*args) now, or when the enclosing recording() block succeeds"""
+        deferred = getattr(self._local, 'deferred', None)
+        if deferred is None:
+            action(*args)
+        else:
+            deferred.append((action, args))
+
+    @contextmanager
+    def recording(self):
+        """Run a block whose recorded changes are undone, newest first, if it raises"""
+        self._local.entries = entries = []
+        self._local.deferred = deferred = []
+        try:
+            yield
+        except BaseException:
+            self._local.entries = self._local.deferred = None
+            for action, args in reversed(entries):
+                action(*args)
+            raise
+        finally:
+            self._local.entries = self._local.deferred = None
+        for action, args in deferred:
+            action(*args)
+
+
+undo_log = UndoLog()
+
+
+class Arg:
+    """One positional argument of a command.
+
+    `type` converts incoming values (the UI console passes everything as
+    strings); None passes values through untouched.
+    """
+
+    def __init__(self, name, type=str, required=True, default=None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+
+    def convert(self, command, value):
+        if self.type is None or value is None or isinstance(value, self.type):
+            return value
+        try:
+            return self.type(value)
+        except (TypeError, ValueError):
+            raise CommandError(f"Argument '{self.name}' of {command} must be {self.type.__name__}, Sir.")
+
+    def describe(self):
+        return {'name': self.name, 'type': self.type.__name__ if self.type else 'any', 'required': self.required}
+
+
+class Command:
+    """A registered handler with its argument schema and call statistics.
+
+    A read-only command changes nothing. A cacheable command is read-only
+    and its result depends on nothing but its arguments and the user's
+    data, so it may be served from a cache until the user's next write;
+    reads that also depend on the clock are read-only but not cacheable.
+    """
+
+    def __init__(self, name, handler, args, description, cacheable=False, read_only=False):
+        self.name = name
+        self.handler = handler
+        self.args = tuple(args)
+        self.description = description
+        self.cacheable = cacheable
+        self.read_only = read_only or cacheable
+        # Trace spans are grouped by the module the handler comes from
+        self.span_name = f"{getattr(handler, '__module__', None) or 'commands'}.{name}"
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.lock = threading.Lock()
+
+    def bind(self, values):
+        """Check the call against the schema and return converted arguments"""
+        if len(values) > len(self.args):
+            raise CommandError(f"{self.name} takes at most {len(self.args)} arguments, Sir.")
+        bound = []
+        for position, arg in enumerate(self.args):
+            if position < len(values):
+                bound.append(arg.convert(self.name, values[position]))
+            elif arg.required:
+                raise CommandError(f"Missing argument '{arg.name}' for {self.name}, Sir.")
+            else:
+                bound.append(arg.default)
+        return bound
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_ms': round(self.total_time * 1000, 3),
+            'avg_ms': round(self.total_time * 1000 / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max_time * 1000, 3)
+        }
+
+
+class CommandRegistry:
+    """Name -> Command table that modules register their handlers into.
+
+    Handlers are called as handler(user_id, *args) after the arguments have
+    been checked against the command's schema. Each handler run is timed and
+    counted on its Command; calls rejected by the schema never reach it.
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def register(self, name, handler, args=(), description='', cacheable=False, read_only=False):
+        """Register a handler; registering a name again replaces it"""
+        self.commands[name] = Command(name, handler, args, description, cacheable, read_only)
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def dispatch(self, name, user_id, args=()):
+        """Run a registered command for a user"""
+        command = self.commands.get(name)
+        if command is None:
+            raise CommandError(f"Unknown command '{name}', Sir.")
+        bound = command.bind(args)
+        start = time.perf_counter()
+        try:
+            with tracing.span(command.span_name):
+                return command.handler(user_id, *bound)
+        except Exception:
+            with command.lock:
+                command.errors += 1
+            COMMAND_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            COMMAND_SECONDS.observe(elapsed, name)
+            with command.lock:
+                command.calls += 1
+                command.total_time += elapsed
+                if elapsed > command.max_time:
+                    command.max_time = elapsed
+
+    def check(self, name, args=()):
+        """Raise CommandError if the call would be rejected, without running it"""
+        command = self.commands.get(name)
+        if command is None:
+            raise CommandError(f"Unknown command '{name}', Sir.")
+        command.bind(args)
+
+    def dispatch_batch(self, user_id, calls, atomic=False):
+        """Run (name, args) calls in order and return one result dict per call.
+
+        Every call is checked against its schema first. Without `atomic` each
+        call succeeds or fails on its own. With `atomic` nothing runs unless
+        every call passes the check, and if a handler raises, the changes made
+        by the calls before it are undone through undo_log; those results are
+        marked 'rolled_back' and the rest 'skipped'.
+        """
+        results = []
+        for name, args in calls:
+            try:
+                self.check(name, args)
+                results.append(None)
+            except CommandError as e:
+                results.append({'status': 'error', 'error': str(e)})
+        if atomic and any(results):
+            return [result or {'status': 'skipped'} for result in results]
+        if not atomic:
+            for position, (name, args) in enumerate(calls):
+                if results[position] is None:
+                    try:
+                        results[position] = {'status': 'success', 'result': self.dispatch(name, user_id, args)}
+                    except Exception as e:
+                        results[position] = {'status': 'error', 'error': str(e)}
+            return results
+        position = 0
+        try:
+            with undo_log.recording():
+                for position, (name, args) in enumerate(calls):
+                    results[position] = {'status': 'success', 'result': self.dispatch(name, user_id, args)}
+        except Exception as e:
+            results[:position] = [{'status': 'rolled_back'} for _ in range(position)]
+            results[position] = {'status': 'error', 'error': str(e)}
+            results[position + 1:] = [{'status': 'skipped'} for _ in range(position + 1, len(calls))]
+        return results
+
+    def describe(self):
+        """Schema and statistics for every registered command"""
+        return {
+            name: {
+                'description': command.description,
+                'args': [arg.describe() for arg in command.args],
+                'cacheable': command.cacheable,
+                'read_only': command.read_only,
+                'stats': command.stats()
+            }
+            for name, command in sorted(self.commands.items())
+        }
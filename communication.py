@@ -0,0 +1,137 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from operator import itemgetter
+import config
+from concurrency import IdAllocator, StripedLock
+from commands import Arg, undo_log
+import metrics
+from pagination import PAGE_ARGS, page_of, parse_page_query
+
+MESSAGE_FIELDS = ('id', 'recipient', 'message', 'user_id', 'sent_at')
+NOTIFICATION_FIELDS = ('id', 'notification', 'type', 'user_id', 'created_at')
+SENT = metrics.counter('stark_communications_sent_total', 'Messages and notifications sent, by type', ('type',))
+
+class CommunicationManager:
+    """Per-user lists of sent messages and notifications.
+
+    Records get their id and timestamp under the user's lock as they are
+    appended, so each list is ordered by both and a page is found by
+    bisection rather than by scanning.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker
+        self.messages = {}
+        self.notifications = {}
+        self.ids = IdAllocator()
+        self.locks = StripedLock()
+
+    def send_message(self, recipient, message, user_id):
+        """Send a message to a recipient on behalf of the user"""
+        record = {
+            'recipient': recipient,
+            'message': message,
+            'user_id': user_id
+        }
+        with self.locks(user_id):
+            record['id'] = next(self.ids)
+            record['sent_at'] = datetime.now()
+            self.messages.setdefault(user_id, []).append(record)
+        undo_log.record(self._unsend, self.messages, user_id, record)
+        self._publish(user_id, 'message', record)
+        SENT.inc('message')
+        return f"Message sent to {recipient}, Sir."
+
+    def get_messages(self, user_id):
+        """Get all messages for a user"""
+        with self.locks(user_id):
+            return list(self.messages.get(user_id, ()))
+
+    def send_notification(self, notification, user_id, notification_type="notification"):
+        """Send a notification to the user"""
+        if notification_type not in config.NOTIFICATION_TYPES:
+            return f"Unknown notification type '{notification_type}', Sir."
+        record = {
+            'notification': notification,
+            'type': notification_type,
+            'user_id': user_id
+        }
+        with self.locks(user_id):
+            record['id'] = next(self.ids)
+            record['created_at'] = datetime.now()
+            self.notifications.setdefault(user_id, []).append(record)
+        undo_log.record(self._unsend, self.notifications, user_id, record)
+        self._publish(user_id, 'notification', record)
+        SENT.inc(notification_type)
+        return "Notification sent, Sir."
+
+    def get_notifications(self, user_id):
+        """Get all notifications for a user"""
+        with self.locks(user_id):
+            return list(self.notifications.get(user_id, ()))
+
+    def count_messages(self, user_id):
+        """Number of messages a user has sent"""
+        return len(self.messages.get(user_id, ()))
+
+    def count_notifications(self, user_id):
+        """Number of notifications a user has"""
+        return len(self.notifications.get(user_id, ()))
+
+    def page_messages(self, user_id, limit=config.DEFAULT_PAGE_SIZE, after=None, since=None, fields=None):
+        """One page of a user's messages, oldest first; pass the page's next_cursor position as `after`"""
+        return self._page(self.messages, 'sent_at', user_id, limit, after, since, fields)
+
+    def page_notifications(self, user_id, limit=config.DEFAULT_PAGE_SIZE, after=None, since=None, fields=None):
+        """One page of a user's notifications, oldest first; pass the page's next_cursor position as `after`"""
+        return self._page(self.notifications, 'created_at', user_id, limit, after, since, fields)
+
+    def _page(self, store, time_field, user_id, limit, after, since, fields):
+        with self.locks(user_id):
+            records = store.get(user_id, [])
+            start = 0
+            if after is not None:
+                start = bisect_right(records, after, key=itemgetter('id'))
+            if since is not None:
+                start = max(start, bisect_left(records, since, key=itemgetter(time_field)))
+            records = records[start:start + limit + 1]
+        return page_of(records, limit, itemgetter('id'), fields)
+
+    def _publish(self, user_id, kind, record):
+        if self.broker is not None:
+            undo_log.defer(self.broker.publish, user_id, kind, record)
+
+    def _unsend(self, store, user_id, record):
+        with self.locks(user_id):
+            records = store.get(user_id, [])
+            for position in range(len(records) - 1, -1, -1):
+                if records[position] is record:
+                    del records[position]
+                    return
+
+    def register_metrics(self, registry):
+        """Report how many messages and notifications are held at scrape time"""
+        registry.callback('stark_communications_stored', 'Messages and notifications held in memory', lambda: {
+            ('message',): sum(map(len, list(self.messages.values()))),
+            ('notification',): sum(map(len, list(self.notifications.values())))
+        }, ('kind',))
+
+    def register_commands(self, registry):
+        """Register the messaging commands with a CommandRegistry"""
+        registry.register('send_message',
+                          lambda user_id, recipient, message: self.send_message(recipient, message, user_id),
+                          [Arg('recipient'), Arg('message')], 'Send a message')
+        registry.register('get_messages', self.get_messages, description='List sent messages', cacheable=True)
+        registry.register('page_messages',
+                          lambda user_id, *query: self.page_messages(user_id, *parse_page_query(*query, MESSAGE_FIELDS)),
+                          PAGE_ARGS, 'Page through sent messages', cacheable=True)
+        registry.register('send_notification',
+                          lambda user_id, notification, kind: self.send_notification(notification, user_id, kind),
+                          [Arg('notification'), Arg('type', required=False, default='notification')],
+                          'Send a notification')
+        registry.register('get_notifications', self.get_notifications, description='List notifications',
+                          cacheable=True)
+        registry.register('page_notifications',
+                          lambda user_id, *query: self.page_notifications(
+                              user_id, *parse_page_query(*query, NOTIFICATION_FIELDS)),
+                          PAGE_ARGS, 'Page through notifications', cacheable=True)
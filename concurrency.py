@@ -0,0 +1,47 @@
+import threading
+import config
+
+class IdAllocator:
+    """Hands out strictly increasing integer ids from any number of threads.
+
+    Ids are never reused, not even after the record holding one is deleted;
+    advance() moves the counter past ids that were allocated elsewhere, such
+    as rows read back from the database.
+    """
+
+    def __init__(self, start=1):
+        self._next = start
+        self._lock = threading.Lock()
+
+    def __next__(self):
+        with self._lock:
+            value = self._next
+            self._next += 1
+            return value
+
+    def peek(self):
+        """The id the next call will return"""
+        return self._next
+
+    def advance(self, used):
+        """Make sure ids handed out from now on are greater than `used`"""
+        with self._lock:
+            if used >= self._next:
+                self._next = used + 1
+
+
+class StripedLock:
+    """A fixed set of reentrant locks shared out by key hash.
+
+    Keys that hash to different stripes never contend, so per-user work runs
+    in parallel without keeping a lock object for every user; a stripe is
+    reentrant so a locked method may call another locked method for the
+    same key.
+    """
+
+    def __init__(self, stripes=config.LOCK_STRIPES):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        """The lock guarding `key`, for use in a with statement"""
+        return self._locks[hash(key) % len(self._locks)]
@@ -1,4 +1,18 @@
 # Configuration file for Stark Assistant
+#
+# Secrets are never kept here: AUTH_SECRET and ADMIN_TOKEN come from the
+# environment, or from a .env file when python-dotenv is installed (see
+# .env.example).
+import os
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+if load_dotenv is not None:
+    load_dotenv()
+
 # Application Settings
 APP_NAME = "Stark Assistant"
 APP_VERSION = "1.0.0"
@@ -21,18 +35,66 @@ NOTIFICATION_TYPES = ["text", "notification", "reminder", "alert"]
 MEMORY_CATEGORIES = ["preferences", "conversation", "learned", "personal"]
 MAX_MEMORY_ITEMS_PER_CATEGORY = 5000
 MEMORY_AUTO_CLEANUP_DAYS = 90
+MEMORY_CLEANUP_INTERVAL = 3600
+CONVERSATION_BUFFER_SIZE = 200
+CONVERSATION_LOG_DIR = "conversation_history"
+CONVERSATION_SEGMENT_SIZE = 1048576
+SEMANTIC_DIMENSIONS = 256
 
 # API Settings
 API_HOST = "127.0.0.1"
 API_PORT = 5000
 API_DEBUG = True
 API_ALLOW_CORS = True
+MAX_BATCH_COMMANDS = 1000
+USER_ID_HEADER = "X-User-Id"
+ASSISTANT_POOL_SIZE = 256
+ASSISTANT_POOL_SWEEP_INTERVAL = 60
+LOCK_STRIPES = 64
+ASYNC_EXECUTOR_WORKERS = 32
+EVENT_BUFFER_SIZE = 500
+LONG_POLL_TIMEOUT = 30
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SSE_HEARTBEAT_INTERVAL = 15
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+TIMESTAMP_CACHE_SIZE = 4096
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_DEFAULT = (20, 40)
+RATE_LIMITS = {
+    'search_memories': (5, 10),
+    'execute_command': (10, 20),
+    'execute_batch': (2, 5)
+}
+RATE_LIMIT_MAX_KEYS = 100000
+ADMISSION_MAX_IN_FLIGHT = 64
+ADMISSION_MIN_IN_FLIGHT = 4
+ADMISSION_TARGET_LATENCY = 0.5
+RESPONSE_CACHE_SIZE = 10000
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") or None
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
 
 # Database Settings
 DATABASE_TYPE = "sqlite"
 DATABASE_NAME = "stark_assistant.db"
 DATABASE_HOST = "localhost"
 DATABASE_PORT = 5432
+DATABASE_USER = "stark"
+DATABASE_PASSWORD = ""
+DATABASE_DRIVER = "postgresql+psycopg2"
+DATABASE_URL = None
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 10
+SQLITE_JOURNAL_MODE = "WAL"
+SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_CACHE_SIZE = -16000
+SQLITE_MMAP_SIZE = 268435456
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_STATEMENT_CACHE_SIZE = 256
+TASK_FLUSH_INTERVAL = 1.0
+TASK_FLUSH_BATCH_SIZE = 500
 
 # Logging Settings
 LOG_LEVEL = "INFO"
@@ -40,8 +102,20 @@ LOG_FILE = "stark_assistant.log"
 LOG_MAX_SIZE = 10485760
 LOG_BACKUP_COUNT = 5
 
+# Profiling and Tracing Settings
+ENABLE_PROFILING = False
+PROFILER_INTERVAL = 0.005
+PROFILER_DEFAULT_SECONDS = 10
+PROFILER_MAX_SECONDS = 60
+ENABLE_TRACING = False
+TRACE_SAMPLE_RATE = 0.01
+TRACE_HEADER = "X-Trace"
+TRACE_FILE = "traces.jsonl"
+
 # Security Settings
 ENABLE_AUTHENTICATION = True
+AUTH_SECRET = os.environ.get("AUTH_SECRET") or None
+AUTH_HEADER = "Authorization"
 SESSION_TIMEOUT = 3600
 PASSWORD_MIN_LENGTH = 8
 
@@ -49,6 +123,7 @@ PASSWORD_MIN_LENGTH = 8
 UI_THEME = "dark"
 UI_LANGUAGE = "en"
 UI_AUTO_REFRESH_INTERVAL = 5000
+UI_EVENT_POLL_INTERVAL = 250
 
 # Response Format
 POLITENESS_LEVEL = "high"
@@ -1,64 +1,412 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+import config
+import metrics
+import tracing
+
+DB_SECONDS = metrics.histogram('stark_db_operation_duration_seconds', 'Storage call latency by operation',
+                               ('operation',))
+
+def instrumented(operation):
+    """Decorator timing a storage call into DB_SECONDS and, in a traced request, a database span"""
+    span_name = 'database.' + operation
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracing.span(span_name), DB_SECONDS.time(operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+TASK_COLUMNS = ('id', 'task_name', 'user_id', 'created_at', 'due_date', 'completed', 'reminder')
+
+INSERT_USER = 'INSERT INTO user_profiles (username, email) VALUES (?, ?)'
+INSERT_MEMORY = 'INSERT INTO memory (user_id, memory_text) VALUES (?, ?)'
+INSERT_TASK = 'INSERT INTO tasks (user_id, task_name) VALUES (?, ?)'
+INSERT_COMMUNICATION_LOG = 'INSERT INTO communication_logs (user_id, log) VALUES (?, ?)'
+UPSERT_TASK = f'INSERT OR REPLACE INTO tasks ({", ".join(TASK_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)'
+DELETE_TASK = 'DELETE FROM tasks WHERE id = ?'
+SELECT_TASKS = f'SELECT {", ".join(TASK_COLUMNS)} FROM tasks ORDER BY id'
+SELECT_USER_TASKS = f'SELECT {", ".join(TASK_COLUMNS)} FROM tasks WHERE user_id = ? ORDER BY id'
+SELECT_MAX_TASK_ID = 'SELECT COALESCE(MAX(id), 0) FROM tasks'
+BULK_INSERT_MEMORY = 'INSERT INTO memory (user_id, memory_text, created_at) VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))'
+BULK_INSERT_TASK = 'INSERT INTO tasks (user_id, task_name, created_at) VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))'
+BULK_INSERT_COMMUNICATION_LOG = ('INSERT INTO communication_logs (user_id, log, created_at) '
+                                 'VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))')
+
+# Secondary indexes per table, name -> definition
+INDEXES = {
+    'memory': {
+        'idx_memory_user_created': 'memory (user_id, created_at, id)'
+    },
+    'tasks': {
+        'idx_tasks_user_created': 'tasks (user_id, created_at, id)',
+        'idx_tasks_user_due': 'tasks (user_id, completed, due_date)'
+    },
+    'communication_logs': {
+        'idx_communication_logs_user_created': 'communication_logs (user_id, created_at, id)'
+    }
+}
+
+# Ordered schema migrations; PRAGMA user_version records the last one applied
+MIGRATIONS = [
+    (1, 'index per-user time-range reads', [
+        f'CREATE INDEX IF NOT EXISTS {name} ON {definition}'
+        for table in ('memory', 'tasks', 'communication_logs') for name, definition in INDEXES[table].items()
+    ])
+]
+
+TIMESTAMP_COLUMNS = {'created_at', 'due_date', 'reminder'}
+
+# Columns returned by the paged read queries
+PAGE_COLUMNS = {
+    'memory': ('id', 'user_id', 'memory_text', 'created_at'),
+    'tasks': TASK_COLUMNS,
+    'communication_logs': ('id', 'user_id', 'log', 'created_at')
+}
+
+def page_columns(table, fields=None):
+    """The PAGE_COLUMNS of a table narrowed to `fields`, always keeping the id and created_at keyset"""
+    columns = PAGE_COLUMNS[table]
+    if fields is None:
+        return columns
+    unknown = set(fields).difference(columns)
+    if unknown:
+        raise ValueError(f"Unknown {table} columns: {', '.join(sorted(unknown))}")
+    return tuple(column for column in columns if column in fields or column in ('id', 'created_at'))
+
+class ConnectionManager:
+    """Hands out one tuned SQLite connection per thread.
+
+    Connections run in autocommit mode with the journal mode, synchronous
+    level, page cache and mmap size taken from config, so with WAL readers
+    never wait for a writer. Each connection keeps its own prepared statement
+    cache. transaction() opens BEGIN IMMEDIATE on the calling thread's
+    connection and nests as savepoints. An in-memory database cannot be
+    shared between connections, so ':memory:' uses a single connection
+    serialized by a lock.
+
+    Connections are kept per thread, and whenever a new one is opened those
+    of threads that have since ended are closed, so a server that starts a
+    thread per request holds one connection per live thread, not one per
+    thread it ever ran.
+    """
+
+    def __init__(self, db_name, journal_mode=config.SQLITE_JOURNAL_MODE, synchronous=config.SQLITE_SYNCHRONOUS,
+                 cache_size=config.SQLITE_CACHE_SIZE, mmap_size=config.SQLITE_MMAP_SIZE,
+                 busy_timeout=config.SQLITE_BUSY_TIMEOUT, cached_statements=config.SQLITE_STATEMENT_CACHE_SIZE):
+        self.db_name = db_name
+        self.pragmas = {
+            'journal_mode': journal_mode,
+            'synchronous': synchronous,
+            'cache_size': cache_size,
+            'mmap_size': mmap_size,
+            'busy_timeout': busy_timeout
+        }
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.shared = None
+        self.shared_lock = None
+        if db_name == ':memory:':
+            self.shared = self._open()
+            self.shared_lock = threading.RLock()
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        if self.shared is not None:
+            return self.shared
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._open()
+            with self.lock:
+                ended = [thread for thread in self.connections if not thread.is_alive()]
+                for thread in ended:
+                    self.connections.pop(thread).close()
+                self.connections[threading.current_thread()] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a write transaction, or a savepoint when nested"""
+        with self.reading() as conn:
+            depth = getattr(self.local, 'depth', 0)
+            savepoint = f'sp_{depth}'
+            conn.execute(f'SAVEPOINT {savepoint}' if depth else 'BEGIN IMMEDIATE')
+            self.local.depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth:
+                    conn.execute(f'ROLLBACK TO {savepoint}')
+                    conn.execute(f'RELEASE {savepoint}')
+                else:
+                    conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute(f'RELEASE {savepoint}' if depth else 'COMMIT')
+            finally:
+                self.local.depth = depth
+
+    @contextmanager
+    def reading(self):
+        """Yield the calling thread's connection for reads"""
+        if self.shared_lock is None:
+            yield self.connection()
+        else:
+            with self.shared_lock:
+                yield self.shared
+
+    def close(self):
+        """Close every connection opened by this manager"""
+        with self.lock:
+            connections, self.connections = list(self.connections.values()), {}
+        if self.shared is not None:
+            connections.append(self.shared)
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_name, isolation_level=None, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
 
 class Database:
     def __init__(self, db_name='stark_assistant.db'):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
+        self.connections = ConnectionManager(db_name)
         self.create_tables()
+        self.migrate()
+
+    @property
+    def conn(self):
+        """The calling thread's connection"""
+        return self.connections.connection()
+
+    def transaction(self):
+        """Context manager wrapping the block in one write transaction"""
+        return self.connections.transaction()
 
     def create_tables(self):
-        # Create user profiles table
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS user_profiles (
-            id INTEGER PRIMARY KEY,
-            username TEXT NOT NULL,
-            email TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-
-        # Create memory table
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS memory (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            memory_text TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user_profiles (id)
-        )''')
-
-        # Create tasks table
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY,
-            task_name TEXT NOT NULL,
-            user_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user_profiles (id)
-        )''')
-
-        # Create communication logs table
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS communication_logs (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            log TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user_profiles (id)
-        )''')
-
-        self.conn.commit()
+        with self.transaction() as conn:
+            # Create user profiles table
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_profiles (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                email TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
+            # Create memory table
+            conn.execute('''CREATE TABLE IF NOT EXISTS memory (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                memory_text TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user_profiles (id)
+            )''')
+
+            # Create tasks table
+            conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                task_name TEXT NOT NULL,
+                user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                due_date TIMESTAMP,
+                completed INTEGER DEFAULT 0,
+                reminder TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user_profiles (id)
+            )''')
+
+            # Tables created before tasks were persisted lack the state columns
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(tasks)')}
+            for column in ('due_date TIMESTAMP', 'completed INTEGER DEFAULT 0', 'reminder TIMESTAMP'):
+                if column.split()[0] not in existing:
+                    conn.execute(f'ALTER TABLE tasks ADD COLUMN {column}')
+
+            # Create communication logs table
+            conn.execute('''CREATE TABLE IF NOT EXISTS communication_logs (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                log TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user_profiles (id)
+            )''')
+
+    def migrate(self):
+        """Apply any schema migrations newer than the database's user_version"""
+        with self.transaction() as conn:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, _, statements in MIGRATIONS:
+                if version > current:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f'PRAGMA user_version = {version}')
+        return self.schema_version()
+
+    def schema_version(self):
+        """Return the last migration applied to this database"""
+        with self.connections.reading() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
 
     def add_user(self, username, email):
-        self.cursor.execute('INSERT INTO user_profiles (username, email) VALUES (?, ?)', (username, email))
-        self.conn.commit()
+        with self.transaction() as conn:
+            conn.execute(INSERT_USER, (username, email))
 
     def add_memory(self, user_id, memory_text):
-        self.cursor.execute('INSERT INTO memory (user_id, memory_text) VALUES (?, ?)', (user_id, memory_text))
-        self.conn.commit()
+        with self.transaction() as conn:
+            conn.execute(INSERT_MEMORY, (user_id, memory_text))
 
     def add_task(self, user_id, task_name):
-        self.cursor.execute('INSERT INTO tasks (user_id, task_name) VALUES (?, ?)', (user_id, task_name))
-        self.conn.commit()
+        with self.transaction() as conn:
+            conn.execute(INSERT_TASK, (user_id, task_name))
+
+    @instrumented('apply_task_changes')
+    def apply_task_changes(self, tasks, deleted_ids):
+        """Upsert tasks and delete task ids in a single transaction"""
+        rows = [(task['id'], task['name'], task['user_id'], _to_text(task['created_at']), _to_text(task['due_date']),
+                 int(task['completed']), _to_text(task.get('reminder'))) for task in tasks]
+        with self.transaction() as conn:
+            if rows:
+                conn.executemany(UPSERT_TASK, rows)
+            if deleted_ids:
+                conn.executemany(DELETE_TASK, [(task_id,) for task_id in deleted_ids])
+
+    @instrumented('load_tasks')
+    def load_tasks(self, user_id=None):
+        """Load every task, or one user's tasks, with one SELECT, shaped like TaskManager tasks"""
+        with self.connections.reading() as conn:
+            if user_id is None:
+                rows = conn.execute(SELECT_TASKS).fetchall()
+            else:
+                rows = conn.execute(SELECT_USER_TASKS, (user_id,)).fetchall()
+        tasks = []
+        for task_id, name, user_id, created_at, due_date, completed, reminder in rows:
+            task = {
+                'id': task_id,
+                'name': name,
+                'user_id': user_id,
+                'created_at': _from_text(created_at),
+                'due_date': _from_text(due_date),
+                'completed': bool(completed)
+            }
+            if reminder is not None:
+                task['reminder'] = _from_text(reminder)
+            tasks.append(task)
+        return tasks
+
+    @instrumented('max_task_id')
+    def max_task_id(self):
+        """Highest task id stored so far, or 0"""
+        with self.connections.reading() as conn:
+            return conn.execute(SELECT_MAX_TASK_ID).fetchone()[0]
 
     def add_communication_log(self, user_id, log):
-        self.cursor.execute('INSERT INTO communication_logs (user_id, log) VALUES (?, ?)', (user_id, log))
-        self.conn.commit()
+        with self.transaction() as conn:
+            conn.execute(INSERT_COMMUNICATION_LOG, (user_id, log))
+
+    @instrumented('add_users')
+    def add_users(self, users):
+        """Insert (username, email) rows in one transaction; returns the row count"""
+        with self.transaction() as conn:
+            return conn.executemany(INSERT_USER, users).rowcount
+
+    @instrumented('add_memories')
+    def add_memories(self, memories, rebuild_indexes=False):
+        """Insert (user_id, memory_text[, created_at]) rows in one transaction; returns the row count.
+
+        For imports much larger than the existing table, rebuild_indexes drops
+        the memory indexes for the load and recreates them afterwards, which
+        sorts once instead of updating the index row by row.
+        """
+        with self.transaction() as conn:
+            if rebuild_indexes:
+                for name in INDEXES['memory']:
+                    conn.execute(f'DROP INDEX IF EXISTS {name}')
+            count = conn.executemany(BULK_INSERT_MEMORY, _with_created_at(memories)).rowcount
+            if rebuild_indexes:
+                for name, definition in INDEXES['memory'].items():
+                    conn.execute(f'CREATE INDEX {name} ON {definition}')
+            return count
+
+    @instrumented('add_tasks')
+    def add_tasks(self, tasks):
+        """Insert (user_id, task_name[, created_at]) rows in one transaction; returns the row count"""
+        with self.transaction() as conn:
+            return conn.executemany(BULK_INSERT_TASK, _with_created_at(tasks)).rowcount
+
+    @instrumented('add_communication_logs')
+    def add_communication_logs(self, logs):
+        """Insert (user_id, log[, created_at]) rows in one transaction; returns the row count"""
+        with self.transaction() as conn:
+            return conn.executemany(BULK_INSERT_COMMUNICATION_LOG, _with_created_at(logs)).rowcount
+
+    @instrumented('get_memories')
+    def get_memories(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's memories ordered by creation time"""
+        return self._page('memory', user_id, since, until, after, limit, fields)
+
+    @instrumented('get_tasks')
+    def get_tasks(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's persisted tasks ordered by creation time"""
+        return self._page('tasks', user_id, since, until, after, limit, fields)
+
+    @instrumented('get_communication_logs')
+    def get_communication_logs(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's communication logs ordered by creation time"""
+        return self._page('communication_logs', user_id, since, until, after, limit, fields)
+
+    def _page(self, table, user_id, since, until, after, limit, fields=None):
+        """Keyset-paginated read over the (user_id, created_at) index.
+
+        `since` is inclusive and `until` exclusive. `after` is the
+        (created_at, id) pair of the last row of the previous page; pass
+        page[-1]['created_at'], page[-1]['id'] to continue. `fields` limits
+        the columns read to those named plus the keyset.
+        """
+        columns = page_columns(table, fields)
+        clauses = ['user_id = ?']
+        params = [user_id]
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(_to_text(since))
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(_to_text(until))
+        if after is not None:
+            clauses.append('(created_at, id) > (?, ?)')
+            params.extend((_to_text(after[0]), after[1]))
+        params.append(limit)
+        sql = (f'SELECT {", ".join(columns)} FROM {table} WHERE {" AND ".join(clauses)} '
+               'ORDER BY created_at, id LIMIT ?')
+        with self.connections.reading() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        page = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            for column in TIMESTAMP_COLUMNS.intersection(record):
+                record[column] = _from_text(record[column])
+            page.append(record)
+        return page
 
     def close(self):
-        self.conn.close()
+        self.connections.close()
+
+
+def _to_text(value):
+    return value.isoformat(sep=' ') if isinstance(value, datetime) else value
+
+def _from_text(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def _with_created_at(rows):
+    for row in rows:
+        yield row[0], row[1], _to_text(row[2]) if len(row) > 2 else None
@@ -1,41 +1,92 @@
 import logging
 import time
+from datetime import datetime, timedelta
+import config
+import logging_setup
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 24 * 60 * 60
 
 class HealthMonitor:
-    def __init__(self):
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    def __init__(self, scheduler=None, notify=None, user_id=config.DEFAULT_USER_ID):
         self.health_metrics = {}
         self.medication_reminders = []
         self.sessions = []
+        self.scheduler = scheduler
+        self.notify = notify
+        self.user_id = user_id
 
     def log_health_metric(self, metric_name, value):
         self.health_metrics[metric_name] = value
-        logging.info(f'Logged {metric_name}: {value}')
+        logger.info('Logged %s: %s', metric_name, value)
 
     def add_medication_reminder(self, medication_name, time_to_take):
         reminder = {'medication': medication_name, 'time': time_to_take}
+        if self.scheduler is not None:
+            reminder['job'] = self.scheduler.schedule(next_daily_occurrence(time_to_take), self._fire_medication_reminder,
+                                                      medication_name, time_to_take, interval=DAY_SECONDS)
         self.medication_reminders.append(reminder)
-        logging.info(f'Added medication reminder: {medication_name} at {time_to_take}')
+        logger.info('Added medication reminder: %s at %s', medication_name, time_to_take)
+
+    def remove_medication_reminder(self, medication_name):
+        remaining = []
+        for reminder in self.medication_reminders:
+            if reminder['medication'] == medication_name:
+                if 'job' in reminder:
+                    self.scheduler.cancel(reminder['job'])
+            else:
+                remaining.append(reminder)
+        self.medication_reminders = remaining
+        logger.info('Removed medication reminder: %s', medication_name)
+
+    def _fire_medication_reminder(self, medication_name, time_to_take):
+        message = f'Time to take {medication_name} ({time_to_take}), Sir.'
+        if self.notify is not None:
+            self.notify(message, self.user_id, 'reminder')
+        else:
+            logger.info(message)
 
     def track_work_session(self, session_name):
         start_time = time.time()
         self.sessions.append({'name': session_name, 'start': start_time})
-        logging.info(f'Started work session: {session_name} at {time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start_time))}')
+        logger.info('Started work session: %s at %s', session_name, _UTCTime(start_time))
 
     def end_work_session(self, session_name):
         end_time = time.time()
         for session in self.sessions:
             if session['name'] == session_name:
                 session['end'] = end_time
-                logging.info(f'Ended work session: {session_name} at {time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(end_time))}')
+                logger.info('Ended work session: %s at %s', session_name, _UTCTime(end_time))
                 break
 
     def check_health_status(self):
-        status = "Health Metrics: " + str(self.health_metrics) + '\n' + "Medication Reminders: " + str(self.medication_reminders)
-        logging.info(f'Current Health Status: {status}')
+        reminders = [{'medication': r['medication'], 'time': r['time']} for r in self.medication_reminders]
+        status = "Health Metrics: " + str(self.health_metrics) + '\n' + "Medication Reminders: " + str(reminders)
+        logger.info('Current Health Status: %s', status)
         return status
 
+class _UTCTime:
+    """A UTC epoch time that is only rendered if the log record is written"""
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __str__(self):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self.seconds))
+
+def next_daily_occurrence(time_to_take, now=None):
+    """Return the next datetime at which an 'HH:MM' daily time occurs"""
+    now = now or datetime.now()
+    hour, minute = (int(part) for part in time_to_take.split(':')[:2])
+    occurrence = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if occurrence <= now:
+        occurrence += timedelta(days=1)
+    return occurrence
+
 if __name__ == '__main__':
+    logging_setup.configure()
     monitor = HealthMonitor()  
     monitor.log_health_metric('Heart Rate', 72)  
     monitor.add_medication_reminder('Aspirin', '08:00')  
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import config
+
+class ConversationLog:
+    """Append-only conversation log split into rotating segment files.
+
+    Records are written as JSON lines to numbered segment files in
+    `directory`; a new segment starts once the current one reaches
+    `segment_size` bytes. Reading streams one segment at a time, so the full
+    history can be scanned without loading it into memory, and tail(n) reads
+    segments newest-first and stops once it has n records.
+    """
+
+    def __init__(self, directory, segment_size=config.CONVERSATION_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(name for name in os.listdir(directory) if name.endswith('.jsonl'))
+        if not self.segments:
+            self.segments.append(self._segment_name(0))
+        self.file = open(self._path(self.segments[-1]), 'ab')
+
+    def append(self, record):
+        """Append one record, rotating to a new segment when the current one is full"""
+        line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+        with self.lock:
+            if self.file.tell() and self.file.tell() + len(line) > self.segment_size:
+                self.file.close()
+                self.segments.append(self._segment_name(int(self.segments[-1].split('.')[0]) + 1))
+                self.file = open(self._path(self.segments[-1]), 'ab')
+            self.file.write(line)
+            self.file.flush()
+
+    def __iter__(self):
+        """Stream every record, oldest first"""
+        with self.lock:
+            segments = list(self.segments)
+        for name in segments:
+            with open(self._path(name), 'rb') as segment:
+                for line in segment:
+                    yield json.loads(line)
+
+    def iter_reverse(self):
+        """Stream every record, newest first, holding one segment in memory at a time"""
+        with self.lock:
+            segments = list(self.segments)
+        for name in reversed(segments):
+            with open(self._path(name), 'rb') as segment:
+                lines = segment.readlines()
+            for line in reversed(lines):
+                yield json.loads(line)
+
+    def tail(self, n):
+        """Return the last n records, oldest first"""
+        records = []
+        for record in self.iter_reverse():
+            if len(records) >= n:
+                break
+            records.append(record)
+        records.reverse()
+        return records
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _segment_name(number):
+        return f'{number:08d}.jsonl'
@@ -0,0 +1,108 @@
+"""Process-wide logging: JSON lines in a size-rotated file, written off the calling thread.
+
+configure() points the root logger at a QueueHandler, so a logging call
+only merges its arguments into the message and puts the record on a
+queue. A QueueListener thread turns queued records into JSON and appends
+them to config.LOG_FILE, rolling it over at LOG_MAX_SIZE bytes and keeping
+LOG_BACKUP_COUNT old files. Modules log through their own
+logging.getLogger(__name__) with %-style arguments, which are never
+formatted when LOG_LEVEL filters the record out.
+"""
+import atexit
+import copy
+import logging
+import queue
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import config
+from serialization import dumps
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with `extra=` fields kept as their own keys"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return dumps(entry).decode('utf-8')
+
+
+class _StructuredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() renders the whole line on the calling thread; this
+    one only merges the arguments and the traceback, which must happen
+    before the record crosses threads, and keeps the `extra=` fields.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(level=None, path=None, max_bytes=None, backup_count=None):
+    """Route the root logger through a background JSON file writer; later calls replace the earlier setup.
+
+    Settings not passed are read from config.LOG_* at call time.
+    """
+    global _listener, _handler
+    level = config.LOG_LEVEL if level is None else level
+    path = config.LOG_FILE if path is None else path
+    max_bytes = config.LOG_MAX_SIZE if max_bytes is None else max_bytes
+    backup_count = config.LOG_BACKUP_COUNT if backup_count is None else backup_count
+    with _lock:
+        _stop()
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        file_handler.setFormatter(JSONFormatter())
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, file_handler)
+        _handler = _StructuredQueueHandler(records)
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        root.setLevel(level)
+        _listener.start()
+
+
+def shutdown():
+    """Write out every queued record and close the log file"""
+    with _lock:
+        _stop()
+
+
+def _stop():
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _handler = None
+
+
+atexit.register(shutdown)
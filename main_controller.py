@@ -1 +1,136 @@
-from task_manager import TaskManager\nfrom communication import CommunicationManager\nfrom memory import MemoryManager\nfrom datetime import datetime\n\nclass StarkAssistant:\n    """Main orchestrator module that coordinates all assistant modules"""\n    \n    def __init__(self, user_id):\n        self.user_id = user_id\n        self.task_manager = TaskManager()\n        self.communication_manager = CommunicationManager()\n        self.memory_manager = MemoryManager()\n        self.start_time = datetime.now()\n        print(f"Welcome, Sir. I am at your service. Current time: {self.start_time}")\n\n    def process_command(self, command, *args):\n        """Process user commands and route to appropriate module"""\n        command = command.lower().strip()\n        \n        # Task Management Commands\n        if command == "add_task":\n            return self.task_manager.add_task(args[0], self.user_id, args[1] if len(args) > 1 else None)\n        elif command == "list_tasks":\n            return self.task_manager.list_tasks(self.user_id)\n        elif command == "complete_task":\n            return self.task_manager.complete_task(args[0])\n        elif command == "delete_task":\n            return self.task_manager.delete_task(args[0])\n        elif command == "get_overdue_tasks":\n            return self.task_manager.get_overdue_tasks(self.user_id)\n        \n        # Communication Commands\n        elif command == "send_message":\n            return self.communication_manager.send_message(args[0], args[1], self.user_id)\n        elif command == "get_messages":\n            return self.communication_manager.get_messages(self.user_id)\n        elif command == "send_notification":\n            return self.communication_manager.send_notification(args[0], self.user_id, args[1] if len(args) > 1 else "notification")\n        elif command == "get_notifications":\n            return self.communication_manager.get_notifications(self.user_id)\n        \n        # Memory Commands\n        elif command == "store_memory":\n            return self.memory_manager.store_memory(self.user_id, args[0], args[1], args[2] if len(args) > 2 else None)\n        elif command == "retrieve_memory":\n            return self.memory_manager.retrieve_memory(self.user_id, args[0])\n        elif command == "search_memories":\n            return self.memory_manager.search_memories(self.user_id, args[0])\n        \n        else:\n            return "Command not recognized, Sir. Please try again."\n\n    def get_status(self):\n        """Get overall assistant status"""\n        return {\n            'user_id': self.user_id,\n            'uptime': str(datetime.now() - self.start_time),\n            'active_tasks': len([t for t in self.task_manager.tasks if not t['completed']]),\n            'pending_messages': len(self.communication_manager.get_messages(self.user_id)),\n            'stored_memories': sum(len(m) for m in self.memory_manager.memories.get(self.user_id, {}).values())\n        }\n\n    def shutdown(self):\n        """Gracefully shutdown the assistant"""\n        print(f"Shutting down. It has been a pleasure serving you, Sir.")\n        return True
\ No newline at end of file
+from cache import ResponseCache
+from task_manager import TaskManager
+from communication import CommunicationManager
+from memory import MemoryManager
+from health_monitor import HealthMonitor
+from scheduler import default_scheduler
+from storage import create_backend
+from commands import CommandRegistry
+import metrics
+import tracing
+from pubsub import EventBroker
+import config
+from datetime import datetime
+
+class AssistantServices:
+    """Storage, scheduler and managers shared by every StarkAssistant of a process.
+
+    The managers keep their data per user, so one set serves any number of
+    assistants; tasks are read from the database per user on demand. Results
+    of cacheable commands are kept in `responses` until the user's next write.
+    """
+
+    def __init__(self, database=None, scheduler=None, history_dir=config.CONVERSATION_LOG_DIR):
+        self.scheduler = scheduler if scheduler is not None else default_scheduler()
+        self.events = EventBroker()
+        self.communication_manager = CommunicationManager(self.events)
+        self.database = database or create_backend()
+        self.task_manager = TaskManager(self.scheduler, self.communication_manager.send_notification, self.database,
+                                        preload=False)
+        self.responses = ResponseCache()
+        self.memory_manager = MemoryManager(self.scheduler, history_dir=history_dir,
+                                            on_expire=self.responses.invalidate)
+        self.commands = CommandRegistry()
+        self.task_manager.register_commands(self.commands)
+        self.communication_manager.register_commands(self.commands)
+        self.memory_manager.register_commands(self.commands)
+        self.task_manager.register_metrics(metrics.registry)
+        self.communication_manager.register_metrics(metrics.registry)
+        self.memory_manager.register_metrics(metrics.registry)
+        metrics.callback('stark_response_cache_lookups_total', 'Response cache lookups by result',
+                         lambda: {('hit',): self.responses.hits, ('miss',): self.responses.misses},
+                         ('result',), kind='counter')
+        metrics.callback('stark_response_cache_entries', 'Entries in the response cache', lambda: len(self.responses))
+
+    def close(self):
+        self.task_manager.close()
+        self.memory_manager.close()
+        self.database.close()
+
+
+class StarkAssistant:
+    """Main orchestrator module that coordinates all assistant modules"""
+    
+    def __init__(self, user_id, services=None):
+        self.user_id = user_id
+        self.owns_services = services is None
+        self.services = services = services or AssistantServices()
+        self.scheduler = services.scheduler
+        self.communication_manager = services.communication_manager
+        self.database = services.database
+        self.task_manager = services.task_manager
+        self.memory_manager = services.memory_manager
+        self.commands = services.commands
+        self.responses = services.responses
+        self.events = services.events
+        # Reminders and health alerts change the user's data outside process_command
+        self.events.subscribe(user_id, self._on_event)
+        self.health_monitor = HealthMonitor(self.scheduler, self.communication_manager.send_notification, user_id)
+        self.task_manager.load_user(user_id)
+        self.start_time = datetime.now()
+        print(f"Welcome, Sir. I am at your service. Current time: {self.start_time}")
+
+    def process_command(self, command, *args):
+        """Process user commands and route to appropriate module.
+
+        Cacheable commands are answered from the response cache when the
+        user has written nothing since the same call; any command that is
+        not read-only counts as a write and invalidates the user's cached
+        results.
+        """
+        command = command.lower().strip()
+        registered = self.commands.get(command)
+        if registered is None:
+            return "Command not recognized, Sir. Please try again."
+        with tracing.span('main_controller.process_command'):
+            if registered.cacheable:
+                return self.responses.get_or_compute(self.user_id, (command, args),
+                                                     lambda: self.commands.dispatch(command, self.user_id, args))
+            if registered.read_only:
+                return self.commands.dispatch(command, self.user_id, args)
+            try:
+                return self.commands.dispatch(command, self.user_id, args)
+            finally:
+                self.responses.invalidate(self.user_id)
+
+    def process_batch(self, calls, atomic=False):
+        """Run an ordered list of (command, args) pairs and return a result dict for each.
+
+        Task changes made by the batch reach the database together in one
+        flush at the end. With `atomic`, either every command runs or none of
+        their changes are kept (see CommandRegistry.dispatch_batch).
+        """
+        calls = [(command.lower().strip(), tuple(args)) for command, args in calls]
+        try:
+            with self.task_manager.staging_writes():
+                results = self.commands.dispatch_batch(self.user_id, calls, atomic)
+        finally:
+            self.responses.invalidate(self.user_id)
+        with tracing.span('task_manager.flush'):
+            self.task_manager.flush()
+        return results
+
+    def get_status(self):
+        """Get overall assistant status; every count is kept up to date by its manager, so this is O(1)"""
+        return {
+            'user_id': self.user_id,
+            'uptime': str(datetime.now() - self.start_time),
+            'active_tasks': self.task_manager.count(self.user_id),
+            'pending_messages': self.communication_manager.count_messages(self.user_id),
+            'notifications': self.communication_manager.count_notifications(self.user_id),
+            'stored_memories': self.memory_manager.count(self.user_id)
+        }
+
+    def _on_event(self, event):
+        self.responses.invalidate(self.user_id)
+
+    def shutdown(self):
+        """Gracefully shutdown the assistant"""
+        print(f"Shutting down. It has been a pleasure serving you, Sir.")
+        self.events.unsubscribe(self.user_id, self._on_event)
+        self.responses.invalidate(self.user_id)
+        if self.owns_services:
+            self.services.close()
+        else:
+            self.task_manager.unload_user(self.user_id)
+        return True
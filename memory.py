@@ -1,59 +1,338 @@
+import heapq
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import islice
+import config
+from commands import Arg, undo_log
+from concurrency import StripedLock
+import metrics
+from pagination import PAGE_ARGS, page_of, parse_page_query
+from history_log import ConversationLog
+from search_index import InvertedIndex
+from semantic_index import SemanticIndex
+
+DAY_SECONDS = 24 * 60 * 60
+MEMORY_FIELDS = ('key', 'value', 'updated_at')
+MEMORY_OPERATIONS = metrics.counter('stark_memory_operations_total', 'Memory changes and lookups by operation',
+                                    ('operation',))
+
 class MemoryManager:
-    def __init__(self):
-        self.preferences = {}
-        self.conversation_history = []
-        self.learned_information = {}  
-        self.personal_details = {}
+    """Per-user memories grouped by category.
+
+    memories[user_id][category] is an OrderedDict of key -> [value, last_touched]
+    kept in least-recently-used order, so the oldest entry is evicted in O(1)
+    once a category reaches MAX_MEMORY_ITEMS_PER_CATEGORY and entries untouched
+    for MEMORY_AUTO_CLEANUP_DAYS are trimmed from the front of each category.
+    Per-user totals are kept alongside so counts never walk the store.
+
+    Recent conversation turns are held in a fixed-size ring buffer; when a
+    history directory is given every turn is also appended to an on-disk
+    ConversationLog, which serves anything older than the buffer.
+
+    recall_memories() ranks memories by similarity of hashed embeddings; a
+    user's SemanticIndex is built on first use and then kept in step with
+    every store and eviction.
+
+    Everything a user owns, including their indexes, is guarded by that
+    user's stripe of a StripedLock.
+
+    Reads pass over memories untouched for longer than the TTL, and the
+    periodic cleanup removes them; it runs outside any command, so
+    `on_expire(user_id)` is called for every user it removed memories from.
+    """
+
+    def __init__(self, scheduler=None, max_items=config.MAX_MEMORY_ITEMS_PER_CATEGORY,
+                 ttl=config.MEMORY_AUTO_CLEANUP_DAYS * DAY_SECONDS, history_dir=None,
+                 history_size=config.CONVERSATION_BUFFER_SIZE, on_expire=None):
+        self.memories = {}
+        self.counts = {}
+        self.locks = StripedLock()
+        self.search_indexes = {}
+        self.semantic_indexes = {}
+        self.conversation_history = deque(maxlen=history_size)
+        self.conversation_log = ConversationLog(history_dir) if history_dir else None
+        if self.conversation_log is not None:
+            self.conversation_history.extend(self.conversation_log.tail(history_size))
+        self.max_items = max_items
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.scheduler = scheduler
+        self.cleanup_job = None
+        if scheduler is not None:
+            self.cleanup_job = scheduler.schedule(time.time() + config.MEMORY_CLEANUP_INTERVAL, self.cleanup_expired,
+                                                  interval=config.MEMORY_CLEANUP_INTERVAL)
+
+    def store_memory(self, user_id, category, key, value=None):
+        """Store a memory under a category, evicting the least recently used entry when full."""
+        with self.locks(user_id):
+            if category not in config.MEMORY_CATEGORIES:
+                return f"Unknown memory category '{category}', Sir."
+            bucket = self.memories.setdefault(user_id, {}).setdefault(category, OrderedDict())
+            previous = bucket.get(key)
+            evicted = None
+            if previous is not None:
+                bucket.move_to_end(key)
+            elif len(bucket) >= self.max_items:
+                evicted = bucket.popitem(last=False)
+                self._evict(user_id, category, evicted[0])
+                MEMORY_OPERATIONS.inc('evict')
+            else:
+                self.counts[user_id] = self.counts.get(user_id, 0) + 1
+            bucket[key] = [value, time.time()]
+            self._reindex(user_id, category, key, value)
+            undo_log.record(self._undo_store, user_id, category, key, previous, evicted)
+        MEMORY_OPERATIONS.inc('store')
+        return "Memory stored successfully, Sir."
+
+    def retrieve_memory(self, user_id, category):
+        """Retrieve all memories stored under a category."""
+        with self.locks(user_id):
+            cutoff = time.time() - self.ttl
+            bucket = self.memories.get(user_id, {}).get(category, {})
+            found = {key: entry[0] for key, entry in bucket.items() if entry[1] >= cutoff}
+            if not found:
+                return "No memories found in this category, Sir."
+            return found
+
+    def page_memories(self, user_id, category, limit=config.DEFAULT_PAGE_SIZE, after=None, since=None, fields=None):
+        """One page of a category's memories ordered by key; pass the page's next_cursor position as `after`."""
+        with self.locks(user_id):
+            bucket = self.memories.get(user_id, {}).get(category, {})
+            since = max(since.timestamp() if since is not None else 0, time.time() - self.ttl)
+            entries = ((key, entry) for key, entry in bucket.items()
+                       if (after is None or str(key) > after) and entry[1] >= since)
+            page = [{'key': key, 'value': entry[0], 'updated_at': datetime.fromtimestamp(entry[1])}
+                    for key, entry in heapq.nsmallest(limit + 1, entries, key=lambda item: str(item[0]))]
+        return page_of(page, limit, lambda item: str(item['key']), fields)
+
+    def get_memory(self, user_id, category, key, default=None):
+        """Return one memory's value, marking it as recently used."""
+        with self.locks(user_id):
+            bucket = self.memories.get(user_id, {}).get(category)
+            entry = bucket.get(key) if bucket else None
+            if entry is None:
+                return default
+            if time.time() - entry[1] > self.ttl:
+                self.forget_memory(user_id, category, key)
+                return default
+            entry[1] = time.time()
+            bucket.move_to_end(key)
+            return entry[0]
+
+    def forget_memory(self, user_id, category, key):
+        """Remove one memory."""
+        with self.locks(user_id):
+            bucket = self.memories.get(user_id, {}).get(category)
+            if not bucket or key not in bucket:
+                return "No memory found for this key, Sir."
+            del bucket[key]
+            self._evict(user_id, category, key)
+            self.counts[user_id] -= 1
+        MEMORY_OPERATIONS.inc('forget')
+        return "Memory removed, Sir."
+
+    def clear_memories(self, user_id, category):
+        """Remove every memory in a category."""
+        with self.locks(user_id):
+            bucket = self.memories.get(user_id, {}).pop(category, None)
+            if bucket:
+                for key in bucket:
+                    self._evict(user_id, category, key)
+                self.counts[user_id] -= len(bucket)
+                MEMORY_OPERATIONS.inc('forget', amount=len(bucket))
+            return "All information cleared successfully, Sir."
 
-    def store_information(self, key, value):
+    def count(self, user_id, category=None):
+        """Number of memories a user has, optionally within one category."""
+        if category is not None:
+            return len(self.memories.get(user_id, {}).get(category, ()))
+        return self.counts.get(user_id, 0)
+
+    def cleanup_expired(self, now=None):
+        """Drop memories untouched for longer than the TTL; returns how many were removed."""
+        cutoff = (now or time.time()) - self.ttl
+        removed = 0
+        for user_id in list(self.memories):
+            expired = 0
+            with self.locks(user_id):
+                for category, bucket in self.memories[user_id].items():
+                    while bucket:
+                        key, entry = next(iter(bucket.items()))
+                        if entry[1] > cutoff:
+                            break
+                        del bucket[key]
+                        self._evict(user_id, category, key)
+                        expired += 1
+                self.counts[user_id] -= expired
+            if expired and self.on_expire is not None:
+                self.on_expire(user_id)
+            removed += expired
+        MEMORY_OPERATIONS.inc('expire', amount=removed)
+        return removed
+
+    def search_memories(self, user_id, query):
+        """Search a user's keys and values for entries containing every word of the query (as a prefix)."""
+        MEMORY_OPERATIONS.inc('search')
+        with self.locks(user_id):
+            cutoff = time.time() - self.ttl
+            results = {}
+            index = self.search_indexes.get(user_id)
+            for category, key in sorted(index.search(query), key=str) if index else ():
+                entry = self.memories[user_id][category][key]
+                if entry[1] >= cutoff:
+                    results.setdefault(category, {})[key] = entry[0]
+            if results:
+                return results
+            else:
+                return "No memories found matching the query, Sir."
+
+    def recall_memories(self, user_id, query, k=5):
+        """Return the k memories closest in meaning to the query, best first."""
+        MEMORY_OPERATIONS.inc('recall')
+        with self.locks(user_id):
+            semantic = self.semantic_indexes.get(user_id)
+            if semantic is None:
+                semantic = self.semantic_indexes[user_id] = SemanticIndex()
+                for category, bucket in self.memories.get(user_id, {}).items():
+                    for key, entry in bucket.items():
+                        semantic.add((category, key), _memory_text(key, entry[0]))
+            cutoff = time.time() - self.ttl
+            results = []
+            for (category, key), score in semantic.search(query, int(k)):
+                entry = self.memories[user_id][category][key]
+                if entry[1] >= cutoff:
+                    results.append({'category': category, 'key': key, 'value': entry[0], 'score': round(score, 4)})
+            return results if results else "No memories found matching the query, Sir."
+
+    def register_commands(self, registry):
+        """Register the memory commands with a CommandRegistry."""
+        registry.register('store_memory', self.store_memory,
+                          [Arg('category'), Arg('key', type=None), Arg('value', type=None, required=False)],
+                          'Store a memory under a category')
+        registry.register('retrieve_memory', self.retrieve_memory, [Arg('category')], 'List memories in a category',
+                          cacheable=True)
+        registry.register('page_memories',
+                          lambda user_id, category, *query: self.page_memories(
+                              user_id, category, *parse_page_query(*query, MEMORY_FIELDS, cursor_type=str)),
+                          (Arg('category'),) + PAGE_ARGS, 'Page through memories in a category', cacheable=True)
+        registry.register('search_memories', self.search_memories, [Arg('keyword')], 'Keyword search over memories',
+                          cacheable=True)
+        registry.register('recall_memories', self.recall_memories,
+                          [Arg('query'), Arg('limit', type=int, required=False, default=5)],
+                          'Semantic search over memories', cacheable=True)
+
+    def register_metrics(self, registry):
+        """Report how many memories and conversation turns are held at scrape time."""
+        registry.callback('stark_memories', 'Memories held in memory', lambda: sum(list(self.counts.values())))
+        registry.callback('stark_conversation_buffer', 'Conversation turns in the in-memory buffer',
+                          lambda: len(self.conversation_history))
+
+    def store_information(self, key, value, user_id=config.DEFAULT_USER_ID):
         """Store information based on a key-value pair."""
-        self.learned_information[key] = value
+        self.store_memory(user_id, 'learned', key, value)
         return "Information stored successfully, Sir."
 
-    def retrieve_information(self, key):
+    def retrieve_information(self, key, user_id=config.DEFAULT_USER_ID):
         """Retrieve information based on the key provided."""
-        return self.learned_information.get(key, "No information found for this key, Sir.")
+        return self.get_memory(user_id, 'learned', key, "No information found for this key, Sir.")
 
-    def update_information(self, key, value):
+    def update_information(self, key, value, user_id=config.DEFAULT_USER_ID):
         """Update existing information based on a key-value pair."""
-        if key in self.learned_information:
-            self.learned_information[key] = value
-            return "Information updated successfully, Sir."
-        else:
-            return "No information found for this key to update, Sir."
+        with self.locks(user_id):
+            if key in self.memories.get(user_id, {}).get('learned', ()):
+                self.store_memory(user_id, 'learned', key, value)
+                return "Information updated successfully, Sir."
+            else:
+                return "No information found for this key to update, Sir."
 
-    def clear_information(self):
+    def clear_information(self, user_id=config.DEFAULT_USER_ID):
         """Clear all stored information."""
-        self.learned_information.clear()
-        return "All information cleared successfully, Sir."
+        return self.clear_memories(user_id, 'learned')
 
     def add_to_conversation_history(self, conversation):
         """Add a conversation record to the history."""
         self.conversation_history.append(conversation)
+        if self.conversation_log is not None:
+            self.conversation_log.append(conversation)
         return "Conversation history updated, Sir."
 
-    def search_memories(self, query):
-        """Search through stored memories based on a query."""
-        results = {key: value for key, value in self.learned_information.items() if query.lower() in key.lower()}
-        if results:
-            return results
-        else:
-            return "No memories found matching the query, Sir."     
+    def recent_conversation(self, n):
+        """Return the last n conversation records, oldest first."""
+        if n <= len(self.conversation_history) or self.conversation_log is None:
+            recent = list(islice(reversed(self.conversation_history), n))
+            recent.reverse()
+            return recent
+        return self.conversation_log.tail(n)
+
+    def iter_conversation_history(self):
+        """Stream the full conversation history, oldest first, without loading it all."""
+        if self.conversation_log is not None:
+            return iter(self.conversation_log)
+        return iter(list(self.conversation_history))
 
-    def store_preferences(self, key, value):
+    def close(self):
+        """Cancel the periodic cleanup and close the conversation log."""
+        if self.cleanup_job is not None:
+            self.scheduler.cancel(self.cleanup_job)
+            self.cleanup_job = None
+        if self.conversation_log is not None:
+            self.conversation_log.close()
+
+    def store_preferences(self, key, value, user_id=config.DEFAULT_USER_ID):
         """Store user preferences."""
-        self.preferences[key] = value
+        self.store_memory(user_id, 'preferences', key, value)
         return "Preferences stored successfully, Sir."
 
-    def retrieve_preferences(self, key):
+    def retrieve_preferences(self, key, user_id=config.DEFAULT_USER_ID):
         """Retrieve user preferences."""
-        return self.preferences.get(key, "No preference found for this key, Sir.")
+        return self.get_memory(user_id, 'preferences', key, "No preference found for this key, Sir.")
 
-    def store_personal_details(self, detail, value):
+    def store_personal_details(self, detail, value, user_id=config.DEFAULT_USER_ID):
         """Store personal details of the user."""
-        self.personal_details[detail] = value
+        self.store_memory(user_id, 'personal', detail, value)
         return "Personal details stored successfully, Sir."
 
-    def retrieve_personal_details(self, detail):
+    def retrieve_personal_details(self, detail, user_id=config.DEFAULT_USER_ID):
         """Retrieve personal details of the user."""
-        return self.personal_details.get(detail, "No personal detail found for this key, Sir.")
+        return self.get_memory(user_id, 'personal', detail, "No personal detail found for this key, Sir.")
+
+    def _index(self, user_id):
+        index = self.search_indexes.get(user_id)
+        if index is None:
+            index = self.search_indexes[user_id] = InvertedIndex()
+        return index
+
+    def _reindex(self, user_id, category, key, value):
+        self._index(user_id).add((category, key), key, value)
+        semantic = self.semantic_indexes.get(user_id)
+        if semantic is not None:
+            semantic.add((category, key), _memory_text(key, value))
+
+    def _undo_store(self, user_id, category, key, previous, evicted):
+        with self.locks(user_id):
+            bucket = self.memories.get(user_id, {}).get(category)
+            if bucket is None or key not in bucket:
+                return
+            if previous is not None:
+                bucket[key] = previous
+                self._reindex(user_id, category, key, previous[0])
+            else:
+                del bucket[key]
+                self._evict(user_id, category, key)
+                if evicted is None:
+                    self.counts[user_id] -= 1
+            if evicted is not None:
+                bucket[evicted[0]] = evicted[1]
+                bucket.move_to_end(evicted[0], last=False)
+                self._reindex(user_id, category, evicted[0], evicted[1][0])
+
+    def _evict(self, user_id, category, key):
+        self.search_indexes[user_id].remove((category, key))
+        semantic = self.semantic_indexes.get(user_id)
+        if semantic is not None:
+            semantic.remove((category, key))
+
+
+def _memory_text(key, value):
+    return f'{key} {value}' if value is not None else str(key)
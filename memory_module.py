@@ -1,21 +1,29 @@
 # memory_module.py
 
+from semantic_index import SemanticIndex
+
 class MemoryModule:
     def __init__(self):
         self.memories = {}
+        self.indexes = {}
 
     def store_memory(self, user_id, memory):
         if user_id not in self.memories:
             self.memories[user_id] = []
+            self.indexes[user_id] = SemanticIndex()
+        self.indexes[user_id].add(len(self.memories[user_id]), memory)
         self.memories[user_id].append(memory)
 
-    def retrieve_memories(self, user_id):
-        return self.memories.get(user_id, [])
+    def retrieve_memories(self, user_id, query=None, k=5):
+        # With a query, return the k memories most similar to it, best first
+        if query is None:
+            return self.memories.get(user_id, [])
+        if user_id not in self.indexes:
+            return []
+        return [self.memories[user_id][position] for position, _ in self.indexes[user_id].search(query, k)]
 
     def update_profile(self, user_id, profile_info):
-        if user_id not in self.memories:
-            self.memories[user_id] = []
-        self.memories[user_id].append(profile_info)
+        self.store_memory(user_id, profile_info)
     
 # Example usage:
 # memory_module = MemoryModule()
@@ -0,0 +1,206 @@
+"""Process-wide metrics, rendered in the Prometheus text exposition format.
+
+Modules declare their instruments once at import time:
+
+    COMMAND_SECONDS = metrics.histogram('stark_command_duration_seconds', 'Command handler latency', ('command',))
+
+and record into them on the hot path with observe()/inc(), which cost a
+lock and a dict update. Histograms keep per-bucket counts and are made
+cumulative only when scraped. Values that are already maintained
+elsewhere (store sizes, cache counters) are not copied on every change
+but read by a callback when /metrics is scraped.
+
+Nothing is recorded unless config.ENABLE_ANALYTICS is set; the flag is
+read on every call, so it can be switched while the process runs.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+import config
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_names(self, sample_name):
+        return self.labelnames
+
+    def samples(self):
+        """(sample name, label values, value) triples for rendering"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, labels, value) for labels, value in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        position = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def timed(self, *labels):
+        """Decorator form of time()"""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (_format_value(bound),), cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+    def label_names(self, sample_name):
+        return self.labelnames + ('le',) if sample_name.endswith('_bucket') else self.labelnames
+
+
+class Callback(Metric):
+    """A value read from `function` at scrape time: a number, or a dict of label tuple -> number"""
+
+    def __init__(self, registry, name, help, function, labelnames=(), kind='gauge'):
+        super().__init__(registry, name, help, labelnames)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        value = self.function()
+        if isinstance(value, dict):
+            return [(self.name, labels, number) for labels, number in value.items()]
+        return [(self.name, (), value)]
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=None):
+        self._enabled = enabled
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """The flag given to the constructor, or else config.ENABLE_ANALYTICS as it is now"""
+        return config.ENABLE_ANALYTICS if self._enabled is None else self._enabled
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labelnames, buckets))
+
+    def callback(self, name, help, function, labelnames=(), kind='gauge'):
+        """Register (or replace) a metric computed when scraped"""
+        return self._add(Callback(self, name, help, function, labelnames, kind))
+
+    def render(self):
+        """All metrics in the text exposition format"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{_format_labels(metric.label_names(name), labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+# The process's registry and shortcuts for declaring into it
+registry = MetricsRegistry()
+counter = registry.counter
+histogram = registry.histogram
+callback = registry.callback
+
+# Shared by the Flask and ASGI apps
+HTTP_SECONDS = histogram('stark_http_request_duration_seconds', 'API request latency by route, method and status',
+                         ('route', 'method', 'status'))
+
+
+def register_admission(limiter, admission):
+    """Report an API app's rate limiter and admission controller at scrape time"""
+    callback('stark_rate_limit_buckets', 'Token buckets held by the rate limiter', lambda: len(limiter))
+    callback('stark_requests_in_flight', 'Requests holding an admission slot', lambda: admission.in_flight)
+    callback('stark_admission_limit', 'Current adaptive limit on requests in flight', lambda: admission.limit)
+    callback('stark_admission_rejected_total', 'Requests shed with 503', lambda: admission.rejected, kind='counter')
@@ -0,0 +1,63 @@
+import base64
+import json
+from datetime import datetime
+from commands import Arg, CommandError
+import config
+
+class PageQueryError(CommandError):
+    """A list request's limit, cursor, since or fields parameter is invalid"""
+
+
+# Optional limit, cursor, since and fields arguments of the page_* commands
+PAGE_ARGS = tuple(Arg(name, type=None, required=False) for name in ('limit', 'cursor', 'since', 'fields'))
+
+def encode_cursor(position):
+    """Opaque token for the sort key of the last item on a page"""
+    return base64.urlsafe_b64encode(json.dumps([position]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))[0]
+    except (ValueError, TypeError, IndexError, KeyError):
+        raise PageQueryError('cursor is not valid')
+
+
+def parse_page_query(limit=None, cursor=None, since=None, fields=None, allowed_fields=(), cursor_type=int):
+    """Validate list query parameters; returns (limit, position after cursor, since, fields)"""
+    try:
+        limit = int(limit) if limit not in (None, '') else config.DEFAULT_PAGE_SIZE
+    except (TypeError, ValueError):
+        raise PageQueryError('limit must be an integer')
+    if not 1 <= limit <= config.MAX_PAGE_SIZE:
+        raise PageQueryError(f'limit must be between 1 and {config.MAX_PAGE_SIZE}')
+    if isinstance(since, str):
+        try:
+            since = datetime.fromisoformat(since) if since else None
+        except ValueError:
+            raise PageQueryError('since must be an ISO 8601 timestamp')
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)
+    if fields:
+        fields = tuple(dict.fromkeys(fields.split(',')))
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown:
+            raise PageQueryError(f"unknown fields {', '.join(unknown)}; choose from {', '.join(allowed_fields)}")
+    else:
+        fields = None
+    position = decode_cursor(cursor)
+    if position is not None and type(position) is not cursor_type:
+        raise PageQueryError('cursor is not valid')
+    return limit, position, since, fields
+
+
+def page_of(items, limit, sort_key, fields=None):
+    """Shape up to limit+1 items (the extra one only signals a next page) into a page"""
+    more = len(items) > limit
+    items = items[:limit]
+    next_cursor = encode_cursor(sort_key(items[-1])) if more else None
+    if fields is not None:
+        items = [{field: item.get(field) for field in fields} for item in items]
+    return {'items': items, 'next_cursor': next_cursor}
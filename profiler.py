@@ -0,0 +1,97 @@
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+import config
+
+class ProfilerError(RuntimeError):
+    """A profile cannot be taken now; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def check_admin_config():
+    """Raise RuntimeError at startup when ENABLE_PROFILING is on but no ADMIN_TOKEN is configured"""
+    if config.ENABLE_PROFILING and not config.ADMIN_TOKEN:
+        raise RuntimeError('ENABLE_PROFILING is on but ADMIN_TOKEN is not set; '
+                           'set it in the environment or in .env (see .env.example)')
+
+
+def check_admin(token):
+    """Raise ProfilerError unless profiling is enabled and `token` matches config.ADMIN_TOKEN.
+
+    With no ADMIN_TOKEN configured every request is refused.
+    """
+    if not config.ENABLE_PROFILING:
+        raise ProfilerError('Profiling is disabled', 404)
+    if not config.ADMIN_TOKEN:
+        raise ProfilerError('ADMIN_TOKEN is not configured', 403)
+    if not hmac.compare_digest((token or '').encode(), config.ADMIN_TOKEN.encode()):
+        raise ProfilerError(f'{config.ADMIN_TOKEN_HEADER} header is missing or wrong', 403)
+
+
+def parse_seconds(value):
+    try:
+        seconds = float(value) if value not in (None, '') else config.PROFILER_DEFAULT_SECONDS
+    except ValueError:
+        raise ProfilerError('seconds must be a number', 400)
+    if not 0 < seconds <= config.PROFILER_MAX_SECONDS:
+        raise ProfilerError(f'seconds must be between 0 and {config.PROFILER_MAX_SECONDS}', 400)
+    return seconds
+
+
+class SamplingProfiler:
+    """Statistical profiler over every thread of the process.
+
+    While sample() runs it wakes every `interval` seconds and records the
+    stack of each other thread via sys._current_frames(), so the code being
+    profiled is not traced or slowed beyond the GIL hand-off per sample. The
+    result is in the collapsed-stack format flame graph tools read: one line
+    per distinct stack, frames root first separated by semicolons, followed
+    by how many samples saw it. Only one profile runs at a time.
+    """
+
+    def __init__(self, interval=config.PROFILER_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def sample(self, seconds):
+        """Sample for `seconds` and return the collapsed stacks as text"""
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerError('A profile is already running', 409)
+        try:
+            stacks = Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+                time.sleep(self.interval)
+        finally:
+            self.lock.release()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    @staticmethod
+    def filename():
+        """Download name for a profile taken now"""
+        return time.strftime('profile-%Y%m%d-%H%M%S.folded')
+
+
+def _collapse(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    frames.append(thread_name)
+    frames.reverse()
+    return ';'.join(frame.replace(';', ':') for frame in frames)
+
+
+profiler = SamplingProfiler()
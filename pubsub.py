@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+import config
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ('message', 'notification')
+
+def parse_event_query(cursor=None, types=None, timeout=None):
+    """Validate the cursor, types and timeout query parameters of an event request"""
+    try:
+        cursor = int(cursor) if cursor not in (None, '') else 0
+        timeout = float(timeout) if timeout not in (None, '') else config.LONG_POLL_TIMEOUT
+    except ValueError:
+        raise ValueError('cursor must be an integer and timeout a number of seconds')
+    if cursor < 0:
+        raise ValueError('cursor must not be negative')
+    kinds = None
+    if types:
+        kinds = set(types.split(','))
+        if not kinds <= set(EVENT_TYPES):
+            raise ValueError(f"types must be a comma separated subset of {', '.join(EVENT_TYPES)}")
+    return cursor, kinds, min(max(timeout, 0.0), config.LONG_POLL_TIMEOUT)
+
+def format_sse(event, dumps):
+    """Frame one event for a text/event-stream response"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {dumps(event['data'])}\n\n"
+
+def format_sse_reset(cursor):
+    """Tell a stream client it missed events and should reload its lists"""
+    return f'id: {cursor}\nevent: reset\ndata: {{}}\n\n'
+
+SSE_KEEP_ALIVE = ': keep-alive\n\n'
+
+
+class EventBroker:
+    """In-process publish/subscribe of per-user events with resumable cursors.
+
+    Every event published for a user gets the next number in that user's
+    sequence and is kept in a ring of the last EVENT_BUFFER_SIZE events, so a
+    client that remembers the last number it saw (its cursor) can ask for
+    only what came after it. Subscribers are callbacks run on the publishing
+    thread; wait() is the blocking flavour used by long-poll requests.
+
+    evict_idle() forgets users with no subscribers and no recent events. A
+    forgotten user's next sequence continues above every number handed out
+    to a forgotten user so far, so an old cursor still reads as missed
+    rather than matching unrelated events.
+    """
+
+    def __init__(self, buffer_size=config.EVENT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.buffers = {}
+        self.sequences = {}
+        self.subscribers = {}
+        self.floor = 0
+        self.lock = threading.Lock()
+
+    def publish(self, user_id, kind, data):
+        """Record an event for a user and hand it to the user's subscribers"""
+        with self.lock:
+            sequence = self.sequences.get(user_id, self.floor) + 1
+            self.sequences[user_id] = sequence
+            event = {'id': sequence, 'type': kind, 'data': data, 'published_at': datetime.now()}
+            buffer = self.buffers.get(user_id)
+            if buffer is None:
+                buffer = self.buffers[user_id] = deque(maxlen=self.buffer_size)
+            buffer.append(event)
+            subscribers = list(self.subscribers.get(user_id, ()))
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception('Event subscriber %r failed for %s', callback, user_id)
+        return event
+
+    def subscribe(self, user_id, callback):
+        """Call callback(event) for every event published for the user from now on"""
+        with self.lock:
+            self.subscribers.setdefault(user_id, []).append(callback)
+
+    def unsubscribe(self, user_id, callback):
+        with self.lock:
+            callbacks = self.subscribers.get(user_id)
+            if callbacks and callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self.subscribers[user_id]
+
+    def evict_idle(self, max_age):
+        """Forget users without subscribers whose last event is older than max_age seconds; returns how many"""
+        cutoff = datetime.now() - timedelta(seconds=max_age)
+        with self.lock:
+            idle = [user_id for user_id, buffer in self.buffers.items()
+                    if user_id not in self.subscribers and buffer[-1]['published_at'] <= cutoff]
+            for user_id in idle:
+                del self.buffers[user_id]
+                self.floor = max(self.floor, self.sequences.pop(user_id))
+        return len(idle)
+
+    def cursor(self, user_id):
+        """The number of the user's latest event, or 0"""
+        return self.sequences.get(user_id, 0)
+
+    def events_since(self, user_id, cursor, kinds=None):
+        """Return (events after cursor, new cursor, missed).
+
+        `missed` is true when the cursor is older than the buffer or newer
+        than anything published (the sequence restarted with the process);
+        the client should then reload the full lists and continue from the
+        new cursor.
+        """
+        with self.lock:
+            latest = self.sequences.get(user_id, 0)
+            buffer = self.buffers.get(user_id)
+            if cursor > latest:
+                return [], latest, True
+            if not buffer or cursor == latest:
+                return [], latest, False
+            missed = cursor < buffer[0]['id'] - 1
+            start = max(0, len(buffer) - (latest - cursor))
+            events = [buffer[i] for i in range(start, len(buffer))]
+        if kinds is not None:
+            events = [event for event in events if event['type'] in kinds]
+        return events, latest, missed
+
+    def wait(self, user_id, cursor, timeout, kinds=None):
+        """Like events_since(), but block up to timeout seconds until there is something to return"""
+        arrived = threading.Event()
+
+        def on_event(event):
+            if kinds is None or event['type'] in kinds:
+                arrived.set()
+
+        self.subscribe(user_id, on_event)
+        try:
+            events, cursor, missed = self.events_since(user_id, cursor, kinds)
+            if not events and not missed and arrived.wait(timeout):
+                events, cursor, missed = self.events_since(user_id, cursor, kinds)
+            return events, cursor, missed
+        finally:
+            self.unsubscribe(user_id, on_event)
+
+    async def wait_async(self, user_id, cursor, timeout, kinds=None):
+        """wait() for coroutines: suspends the caller instead of blocking a thread"""
+        loop = asyncio.get_running_loop()
+        arrived = asyncio.Event()
+
+        def on_event(event):
+            if kinds is None or event['type'] in kinds:
+                loop.call_soon_threadsafe(arrived.set)
+
+        self.subscribe(user_id, on_event)
+        try:
+            events, cursor, missed = self.events_since(user_id, cursor, kinds)
+            if not events and not missed:
+                try:
+                    await asyncio.wait_for(arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return events, cursor, missed
+                events, cursor, missed = self.events_since(user_id, cursor, kinds)
+            return events, cursor, missed
+        finally:
+            self.unsubscribe(user_id, on_event)
@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+import config
+
+class RateLimiter:
+    """Token buckets per (user, route) with a fixed memory bound.
+
+    A bucket refills continuously at `rate` tokens per second up to `burst`
+    and each request spends one token. Buckets live in an OrderedDict in
+    least-recently-used order; once `max_keys` buckets exist the stalest is
+    dropped, which at worst hands that user a fresh, full bucket. A check is
+    a dict lookup, a little arithmetic and a move_to_end, all O(1).
+    """
+
+    def __init__(self, budgets=None, default=config.RATE_LIMIT_DEFAULT, max_keys=config.RATE_LIMIT_MAX_KEYS,
+                 clock=time.monotonic):
+        self.budgets = config.RATE_LIMITS if budgets is None else budgets
+        self.default = default
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, user_id, route):
+        """Spend a token for the user on a route; returns 0 if allowed, else seconds until one is available"""
+        rate, burst = self.budgets.get(route, self.default)
+        key = (user_id, route)
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self.buckets.popitem(last=False)
+                bucket = self.buckets[key] = [burst, now]
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class AdmissionController:
+    """Sheds load when the process is saturated, whoever is asking.
+
+    At most `limit` requests run at once. The limit adapts to latency: each
+    completion feeds an exponentially weighted average, and while that
+    average is above `target_latency` the limit shrinks by a tenth (never
+    below `min_limit`); otherwise it grows back by one up to `max_limit`.
+    Requests arriving while the limit is reached are refused so they can be
+    answered with 503 instead of queueing behind slow ones.
+    """
+
+    def __init__(self, max_limit=config.ADMISSION_MAX_IN_FLIGHT, min_limit=config.ADMISSION_MIN_IN_FLIGHT,
+                 target_latency=config.ADMISSION_TARGET_LATENCY, smoothing=0.1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.limit = max_limit
+        self.in_flight = 0
+        self.latency = 0.0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        """Take a slot for a request; False means it should be turned away"""
+        with self.lock:
+            if self.in_flight >= self.limit:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def exit(self, elapsed):
+        """Release a slot taken by enter() for a request that ran for `elapsed` seconds"""
+        with self.lock:
+            self.in_flight -= 1
+            self.latency += (elapsed - self.latency) * self.smoothing
+            if self.latency > self.target_latency:
+                self.limit = max(self.min_limit, self.limit - max(1, self.limit // 10))
+            elif self.limit < self.max_limit:
+                self.limit += 1
+
+
+def retry_after_header(seconds):
+    """Retry-After value for a wait of `seconds`, in whole seconds"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class ScheduledJob:
+    """Handle for a callback queued on a ReminderScheduler"""
+    __slots__ = ('when', 'seq', 'callback', 'args', 'interval', 'cancelled', 'queued')
+
+    def __init__(self, when, seq, callback, args, interval):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self.queued = True
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class ReminderScheduler:
+    """Min-heap timer that runs callbacks on a single background thread.
+
+    Jobs are ordered by due time in a heap, so scheduling is O(log n). Cancel
+    marks the job and leaves it for the heap to discard when it surfaces; the
+    heap is compacted once cancelled jobs outnumber live ones. The worker
+    thread sleeps on a condition until the earliest job is due or a sooner job
+    is scheduled, so nothing polls.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._cancelled = 0
+        self._running = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def start(self):
+        """Start the worker thread if it is not already running"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='reminder-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the worker thread; queued jobs are kept"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, when, callback, *args, interval=None):
+        """Run callback(*args) at `when` (datetime or epoch seconds), repeating every `interval` seconds if given"""
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        if not isinstance(when, (int, float)) or isinstance(when, bool):
+            raise TypeError(f'when must be a datetime or epoch seconds, not {type(when).__name__}')
+        with self._condition:
+            job = ScheduledJob(when, next(self._sequence), callback, args, interval)
+            heapq.heappush(self._heap, job)
+            if self._heap[0] is job:
+                self._condition.notify()
+        self.start()
+        return job
+
+    def cancel(self, job):
+        """Cancel a scheduled job; cancelling twice is harmless"""
+        with self._condition:
+            if job is None or job.cancelled:
+                return
+            job.cancelled = True
+            if not job.queued:
+                return
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) // 2:
+                for queued in self._heap:
+                    if queued.cancelled:
+                        queued.queued = False
+                self._heap = [queued for queued in self._heap if not queued.cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _next_due(self):
+        """Pop the next due job, waiting until one is due; returns None on stop"""
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                job = self._heap[0]
+                if job.cancelled:
+                    heapq.heappop(self._heap)
+                    job.queued = False
+                    self._cancelled -= 1
+                    continue
+                delay = job.when - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if job.interval:
+                    job.when += job.interval
+                    job.seq = next(self._sequence)
+                    heapq.heappush(self._heap, job)
+                else:
+                    job.queued = False
+                return job
+            return None
+
+    def _drop_earliest(self):
+        """Discard the job at the top of the heap after it could not be handled"""
+        with self._condition:
+            if not self._heap:
+                return
+            job = heapq.heappop(self._heap)
+            job.queued = False
+            if job.cancelled:
+                self._cancelled -= 1
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    job = self._next_due()
+                except Exception:
+                    logger.exception('Scheduled job could not be queued; dropping it')
+                    self._drop_earliest()
+                    continue
+                if job is None:
+                    return
+                try:
+                    job.callback(*job.args)
+                except Exception:
+                    logger.exception('Scheduled callback failed')
+        finally:
+            # Let start() bring up a new worker should this one ever die
+            with self._condition:
+                if self._thread is threading.current_thread():
+                    self._running = False
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+def default_scheduler():
+    """Return the process-wide scheduler shared by all modules"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = ReminderScheduler()
+        return _default_scheduler
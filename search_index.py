@@ -0,0 +1,76 @@
+import re
+from bisect import bisect_left, insort
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+
+def tokenize(text):
+    """Split text into lowercase word tokens; underscores separate words"""
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class InvertedIndex:
+    """Token -> document postings for keyword search.
+
+    Documents are indexed under the tokens of their text. Each query term
+    matches every token it is a prefix of, found by bisecting a sorted
+    vocabulary, and the terms are ANDed by intersecting postings starting
+    from the smallest. Adding or removing a document only touches its own
+    tokens, so the index is kept up to date incrementally.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, *texts):
+        """Index a document under the tokens of the given texts, replacing any earlier version"""
+        self.remove(doc_id)
+        tokens = frozenset(token for text in texts if text is not None for token in tokenize(text))
+        self.documents[doc_id] = tokens
+        for token in tokens:
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = set()
+                insort(self.vocabulary, token)
+            docs.add(doc_id)
+
+    def remove(self, doc_id):
+        """Drop a document from the index; unknown ids are ignored"""
+        for token in self.documents.pop(doc_id, ()):
+            docs = self.postings[token]
+            docs.discard(doc_id)
+            if not docs:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def clear(self):
+        self.postings.clear()
+        self.documents.clear()
+        self.vocabulary.clear()
+
+    def search(self, query):
+        """Return the ids of documents matching every term of the query as a prefix"""
+        terms = set(tokenize(query))
+        if not terms:
+            return set()
+        matches = sorted((self._prefix_matches(term) for term in terms), key=len)
+        result = set(matches[0])
+        for docs in matches[1:]:
+            if not result:
+                break
+            result.intersection_update(docs)
+        return result
+
+    def _prefix_matches(self, term):
+        start = bisect_left(self.vocabulary, term)
+        end = bisect_left(self.vocabulary, term + '\U0010ffff', start)
+        if end - start == 1:
+            return self.postings[self.vocabulary[start]]
+        docs = set()
+        for token in self.vocabulary[start:end]:
+            docs.update(self.postings[token])
+        return docs
@@ -0,0 +1,91 @@
+import re
+import zlib
+import numpy as np
+import config
+
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+def embed(text, dimensions=config.SEMANTIC_DIMENSIONS):
+    """Embed text as an L2-normalized hashed bag of words and character trigrams.
+
+    Features are hashed with crc32, which is stable across processes, into
+    `dimensions` buckets with a sign bit to spread collisions. Trigrams of
+    each padded word let related word forms ('remind', 'reminder') overlap.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in WORD_PATTERN.findall(str(text).lower()):
+        _add_feature(vector, 'w:' + word, 1.0)
+        padded = f'<{word}>'
+        for i in range(len(padded) - 2):
+            _add_feature(vector, padded[i:i + 3], 0.5)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+def _add_feature(vector, feature, weight):
+    digest = zlib.crc32(feature.encode('utf-8'))
+    vector[digest % len(vector)] += weight if digest & 0x80000000 else -weight
+
+
+class SemanticIndex:
+    """Top-k cosine similarity search over embedded documents.
+
+    Embeddings live in rows of one contiguous float32 matrix that grows by
+    doubling, so appends are amortized O(d) and a query is a single
+    matrix-vector product followed by a partial sort. Removing a document
+    moves the last row into its slot.
+    """
+
+    def __init__(self, dimensions=config.SEMANTIC_DIMENSIONS, capacity=256):
+        self.dimensions = dimensions
+        self.matrix = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.ids = []
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, doc_id, text):
+        """Embed and store a document, replacing any earlier version"""
+        vector = embed(text, self.dimensions)
+        row = self.rows.get(doc_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.matrix):
+                grown = np.zeros((len(self.matrix) * 2, self.dimensions), dtype=np.float32)
+                grown[:row] = self.matrix
+                self.matrix = grown
+            self.ids.append(doc_id)
+            self.rows[doc_id] = row
+        self.matrix[row] = vector
+
+    def remove(self, doc_id):
+        """Drop a document; unknown ids are ignored"""
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            moved = self.ids[last]
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = moved
+            self.rows[moved] = row
+        self.ids.pop()
+
+    def clear(self):
+        self.ids.clear()
+        self.rows.clear()
+
+    def search(self, query, k=5):
+        """Return up to k (doc_id, score) pairs with positive similarity, best first"""
+        count = len(self.ids)
+        if not count or k <= 0:
+            return []
+        scores = self.matrix[:count] @ embed(query, self.dimensions)
+        if k < count:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(count)
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.ids[row], float(scores[row])) for row in top if scores[row] > 0]
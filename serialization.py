@@ -0,0 +1,83 @@
+"""Response body encoding shared by the Flask and ASGI apps.
+
+dumps() turns a payload into JSON bytes. orjson is used when it is
+installed; it writes datetimes, dates and dicts in C, so the task, message
+and memory records go out without a Python callback per value. The
+standard library encoder is the fallback, with ISO strings memoized per
+timestamp, since the same created_at or due_date is sent on every list of
+a user's records. Either way timestamps are ISO 8601 and keys are sorted,
+so equal payloads give equal bytes and equal entity tags, and non-ASCII
+text is written as UTF-8 rather than as escapes.
+
+negotiate_encoding(), compress() and entity_tag() implement the content
+negotiation both apps apply to JSON responses: brotli (when installed) or
+gzip for bodies of at least COMPRESSION_MIN_SIZE bytes, and a strong ETag
+per representation so a client repeating a request with If-None-Match gets
+a 304 instead of the same body again.
+"""
+import gzip
+import hashlib
+import json
+from datetime import date
+from functools import lru_cache
+from werkzeug.http import parse_accept_header, parse_etags
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+@lru_cache(maxsize=config.TIMESTAMP_CACHE_SIZE)
+def _isoformat(value):
+    return value.isoformat()
+
+def _default(value):
+    if isinstance(value, date):
+        return _isoformat(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    def dumps(payload):
+        """Serialize a response payload to JSON bytes"""
+        return orjson.dumps(payload, default=_default, option=_ORJSON_OPTIONS)
+else:
+    _encoder = json.JSONEncoder(default=_default, sort_keys=True, separators=(',', ':'),
+                                ensure_ascii=False)
+
+    def dumps(payload):
+        """Serialize a response payload to JSON bytes"""
+        return _encoder.encode(payload).encode('utf-8')
+
+
+def negotiate_encoding(accept_encoding, size):
+    """The content coding to send a body of `size` bytes in, or None to send it as is"""
+    if not accept_encoding or size < config.COMPRESSION_MIN_SIZE:
+        return None
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=config.GZIP_LEVEL)
+
+def entity_tag(body, encoding=None):
+    """Strong ETag for a body as sent with `encoding`"""
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+def not_modified(if_none_match, etag):
+    """True when an If-None-Match header already names `etag`"""
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(etag.strip('"'))
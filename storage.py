@@ -0,0 +1,471 @@
+# Storage backends for Stark Assistant
+#
+# Every backend exposes the interface of database.Database: transaction(),
+# migrate()/schema_version(), the single-row and bulk add_* methods, the
+# paged get_* reads, apply_task_changes()/load_tasks()/max_task_id() and close().
+# create_backend() picks one from config.DATABASE_TYPE.
+
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table, Text, create_engine, event,
+                        func, insert, select, tuple_)
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.pool import StaticPool
+import config
+from database import instrumented, page_columns
+
+metadata = MetaData()
+
+user_profiles_table = Table(
+    'user_profiles', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(255), nullable=False),
+    Column('email', String(255)),
+    Column('created_at', DateTime, server_default=func.current_timestamp())
+)
+
+memory_table = Table(
+    'memory', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', String(64)),
+    Column('memory_text', Text),
+    Column('created_at', DateTime, server_default=func.current_timestamp())
+)
+
+tasks_table = Table(
+    'tasks', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('task_name', Text, nullable=False),
+    Column('user_id', String(64)),
+    Column('created_at', DateTime, server_default=func.current_timestamp()),
+    Column('due_date', DateTime),
+    Column('completed', Integer, default=0),
+    Column('reminder', DateTime)
+)
+
+communication_logs_table = Table(
+    'communication_logs', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', String(64)),
+    Column('log', Text),
+    Column('created_at', DateTime, server_default=func.current_timestamp())
+)
+
+schema_version_table = Table(
+    'schema_version', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime, server_default=func.current_timestamp())
+)
+
+# Secondary indexes; kept outside the tables so migrations create them
+INDEXES = [
+    Index('idx_memory_user_created', memory_table.c.user_id, memory_table.c.created_at, memory_table.c.id),
+    Index('idx_tasks_user_created', tasks_table.c.user_id, tasks_table.c.created_at, tasks_table.c.id),
+    Index('idx_tasks_user_due', tasks_table.c.user_id, tasks_table.c.completed, tasks_table.c.due_date),
+    Index('idx_communication_logs_user_created', communication_logs_table.c.user_id,
+          communication_logs_table.c.created_at, communication_logs_table.c.id)
+]
+
+def _create_indexes(conn):
+    for index in INDEXES:
+        index.create(conn, checkfirst=True)
+
+# Ordered schema migrations; versions match database.MIGRATIONS
+MIGRATIONS = [
+    (1, 'index per-user time-range reads', _create_indexes)
+]
+
+TABLES = {
+    'user_profiles': user_profiles_table,
+    'memory': memory_table,
+    'tasks': tasks_table,
+    'communication_logs': communication_logs_table
+}
+
+# (table, text column) written by the bulk add_* methods
+BULK_COLUMNS = {
+    'memory': 'memory_text',
+    'tasks': 'task_name',
+    'communication_logs': 'log'
+}
+
+
+def database_url(database_type=None):
+    """Build the SQLAlchemy URL for the configured database"""
+    database_type = database_type or config.DATABASE_TYPE
+    if config.DATABASE_URL:
+        return config.DATABASE_URL
+    if database_type == 'sqlite':
+        return URL.create('sqlite', database=config.DATABASE_NAME)
+    return URL.create(config.DATABASE_DRIVER, username=config.DATABASE_USER, password=config.DATABASE_PASSWORD,
+                      host=config.DATABASE_HOST, port=config.DATABASE_PORT, database=config.DATABASE_NAME)
+
+
+def create_backend(database_type=None):
+    """Return the storage backend selected by config.DATABASE_TYPE.
+
+    'sqlite' uses the tuned native database.Database, 'memory' the
+    in-process MemoryBackend, and anything else (e.g. 'postgresql') goes
+    through SQLAlchemy. Setting DATABASE_URL always selects SQLAlchemy.
+    """
+    database_type = database_type or config.DATABASE_TYPE
+    if database_type == 'memory':
+        return MemoryBackend()
+    if database_type == 'sqlite' and not config.DATABASE_URL:
+        from database import Database
+        return Database(config.DATABASE_NAME)
+    return SQLAlchemyBackend(database_url(database_type))
+
+
+class SQLAlchemyBackend:
+    """Storage on SQLAlchemy Core with a pooled engine.
+
+    Works against any dialect SQLAlchemy supports; SQLite and PostgreSQL are
+    the targets. SQLite connections get the same pragmas as
+    database.ConnectionManager. transaction() binds a connection to the
+    calling thread so the add_* methods called inside it join the same
+    transaction; nested calls become savepoints.
+    """
+
+    def __init__(self, url, pool_size=config.DATABASE_POOL_SIZE, max_overflow=config.DATABASE_MAX_OVERFLOW):
+        self.engine = _create_engine(url, pool_size, max_overflow)
+        self.local = threading.local()
+        self.create_tables()
+        self.migrate()
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in one transaction, or a savepoint when nested"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            with conn.begin_nested():
+                yield conn
+            return
+        with self.engine.begin() as conn:
+            self.local.conn = conn
+            try:
+                yield conn
+            finally:
+                self.local.conn = None
+
+    @contextmanager
+    def reading(self):
+        """Yield the current transaction's connection, or a pooled one"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+        else:
+            with self.engine.connect() as conn:
+                yield conn
+
+    def create_tables(self):
+        with self.transaction() as conn:
+            metadata.create_all(conn, tables=list(TABLES.values()) + [schema_version_table])
+
+    def migrate(self):
+        """Apply any schema migrations newer than the recorded schema version"""
+        with self.transaction() as conn:
+            current = conn.execute(select(func.max(schema_version_table.c.version))).scalar() or 0
+            for version, description, apply in MIGRATIONS:
+                if version > current:
+                    apply(conn)
+                    conn.execute(insert(schema_version_table), {'version': version, 'description': description})
+        return self.schema_version()
+
+    def schema_version(self):
+        """Return the last migration applied to this database"""
+        with self.reading() as conn:
+            return conn.execute(select(func.max(schema_version_table.c.version))).scalar() or 0
+
+    def add_user(self, username, email):
+        self.add_users([(username, email)])
+
+    def add_memory(self, user_id, memory_text):
+        self.add_memories([(user_id, memory_text)])
+
+    def add_task(self, user_id, task_name):
+        self.add_tasks([(user_id, task_name)])
+
+    def add_communication_log(self, user_id, log):
+        self.add_communication_logs([(user_id, log)])
+
+    @instrumented('add_users')
+    def add_users(self, users):
+        """Insert (username, email) rows in one transaction; returns the row count"""
+        rows = [{'username': username, 'email': email} for username, email in users]
+        return self._insert_many(user_profiles_table, rows)
+
+    @instrumented('add_memories')
+    def add_memories(self, memories, rebuild_indexes=False):
+        """Insert (user_id, memory_text[, created_at]) rows in one transaction; returns the row count"""
+        return self._insert_many(memory_table, _bulk_rows('memory', memories))
+
+    @instrumented('add_tasks')
+    def add_tasks(self, tasks):
+        """Insert (user_id, task_name[, created_at]) rows in one transaction; returns the row count"""
+        return self._insert_many(tasks_table, _bulk_rows('tasks', tasks))
+
+    @instrumented('add_communication_logs')
+    def add_communication_logs(self, logs):
+        """Insert (user_id, log[, created_at]) rows in one transaction; returns the row count"""
+        return self._insert_many(communication_logs_table, _bulk_rows('communication_logs', logs))
+
+    @instrumented('apply_task_changes')
+    def apply_task_changes(self, changed, deleted_ids):
+        """Upsert tasks and delete task ids in a single transaction"""
+        rows = [_task_row(task) for task in changed]
+        with self.transaction() as conn:
+            ids = [row['id'] for row in rows] + list(deleted_ids)
+            if ids:
+                conn.execute(tasks_table.delete().where(tasks_table.c.id.in_(ids)))
+            if rows:
+                conn.execute(insert(tasks_table), rows)
+
+    @instrumented('load_tasks')
+    def load_tasks(self, user_id=None):
+        """Load every task, or one user's tasks, with one SELECT, shaped like TaskManager tasks"""
+        query = select(tasks_table).order_by(tasks_table.c.id)
+        if user_id is not None:
+            query = query.where(tasks_table.c.user_id == user_id)
+        with self.reading() as conn:
+            rows = conn.execute(query).mappings().all()
+        return [_task_from_row(row) for row in rows]
+
+    @instrumented('max_task_id')
+    def max_task_id(self):
+        """Highest task id stored so far, or 0"""
+        with self.reading() as conn:
+            return conn.execute(select(func.coalesce(func.max(tasks_table.c.id), 0))).scalar()
+
+    @instrumented('get_memories')
+    def get_memories(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's memories ordered by creation time"""
+        return self._page(memory_table, user_id, since, until, after, limit, fields)
+
+    @instrumented('get_tasks')
+    def get_tasks(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's persisted tasks ordered by creation time"""
+        return self._page(tasks_table, user_id, since, until, after, limit, fields)
+
+    @instrumented('get_communication_logs')
+    def get_communication_logs(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        """Return one page of a user's communication logs ordered by creation time"""
+        return self._page(communication_logs_table, user_id, since, until, after, limit, fields)
+
+    def close(self):
+        self.engine.dispose()
+
+    def _insert_many(self, table, rows):
+        rows = list(rows)
+        if rows:
+            with self.transaction() as conn:
+                conn.execute(insert(table), rows)
+        return len(rows)
+
+    def _page(self, table, user_id, since, until, after, limit, fields=None):
+        columns = [table.c[column] for column in page_columns(table.name, fields)]
+        query = select(*columns).where(table.c.user_id == user_id)
+        if since is not None:
+            query = query.where(table.c.created_at >= since)
+        if until is not None:
+            query = query.where(table.c.created_at < until)
+        if after is not None:
+            query = query.where(tuple_(table.c.created_at, table.c.id) > tuple_(*after))
+        query = query.order_by(table.c.created_at, table.c.id).limit(limit)
+        with self.reading() as conn:
+            return [dict(row) for row in conn.execute(query).mappings()]
+
+
+class MemoryBackend:
+    """In-process stand-in for a database, for tests and throwaway sessions.
+
+    Tables are plain lists of row dicts. transaction() holds a lock while
+    every write logs how to put its table back; if the block raises, the
+    entries it logged are undone newest first. Nested transactions undo
+    only their own entries, like savepoints.
+    """
+
+    def __init__(self):
+        self.tables = {name: [] for name in TABLES}
+        self.next_ids = {name: 1 for name in TABLES}
+        self.lock = threading.RLock()
+        self.undo = None
+        self.version = 0
+        self.migrate()
+
+    @contextmanager
+    def transaction(self):
+        """Run the block under the lock, undoing its writes if it raises"""
+        with self.lock:
+            outermost = self.undo is None
+            if outermost:
+                self.undo = []
+            mark = len(self.undo)
+            try:
+                yield self
+            except BaseException:
+                while len(self.undo) > mark:
+                    self._restore(*self.undo.pop())
+                raise
+            finally:
+                if outermost:
+                    self.undo = None
+
+    def migrate(self):
+        self.version = MIGRATIONS[-1][0]
+        return self.version
+
+    def schema_version(self):
+        return self.version
+
+    def add_user(self, username, email):
+        self.add_users([(username, email)])
+
+    def add_memory(self, user_id, memory_text):
+        self.add_memories([(user_id, memory_text)])
+
+    def add_task(self, user_id, task_name):
+        self.add_tasks([(user_id, task_name)])
+
+    def add_communication_log(self, user_id, log):
+        self.add_communication_logs([(user_id, log)])
+
+    def add_users(self, users):
+        return self._insert_many('user_profiles', ({'username': username, 'email': email} for username, email in users))
+
+    def add_memories(self, memories, rebuild_indexes=False):
+        return self._insert_many('memory', _bulk_rows('memory', memories))
+
+    def add_tasks(self, tasks):
+        return self._insert_many('tasks', _bulk_rows('tasks', tasks))
+
+    def add_communication_logs(self, logs):
+        return self._insert_many('communication_logs', _bulk_rows('communication_logs', logs))
+
+    def apply_task_changes(self, changed, deleted_ids):
+        rows = {task['id']: _task_row(task) for task in changed}
+        with self.transaction():
+            self._log_undo('tasks')
+            dropped = set(rows) | set(deleted_ids)
+            self.tables['tasks'] = [row for row in self.tables['tasks'] if row['id'] not in dropped]
+            self.tables['tasks'].extend(rows.values())
+            self.tables['tasks'].sort(key=lambda row: row['id'])
+            if rows:
+                self.next_ids['tasks'] = max(self.next_ids['tasks'], max(rows) + 1)
+
+    def load_tasks(self, user_id=None):
+        with self.lock:
+            return [_task_from_row(row) for row in self.tables['tasks'] if user_id is None or row['user_id'] == user_id]
+
+    def max_task_id(self):
+        with self.lock:
+            return max((row['id'] for row in self.tables['tasks']), default=0)
+
+    def get_memories(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        return self._page('memory', user_id, since, until, after, limit, fields)
+
+    def get_tasks(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        return self._page('tasks', user_id, since, until, after, limit, fields)
+
+    def get_communication_logs(self, user_id, since=None, until=None, after=None, limit=100, fields=None):
+        return self._page('communication_logs', user_id, since, until, after, limit, fields)
+
+    def close(self):
+        pass
+
+    def _insert_many(self, name, rows):
+        count = 0
+        with self.transaction():
+            self._log_undo(name)
+            for row in rows:
+                row.setdefault('created_at', _utc_now())
+                row['id'] = self.next_ids[name]
+                self.next_ids[name] += 1
+                self.tables[name].append(row)
+                count += 1
+        return count
+
+    def _log_undo(self, name):
+        """Log how to undo a write to a table, which may append rows or replace the list but never edit a row"""
+        rows = self.tables[name]
+        self.undo.append((name, rows, len(rows), self.next_ids[name]))
+
+    def _restore(self, name, rows, length, next_id):
+        del rows[length:]
+        self.tables[name] = rows
+        self.next_ids[name] = next_id
+
+    def _page(self, name, user_id, since, until, after, limit, fields=None):
+        columns = page_columns(name, fields) if fields is not None else None
+        with self.lock:
+            rows = [row for row in self.tables[name] if row['user_id'] == user_id
+                    and (since is None or row['created_at'] >= since)
+                    and (until is None or row['created_at'] < until)
+                    and (after is None or (row['created_at'], row['id']) > tuple(after))]
+        rows.sort(key=lambda row: (row['created_at'], row['id']))
+        if columns is None:
+            return [dict(row) for row in rows[:limit]]
+        return [{column: row.get(column) for column in columns} for row in rows[:limit]]
+
+
+def _create_engine(url, pool_size, max_overflow):
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+    if url.database in (None, '', ':memory:'):
+        engine = create_engine(url, poolclass=StaticPool, connect_args={'check_same_thread': False})
+    else:
+        engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow)
+
+    @event.listens_for(engine, 'connect')
+    def _configure_sqlite(dbapi_connection, connection_record):
+        # Let SQLAlchemy issue BEGIN itself so savepoints work under pysqlite
+        dbapi_connection.isolation_level = None
+        for name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout'):
+            dbapi_connection.execute(f'PRAGMA {name} = {getattr(config, "SQLITE_" + name.upper())}')
+
+    @event.listens_for(engine, 'begin')
+    def _begin_sqlite(conn):
+        conn.exec_driver_sql('BEGIN')
+
+    return engine
+
+
+def _bulk_rows(name, rows):
+    column = BULK_COLUMNS[name]
+    for row in rows:
+        created_at = row[2] if len(row) > 2 and row[2] is not None else _utc_now()
+        yield {'user_id': row[0], column: row[1], 'created_at': created_at}
+
+
+def _utc_now():
+    # Same resolution and zone as SQL CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+def _task_row(task):
+    return {
+        'id': task['id'],
+        'task_name': task['name'],
+        'user_id': task['user_id'],
+        'created_at': task['created_at'],
+        'due_date': task['due_date'],
+        'completed': int(task['completed']),
+        'reminder': task.get('reminder')
+    }
+
+
+def _task_from_row(row):
+    task = {
+        'id': row['id'],
+        'name': row['task_name'],
+        'user_id': row['user_id'],
+        'created_at': row['created_at'],
+        'due_date': row['due_date'],
+        'completed': bool(row['completed'])
+    }
+    if row['reminder'] is not None:
+        task['reminder'] = row['reminder']
+    return task
@@ -0,0 +1,97 @@
+"""Stress test for the API under concurrent requests.
+
+Starts many threads that hammer the task, memory, message and batch
+endpoints for a handful of users through the Flask test client, then checks
+that no update was lost: task ids are unique, and every user ends up with
+exactly the tasks, memories and messages the threads created for them.
+
+    python stress_test.py [--threads 16] [--users 4] [--iterations 200]
+"""
+import argparse
+import sys
+import threading
+import time
+from collections import Counter
+
+import config
+config.DATABASE_NAME = ':memory:'
+config.RATE_LIMIT_ENABLED = False
+config.AUTH_SECRET = 'stress-test'
+from api_interface import app, pool
+from assistant_pool import issue_token
+
+
+def worker(number, users, iterations, created, failures):
+    client = app.test_client()
+    user_id = users[number % len(users)]
+    headers = {config.AUTH_HEADER: f'Bearer {issue_token(user_id)}'}
+    counts = Counter()
+    for i in range(iterations):
+        responses = [
+            client.post('/api/task/add', json={'task_name': f'task {number}-{i}'}, headers=headers),
+            client.post('/api/memory/store', json={'category': 'learned', 'key': f'fact {number}-{i}', 'value': i},
+                        headers=headers),
+            client.post('/api/message/send', json={'recipient': 'Pepper', 'message': f'note {number}-{i}'},
+                        headers=headers),
+            client.post('/api/batch', json={'atomic': True, 'commands': [
+                {'command': 'add_task', 'args': [f'batch task {number}-{i}']},
+                {'command': 'send_message', 'args': ['Happy', f'batch note {number}-{i}']}
+            ]}, headers=headers),
+            client.get('/api/task/list', headers=headers),
+            client.get('/api/status', headers=headers)
+        ]
+        for response in responses:
+            if response.status_code >= 400:
+                failures.append(f'{response.request.path}: {response.status_code} {response.get_json()}')
+        counts['tasks'] += 2
+        counts['memories'] += 1
+        counts['messages'] += 2
+    created[number] = (user_id, counts)
+
+
+def run(threads, users, iterations):
+    user_ids = [f'stress_user_{n}' for n in range(users)]
+    created = [None] * threads
+    failures = []
+    workers = [threading.Thread(target=worker, args=(n, user_ids, iterations, created, failures))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    expected = {user_id: Counter() for user_id in user_ids}
+    for user_id, counts in created:
+        expected[user_id].update(counts)
+    services = pool.services
+    task_ids = [task['id'] for task in services.task_manager.tasks]
+    if len(task_ids) != len(set(task_ids)):
+        failures.append(f'{len(task_ids) - len(set(task_ids))} duplicate task ids')
+    for user_id, counts in expected.items():
+        actual = Counter(tasks=services.task_manager.count(user_id),
+                         memories=services.memory_manager.count(user_id),
+                         messages=services.communication_manager.count_messages(user_id))
+        if actual != counts:
+            failures.append(f'{user_id}: expected {dict(counts)}, got {dict(actual)}')
+    services.task_manager.flush()
+    stored = len(services.database.load_tasks())
+    if stored != len(task_ids):
+        failures.append(f'{len(task_ids)} tasks in memory but {stored} in the database')
+
+    requests = threads * iterations * 6
+    print(f'{threads} threads, {users} users, {requests} requests in {elapsed:.2f} s '
+          f'({requests / elapsed:.0f} req/s)')
+    for failure in failures[:20]:
+        print(f'  FAIL {failure}')
+    return not failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=200)
+    options = parser.parse_args()
+    sys.exit(0 if run(options.threads, options.users, options.iterations) else 1)
@@ -1,59 +1,417 @@
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
+import config
+from commands import Arg, CommandError, undo_log
+from concurrency import IdAllocator, StripedLock
+import metrics
+from pagination import PAGE_ARGS, page_of, parse_page_query
+from write_behind import WriteBehindQueue
+
+TASK_OPERATIONS = metrics.counter('stark_task_operations_total', 'Task changes by operation', ('operation',))
+
+TASK_FIELDS = ('id', 'name', 'user_id', 'created_at', 'due_date', 'completed', 'reminder')
+
+def parse_due_date(due_date):
+    """Normalize a due date or reminder time to a naive local datetime; ISO strings are accepted"""
+    if isinstance(due_date, str):
+        try:
+            due_date = datetime.fromisoformat(due_date) if due_date else None
+        except ValueError:
+            raise CommandError(f"'{due_date}' is not an ISO 8601 date, Sir.")
+    if due_date is not None and not isinstance(due_date, datetime):
+        raise CommandError(f"'{due_date}' is not an ISO 8601 date, Sir.")
+    if due_date is not None and due_date.tzinfo is not None:
+        due_date = due_date.astimezone().replace(tzinfo=None)
+    return due_date
+
+
+class TaskStore:
+    """Indexed in-memory task storage.
+
+    Tasks live in an id -> task map, with per-user buckets of pending and
+    completed tasks so lookups, completion and deletion are O(1) and per-user
+    queries only touch that user's tasks. Each user's pending tasks with a
+    due date are also kept in a list of (due_date, id) pairs sorted for
+    bisection, so due-date range queries cost O(log n + k), and the ids of
+    their pending tasks in a sorted list, so a page of them after a given id
+    is found by bisection too. Iterating the store yields tasks.
+    """
 
-class TaskManager:
     def __init__(self):
-        self.tasks = []
+        self.by_id = {}
+        self.pending = {}
+        self.pending_ids = {}
+        self.completed = {}
+        self.due = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def __contains__(self, task_id):
+        return task_id in self.by_id
+
+    def get(self, task_id):
+        """Return the task with the given id, or None"""
+        return self.by_id.get(task_id)
+
+    def add(self, task):
+        """Insert a task and index it under its user"""
+        self.by_id[task['id']] = task
+        if task['completed']:
+            self._link(self.completed, task)
+            return
+        self._link(self.pending, task)
+        insort(self.pending_ids.setdefault(task['user_id'], []), task['id'])
+        if task['due_date'] is not None:
+            insort(self.due.setdefault(task['user_id'], []), (task['due_date'], task['id']))
+
+    def mark_completed(self, task):
+        """Move a task from its user's pending bucket to the completed one"""
+        if not task['completed']:
+            self._unlink(self.pending, task)
+            self._unindex_pending(task)
+            task['completed'] = True
+            self._link(self.completed, task)
+
+    def remove(self, task_id):
+        """Remove a task by id and return it, or None if it does not exist"""
+        task = self.by_id.pop(task_id, None)
+        if task is not None:
+            if task['completed']:
+                self._unlink(self.completed, task)
+            else:
+                self._unlink(self.pending, task)
+                self._unindex_pending(task)
+        return task
+
+    def pending_for(self, user_id):
+        """Return the user's pending tasks in id order"""
+        return [self.by_id[task_id] for task_id in self.pending_ids.get(user_id, ())]
+
+    def pending_count(self, user_id):
+        return len(self.pending.get(user_id, ()))
+
+    def pending_page(self, user_id, after=None, since=None, limit=100):
+        """Return up to `limit` of the user's pending tasks with id above `after`, created at or after `since`"""
+        ids = self.pending_ids.get(user_id, ())
+        page = []
+        for position in range(0 if after is None else bisect_right(ids, after), len(ids)):
+            task = self.by_id[ids[position]]
+            if since is not None and task['created_at'] < since:
+                continue
+            page.append(task)
+            if len(page) == limit:
+                break
+        return page
+
+    def completed_for(self, user_id):
+        """Return the user's completed tasks in insertion order"""
+        return list(self.completed.get(user_id, {}).values())
+
+    def due_between(self, user_id, start=None, end=None, include_end=False):
+        """Return the user's pending tasks due in [start, end), ordered by due date"""
+        index = self.due.get(user_id)
+        if not index:
+            return []
+        lo = 0 if start is None else bisect_left(index, (start,))
+        if end is None:
+            hi = len(index)
+        elif include_end:
+            hi = bisect_right(index, (end, float('inf')))
+        else:
+            hi = bisect_left(index, (end,))
+        return [self.by_id[task_id] for _, task_id in index[lo:hi]]
+
+    def _unindex_pending(self, task):
+        ids = self.pending_ids.get(task['user_id'])
+        if ids:
+            position = bisect_left(ids, task['id'])
+            if position < len(ids) and ids[position] == task['id']:
+                del ids[position]
+                if not ids:
+                    del self.pending_ids[task['user_id']]
+        self._unindex_due(task)
+
+    def _unindex_due(self, task):
+        index = self.due.get(task['user_id'])
+        if not index or task['due_date'] is None:
+            return
+        position = bisect_left(index, (task['due_date'], task['id']))
+        if position < len(index) and index[position][1] == task['id']:
+            del index[position]
+            if not index:
+                del self.due[task['user_id']]
+
+    def _link(self, bucket, task):
+        bucket.setdefault(task['user_id'], {})[task['id']] = task
+
+    def _unlink(self, bucket, task):
+        user_tasks = bucket.get(task['user_id'])
+        if user_tasks is not None:
+            user_tasks.pop(task['id'], None)
+            if not user_tasks:
+                del bucket[task['user_id']]
+
+
+class TaskManager:
+    """Tasks of any number of users, persisted through a write-behind queue.
+
+    With `preload` every stored task is read at start-up. Without it only the
+    id counter is, and each user's tasks are read by load_user() when that
+    user becomes active and dropped again by unload_user(), so memory follows
+    active users rather than everyone in the database. Reminders of unloaded
+    users stay scheduled and still fire.
+
+    Ids come from an IdAllocator, so they are unique and never reused. Each
+    user's tasks and reminders are guarded by that user's stripe of a
+    StripedLock, so requests for different users do not wait on each other.
+    """
+
+    def __init__(self, scheduler=None, notify=None, db=None, preload=True):
+        self.tasks = TaskStore()
+        self.ids = IdAllocator()
+        self.locks = StripedLock()
+        self.scheduler = scheduler
+        self.notify = notify
+        self.reminder_jobs = {}
+        self.db = db
+        self.loaded_users = set()
+        self.writer = None
+        if db is not None:
+            if preload:
+                self.load(db.load_tasks())
+            else:
+                self.ids.advance(db.max_task_id())
+            self.writer = WriteBehindQueue(db.apply_task_changes)
+
+    def load(self, tasks):
+        """Warm the store with previously persisted tasks and re-arm their reminders"""
+        now = datetime.now()
+        loaded = 0
+        for task in tasks:
+            with self.locks(task['user_id']):
+                if task['id'] in self.tasks:
+                    continue
+                self.tasks.add(task)
+                self.ids.advance(task['id'])
+                self._arm_reminder(task, now)
+                loaded += 1
+        TASK_OPERATIONS.inc('load', amount=loaded)
+
+    def load_user(self, user_id):
+        """Read a user's tasks from the database unless they are already in memory"""
+        with self.locks(user_id):
+            if user_id in self.loaded_users:
+                return
+            self.loaded_users.add(user_id)
+            if self.db is not None:
+                self.load(self.db.load_tasks(user_id))
+
+    def unload_user(self, user_id):
+        """Write out pending changes and drop a user's tasks from memory"""
+        self.flush()
+        with self.locks(user_id):
+            self.loaded_users.discard(user_id)
+            for task in self.tasks.pending_for(user_id) + self.tasks.completed_for(user_id):
+                self.tasks.remove(task['id'])
 
     def add_task(self, task_name, user_id, due_date=None):
         """Add a new task for the user"""
         task = {
-            'id': len(self.tasks) + 1,
+            'id': next(self.ids),
             'name': task_name,
             'user_id': user_id,
             'created_at': datetime.now(),
-            'due_date': due_date,
+            'due_date': parse_due_date(due_date),
             'completed': False
         }
-        self.tasks.append(task)
+        with self.locks(user_id):
+            self.tasks.add(task)
+            self._persist(task)
+            undo_log.record(self._restore, task['id'], None, user_id)
+            if task['due_date'] is not None and task['due_date'] > datetime.now():
+                self._schedule_reminder(task, task['due_date'] - timedelta(seconds=config.TASK_REMINDER_LEAD_TIME))
+        TASK_OPERATIONS.inc('add')
         return f"Task '{task_name}' added successfully, Sir."
 
     def list_tasks(self, user_id):
         """List all tasks for a user"""
-        user_tasks = [task for task in self.tasks if task['user_id'] == user_id and not task['completed']]
+        with self.locks(user_id):
+            user_tasks = self.tasks.pending_for(user_id)
         if user_tasks:
             return user_tasks
         else:
             return "You have no pending tasks, Sir."
 
-    def complete_task(self, task_id):
+    def count(self, user_id):
+        """Number of pending tasks a user has"""
+        return self.tasks.pending_count(user_id)
+
+    def page_tasks(self, user_id, limit=config.DEFAULT_PAGE_SIZE, after=None, since=None, fields=None):
+        """One page of a user's pending tasks in id order; pass the page's next_cursor position as `after`"""
+        with self.locks(user_id):
+            tasks = self.tasks.pending_page(user_id, after, since, limit + 1)
+        return page_of(tasks, limit, lambda task: task['id'], fields)
+
+    def complete_task(self, task_id, user_id=None):
         """Mark a task as completed"""
-        for task in self.tasks:
-            if task['id'] == task_id:
-                task['completed'] = True
-                return f"Task '{task['name']}' marked as completed, Sir."
-        return "Task not found, Sir."
+        with self._owned_task(task_id, user_id) as task:
+            if task is None:
+                return "Task not found, Sir."
+            undo_log.record(self._restore, task_id, dict(task), task['user_id'])
+            self.tasks.mark_completed(task)
+            self._persist(task)
+            self._cancel_reminder(task_id)
+        TASK_OPERATIONS.inc('complete')
+        return f"Task '{task['name']}' marked as completed, Sir."
 
-    def delete_task(self, task_id):
+    def delete_task(self, task_id, user_id=None):
         """Delete a task"""
-        self.tasks = [task for task in self.tasks if task['id'] != task_id]
+        with self._owned_task(task_id, user_id) as task:
+            if task is not None:
+                self.tasks.remove(task_id)
+                undo_log.record(self._restore, task_id, task, task['user_id'])
+                if self.writer is not None:
+                    self.writer.delete(task_id)
+                self._cancel_reminder(task_id)
+                TASK_OPERATIONS.inc('delete')
         return "Task deleted, Sir."
 
-    def set_reminder(self, task_id, reminder_time):
+    def set_reminder(self, task_id, reminder_time, user_id=None):
         """Set a reminder for a task"""
-        for task in self.tasks:
-            if task['id'] == task_id:
-                task['reminder'] = reminder_time
-                return f"Reminder set for '{task['name']}' at {reminder_time}, Sir."
-        return "Task not found, Sir."
+        when = parse_due_date(reminder_time)
+        if when is None:
+            raise CommandError("A reminder needs a time, Sir.")
+        with self._owned_task(task_id, user_id) as task:
+            if task is None:
+                return "Task not found, Sir."
+            undo_log.record(self._restore, task_id, dict(task), task['user_id'])
+            task['reminder'] = when
+            self._persist(task)
+            self._schedule_reminder(task, task['reminder'])
+        TASK_OPERATIONS.inc('set_reminder')
+        return f"Reminder set for '{task['name']}' at {reminder_time}, Sir."
 
     def get_overdue_tasks(self, user_id):
         """Get all overdue tasks for a user"""
-        user_tasks = [task for task in self.tasks if task['user_id'] == user_id and not task['completed']]
-        overdue_tasks = [task for task in user_tasks if task['due_date'] and task['due_date'] < datetime.now()]
+        with self.locks(user_id):
+            overdue_tasks = self.tasks.due_between(user_id, end=datetime.now())
         return overdue_tasks if overdue_tasks else "No overdue tasks, Sir."
 
     def get_upcoming_tasks(self, user_id, days=7):
         """Get upcoming tasks for a user within the specified number of days"""
-        user_tasks = [task for task in self.tasks if task['user_id'] == user_id and not task['completed']]
-        upcoming_tasks = [task for task in user_tasks if task['due_date'] and datetime.now() <= task['due_date'] <= datetime.now() + timedelta(days=days)]
-        return upcoming_tasks if upcoming_tasks else "No upcoming tasks, Sir."
\ No newline at end of file
+        now = datetime.now()
+        with self.locks(user_id):
+            upcoming_tasks = self.tasks.due_between(user_id, now, now + timedelta(days=days), include_end=True)
+        return upcoming_tasks if upcoming_tasks else "No upcoming tasks, Sir."
+
+    def register_commands(self, registry):
+        """Register the task commands with a CommandRegistry"""
+        registry.register('add_task', lambda user_id, name, due_date: self.add_task(name, user_id, due_date),
+                          [Arg('task_name'), Arg('due_date', type=None, required=False)], 'Add a new task')
+        registry.register('list_tasks', self.list_tasks, description='List pending tasks', cacheable=True)
+        registry.register('page_tasks',
+                          lambda user_id, *query: self.page_tasks(user_id, *parse_page_query(*query, TASK_FIELDS)),
+                          PAGE_ARGS, 'Page through pending tasks', cacheable=True)
+        registry.register('complete_task', lambda user_id, task_id: self.complete_task(task_id, user_id),
+                          [Arg('task_id', type=int)], 'Mark a task as completed')
+        registry.register('delete_task', lambda user_id, task_id: self.delete_task(task_id, user_id),
+                          [Arg('task_id', type=int)], 'Delete a task')
+        registry.register('set_reminder', lambda user_id, task_id, when: self.set_reminder(task_id, when, user_id),
+                          [Arg('task_id', type=int), Arg('reminder_time', type=None)], 'Set a reminder for a task')
+        registry.register('get_overdue_tasks', self.get_overdue_tasks, description='List overdue tasks', read_only=True)
+        registry.register('get_upcoming_tasks', self.get_upcoming_tasks,
+                          [Arg('days', type=int, required=False, default=7)], 'List tasks due in the next days',
+                          read_only=True)
+
+    def register_metrics(self, registry):
+        """Report the size of the task store and the write-behind queue at scrape time"""
+        registry.callback('stark_tasks', 'Tasks held in memory by state', lambda: {
+            ('pending',): sum(map(len, list(self.tasks.pending.values()))),
+            ('completed',): sum(map(len, list(self.tasks.completed.values())))
+        }, ('state',))
+        registry.callback('stark_task_users_loaded', 'Users whose tasks are in memory', lambda: len(self.loaded_users))
+        if self.writer is not None:
+            registry.callback('stark_task_writes_queued', 'Task changes waiting for the next flush',
+                              lambda: len(self.writer))
+
+    def staging_writes(self):
+        """Context manager that queues the task changes made in it together when it exits"""
+        return self.writer.staging() if self.writer is not None else nullcontext()
+
+    def flush(self):
+        """Write pending task changes to the database now"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Flush pending task changes and stop the write-behind thread"""
+        if self.writer is not None:
+            self.writer.close()
+
+    def _persist(self, task):
+        if self.writer is not None:
+            self.writer.save(task)
+
+    @contextmanager
+    def _owned_task(self, task_id, user_id):
+        """Hold the owner's lock and yield the task, or None if it does not exist or belongs to someone else"""
+        if user_id is None:
+            task = self.tasks.get(task_id)
+            user_id = task['user_id'] if task is not None else None
+        with self.locks(user_id):
+            task = self.tasks.get(task_id)
+            yield task if task is not None and task['user_id'] == user_id else None
+
+    def _restore(self, task_id, snapshot, user_id):
+        """Put a task back to an earlier copy of itself, or drop it if it did not exist"""
+        with self.locks(user_id):
+            self._cancel_reminder(task_id)
+            self.tasks.remove(task_id)
+            if snapshot is None:
+                if self.writer is not None:
+                    self.writer.delete(task_id)
+                return
+            self.tasks.add(snapshot)
+            self._persist(snapshot)
+            self._arm_reminder(snapshot, datetime.now())
+
+    def _arm_reminder(self, task, now):
+        if task['completed']:
+            return
+        if task.get('reminder') is not None and task['reminder'] > now:
+            self._schedule_reminder(task, task['reminder'])
+        elif task['due_date'] is not None and task['due_date'] > now:
+            self._schedule_reminder(task, task['due_date'] - timedelta(seconds=config.TASK_REMINDER_LEAD_TIME))
+
+    def _schedule_reminder(self, task, when):
+        """Queue a reminder for the task on the scheduler, replacing any earlier one"""
+        if self.scheduler is None or self.notify is None:
+            return
+        self._cancel_reminder(task['id'])
+        self.reminder_jobs[task['id']] = self.scheduler.schedule(when, self._fire_reminder, task['id'], task)
+
+    def _cancel_reminder(self, task_id):
+        job = self.reminder_jobs.pop(task_id, None)
+        if job is not None:
+            self.scheduler.cancel(job)
+
+    def _fire_reminder(self, task_id, task):
+        with self.locks(task['user_id']):
+            job = self.reminder_jobs.get(task_id)
+            if job is not None and not job.queued:
+                del self.reminder_jobs[task_id]
+            if task['user_id'] in self.loaded_users or task_id in self.tasks:
+                task = self.tasks.get(task_id)
+            if task is None or task['completed']:
+                return
+            if task['due_date'] is not None:
+                message = f"Reminder: '{task['name']}' is due at {task['due_date']}, Sir."
+            else:
+                message = f"Reminder: '{task['name']}', Sir."
+        TASK_OPERATIONS.inc('remind')
+        self.notify(message, task['user_id'], 'reminder')
@@ -1,4 +1,42 @@
+import asyncio
+import gzip
+import importlib
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+
+from assistant_pool import AssistantPool, UserIdError, check_auth_config, issue_token, resolve_user_id
+import config
+from cache import ResponseCache
+from commands import Arg, Command, CommandError, CommandRegistry
+from communication import CommunicationManager
+from database import Database
+from memory import MemoryManager
+from memory_module import MemoryModule
+from metrics import MetricsRegistry
+from profiler import ProfilerError, SamplingProfiler, check_admin, check_admin_config
+from pubsub import EventBroker
+from rate_limit import AdmissionController, RateLimiter
+from semantic_index import SemanticIndex
+import serialization
+import tracing
+from main_controller import AssistantServices
+import logging_setup
+from health_monitor import HealthMonitor, next_daily_occurrence
+from scheduler import ReminderScheduler, ScheduledJob, default_scheduler
+from storage import MemoryBackend, SQLAlchemyBackend
+from task_manager import TaskManager, TaskStore
+from write_behind import WriteBehindQueue
 
 class TestTaskManager(unittest.TestCase):
     def test_task_creation(self):
@@ -9,6 +47,564 @@ class TestTaskManager(unittest.TestCase):
         # Add test for handling task failures
         pass
 
+    def test_task_index_by_id_and_user(self):
+        manager = TaskManager()
+        manager.add_task('Write report', 'alice')
+        manager.add_task('Buy milk', 'bob')
+        manager.add_task('Call mom', 'alice')
+        self.assertEqual([t['name'] for t in manager.list_tasks('alice')], ['Write report', 'Call mom'])
+        manager.complete_task(1)
+        self.assertEqual([t['name'] for t in manager.list_tasks('alice')], ['Call mom'])
+        self.assertEqual([t['id'] for t in manager.tasks.completed_for('alice')], [1])
+        self.assertEqual(manager.complete_task(99), "Task not found, Sir.")
+
+    def test_delete_task_does_not_reuse_ids(self):
+        manager = TaskManager()
+        manager.add_task('First', 'alice')
+        manager.add_task('Second', 'alice')
+        manager.delete_task(1)
+        manager.add_task('Third', 'alice')
+        self.assertIsNone(manager.tasks.get(1))
+        self.assertEqual([t['id'] for t in manager.list_tasks('alice')], [2, 3])
+        self.assertEqual(len(manager.tasks), 2)
+
+    def test_page_tasks_follows_cursor_and_projects_fields(self):
+        manager = TaskManager()
+        for i in range(5):
+            manager.add_task(f'Task {i}', 'alice')
+        manager.complete_task(2)
+        registry = CommandRegistry()
+        manager.register_commands(registry)
+        first = registry.dispatch('page_tasks', 'alice', (2, None, None, 'id,name'))
+        self.assertEqual(first['items'], [{'id': 1, 'name': 'Task 0'}, {'id': 3, 'name': 'Task 2'}])
+        rest = registry.dispatch('page_tasks', 'alice', (2, first['next_cursor']))
+        self.assertEqual([t['id'] for t in rest['items']], [4, 5])
+        self.assertIsNone(rest['next_cursor'])
+        for query in ((0,), (None, 'garbage'), (None, None, 'yesterday'), (None, None, None, 'secret')):
+            with self.assertRaises(CommandError):
+                registry.dispatch('page_tasks', 'alice', query)
+
+    def test_pending_pages_seek_by_id_when_tasks_arrive_out_of_order(self):
+        store = TaskStore()
+        for task_id in (5, 2, 9, 7, 1):
+            store.add({'id': task_id, 'name': f'Task {task_id}', 'user_id': 'alice', 'created_at': datetime.now(),
+                       'due_date': None, 'completed': False})
+        store.mark_completed(store.get(2))
+        store.remove(9)
+        self.assertEqual([t['id'] for t in store.pending_for('alice')], [1, 5, 7])
+        self.assertEqual([t['id'] for t in store.pending_page('alice', after=1, limit=1)], [5])
+        self.assertEqual([t['id'] for t in store.pending_page('alice', after=5)], [7])
+        self.assertEqual(store.pending_page('alice', after=7), [])
+        self.assertEqual(list(store.completed['alice']), [2])
+
+    def test_overdue_and_upcoming_use_due_date_index(self):
+        manager = TaskManager()
+        now = datetime.now()
+        manager.add_task('Late', 'alice', now - timedelta(days=1))
+        manager.add_task('Later', 'alice', (now - timedelta(hours=1)).isoformat())
+        manager.add_task('Soon', 'alice', now + timedelta(days=2))
+        manager.add_task('Far', 'alice', now + timedelta(days=30))
+        manager.add_task('Undated', 'alice')
+        self.assertEqual([t['name'] for t in manager.get_overdue_tasks('alice')], ['Late', 'Later'])
+        self.assertEqual([t['name'] for t in manager.get_upcoming_tasks('alice')], ['Soon'])
+        manager.complete_task(1)
+        manager.delete_task(3)
+        self.assertEqual([t['name'] for t in manager.get_overdue_tasks('alice')], ['Later'])
+        self.assertEqual(manager.get_upcoming_tasks('alice'), "No upcoming tasks, Sir.")
+
+    def test_concurrent_adds_get_unique_ids(self):
+        manager = TaskManager()
+        memory = MemoryManager()
+
+        def add(number):
+            for i in range(200):
+                manager.add_task(f'Task {i}', f'user_{number % 3}')
+                memory.store_memory(f'user_{number % 3}', 'learned', f'fact {number} {i}', i)
+
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(task['id'] for task in manager.tasks), list(range(1, 1601)))
+        self.assertEqual(sum(memory.count(f'user_{n}') for n in range(3)), 1600)
+
+class TestTaskPersistence(unittest.TestCase):
+    def test_write_behind_coalesces_changes_per_key(self):
+        batches = []
+        queue = WriteBehindQueue(lambda records, deleted: batches.append((records, deleted)), flush_interval=60)
+        queue.save({'id': 1, 'name': 'draft'})
+        queue.save({'id': 1, 'name': 'final'})
+        queue.save({'id': 2, 'name': 'gone'})
+        queue.delete(2)
+        queue.close()
+        self.assertEqual(batches, [([{'id': 1, 'name': 'final'}], [2])])
+
+    def test_staged_changes_are_queued_together_without_holding_up_flushes(self):
+        batches = []
+        queue = WriteBehindQueue(lambda records, deleted: batches.append((records, deleted)), flush_interval=60)
+        with queue.staging():
+            queue.save({'id': 1, 'name': 'batch'})
+            with queue.staging():
+                queue.delete(2)
+            other = threading.Thread(target=queue.save, args=({'id': 3, 'name': 'elsewhere'},))
+            other.start()
+            other.join()
+            queue.flush()
+            self.assertEqual(batches, [([{'id': 3, 'name': 'elsewhere'}], [])])
+        queue.close()
+        self.assertEqual(batches[1], ([{'id': 1, 'name': 'batch'}], [2]))
+
+    def test_tasks_survive_restart(self):
+        db = Database(':memory:')
+        manager = TaskManager(db=db)
+        due_date = datetime.now() - timedelta(days=1)
+        manager.add_task('Renew passport', 'alice', due_date)
+        manager.add_task('Old chore', 'alice')
+        manager.add_task('Water plants', 'bob')
+        manager.complete_task(3)
+        manager.delete_task(2)
+        manager.close()
+
+        restored = TaskManager(db=db)
+        self.assertEqual([t['name'] for t in restored.list_tasks('alice')], ['Renew passport'])
+        self.assertEqual(restored.tasks.get(1)['due_date'], due_date)
+        self.assertEqual([t['id'] for t in restored.get_overdue_tasks('alice')], [1])
+        self.assertTrue(restored.tasks.get(3)['completed'])
+        restored.add_task('Next', 'alice')
+        self.assertEqual(restored.tasks.get(4)['name'], 'Next')
+        restored.close()
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.directory.name, 'stark.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def test_connections_are_per_thread_and_use_wal(self):
+        self.assertEqual(self.db.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.db.conn))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], self.db.conn)
+
+    def test_connections_of_ended_threads_are_closed(self):
+        self.db.conn
+        opened = []
+        for _ in range(5):
+            thread = threading.Thread(target=lambda: opened.append(self.db.conn))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(self.db.connections.connections), 2)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            opened[0].execute('SELECT 1')
+        self.assertEqual(opened[-1].execute('SELECT 1').fetchone()[0], 1)
+
+    def test_readers_do_not_wait_for_writer(self):
+        self.db.add_user('tony', 'tony@stark.com')
+        counts = []
+        with self.db.transaction() as conn:
+            conn.execute('INSERT INTO user_profiles (username, email) VALUES (?, ?)', ('pepper', None))
+            reader = threading.Thread(target=lambda: counts.append(
+                self.db.conn.execute('SELECT COUNT(*) FROM user_profiles').fetchone()[0]))
+            reader.start()
+            reader.join(2)
+        self.assertEqual(counts, [1])
+
+    def test_nested_transaction_rolls_back_to_savepoint(self):
+        with self.db.transaction() as conn:
+            conn.execute('INSERT INTO user_profiles (username, email) VALUES (?, ?)', ('tony', None))
+            with self.assertRaises(ValueError):
+                with self.db.transaction() as inner:
+                    inner.execute('INSERT INTO user_profiles (username, email) VALUES (?, ?)', ('ultron', None))
+                    raise ValueError('abort')
+        names = [row[0] for row in self.db.conn.execute('SELECT username FROM user_profiles')]
+        self.assertEqual(names, ['tony'])
+
+    def test_migrations_create_indexes_once(self):
+        self.assertEqual(self.db.schema_version(), 1)
+        self.assertEqual(self.db.migrate(), 1)
+        indexes = {row[0] for row in self.db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn('idx_memory_user_created', indexes)
+        self.assertIn('idx_communication_logs_user_created', indexes)
+
+    def test_bulk_insert_and_paged_reads(self):
+        start = datetime(2024, 1, 1)
+        memories = ((f'user_{i % 2}', f'memory {i}', start + timedelta(minutes=i)) for i in range(10))
+        self.assertEqual(self.db.add_memories(memories, rebuild_indexes=True), 10)
+        self.assertEqual(self.db.add_communication_logs([('user_0', 'hello'), ('user_0', 'bye')]), 2)
+
+        first = self.db.get_memories('user_0', limit=3)
+        self.assertEqual([m['memory_text'] for m in first], ['memory 0', 'memory 2', 'memory 4'])
+        rest = self.db.get_memories('user_0', after=(first[-1]['created_at'], first[-1]['id']), limit=3)
+        self.assertEqual([m['memory_text'] for m in rest], ['memory 6', 'memory 8'])
+        window = self.db.get_memories('user_1', since=start + timedelta(minutes=3), until=start + timedelta(minutes=7))
+        self.assertEqual([m['memory_text'] for m in window], ['memory 3', 'memory 5'])
+        self.assertEqual(len(self.db.get_communication_logs('user_0')), 2)
+
+class StorageBackendContract:
+    """Behaviour every storage backend must share; mixed into one TestCase per backend"""
+
+    def test_tasks_round_trip_through_apply_task_changes(self):
+        created_at = datetime(2024, 1, 1, 9, 30)
+        task = {'id': 7, 'name': 'Draft', 'user_id': 'user_001', 'created_at': created_at,
+                'due_date': None, 'completed': False}
+        self.backend.apply_task_changes([task], [])
+        self.backend.apply_task_changes([dict(task, name='Final', completed=True)], [8])
+        self.assertEqual(self.backend.load_tasks(), [dict(task, name='Final', completed=True)])
+        self.backend.apply_task_changes([], [7])
+        self.assertEqual(self.backend.load_tasks(), [])
+        self.assertEqual(self.backend.max_task_id(), 0)
+
+    def test_load_tasks_for_one_user(self):
+        tasks = [{'id': i, 'name': f'Task {i}', 'user_id': f'user_{i % 2}', 'created_at': datetime(2024, 1, 1),
+                  'due_date': None, 'completed': False} for i in range(1, 6)]
+        self.backend.apply_task_changes(tasks, [])
+        self.assertEqual([t['id'] for t in self.backend.load_tasks('user_1')], [1, 3, 5])
+        self.assertEqual(self.backend.max_task_id(), 5)
+
+    def test_paged_reads_and_rollback(self):
+        start = datetime(2024, 1, 1)
+        self.backend.add_memories((f'user_{i % 2}', f'memory {i}', start + timedelta(minutes=i)) for i in range(6))
+        with self.assertRaises(ValueError):
+            with self.backend.transaction():
+                self.backend.add_memory('user_0', 'discarded')
+                raise ValueError('abort')
+        with self.backend.transaction():
+            self.backend.add_memory('user_0', 'kept')
+            with self.assertRaises(ValueError):
+                with self.backend.transaction():
+                    self.backend.add_memory('user_0', 'discarded')
+                    self.backend.apply_task_changes([{'id': 1, 'name': 'Discarded', 'user_id': 'user_0',
+                                                      'created_at': start, 'due_date': None, 'completed': False}], [])
+                    raise ValueError('abort')
+        self.assertEqual(self.backend.load_tasks(), [])
+        self.assertEqual(self.backend.max_task_id(), 0)
+        first = self.backend.get_memories('user_0', limit=2)
+        self.assertEqual(first[0]['created_at'], start)
+        rest = self.backend.get_memories('user_0', after=(first[-1]['created_at'], first[-1]['id']))
+        self.assertEqual([m['memory_text'] for m in first + rest], ['memory 0', 'memory 2', 'memory 4', 'kept'])
+        self.assertEqual(self.backend.schema_version(), 1)
+
+    def test_paged_reads_project_fields(self):
+        self.backend.add_memories([('user_0', 'memory', datetime(2024, 1, 1))])
+        page = self.backend.get_memories('user_0', fields=('memory_text',))
+        self.assertEqual(set(page[0]), {'id', 'memory_text', 'created_at'})
+        with self.assertRaises(ValueError):
+            self.backend.get_memories('user_0', fields=('password',))
+
+
+class TestSQLAlchemyBackend(StorageBackendContract, unittest.TestCase):
+    def setUp(self):
+        self.backend = SQLAlchemyBackend('sqlite://')
+
+    def tearDown(self):
+        self.backend.close()
+
+
+class TestMemoryBackend(StorageBackendContract, unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+
+class TestNativeSQLiteBackend(StorageBackendContract, unittest.TestCase):
+    def setUp(self):
+        self.backend = Database(':memory:')
+
+    def tearDown(self):
+        self.backend.close()
+
+class TestAssistantPool(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.services = AssistantServices(MemoryBackend(), ReminderScheduler(), history_dir=None)
+        self.addCleanup(self.services.scheduler.stop)
+        self.pool = AssistantPool(self.services, max_size=2, idle_timeout=60, clock=lambda: self.now)
+        self.addCleanup(self.pool.close)
+
+    def test_services_keep_the_scheduler_they_are_given(self):
+        # An empty scheduler is falsy, and must not be swapped for the process-wide one
+        self.assertIsNot(self.services.scheduler, default_scheduler())
+        self.assertIs(self.pool.sweep_job, self.services.scheduler._heap[0])
+
+    def test_close_releases_the_shared_services(self):
+        with tempfile.TemporaryDirectory() as directory:
+            services = AssistantServices(MemoryBackend(), ReminderScheduler(), history_dir=directory)
+            self.addCleanup(services.scheduler.stop)
+            pool = AssistantPool(services, max_size=2, idle_timeout=60)
+            pool.get('tony')
+            services.memory_manager.add_to_conversation_history({'user': 'Build suit'})
+            cleanup_job = services.memory_manager.cleanup_job
+            pool.close()
+            self.assertTrue(cleanup_job.cancelled)
+            self.assertEqual(len(services.scheduler), 0)
+            self.assertTrue(services.memory_manager.conversation_log.file.closed)
+
+    def test_users_get_separate_assistants(self):
+        tony, pepper = self.pool.get('tony'), self.pool.get('pepper')
+        self.assertIs(self.pool.get('tony'), tony)
+        tony.process_command('add_task', 'Build suit')
+        pepper.process_command('add_task', 'Run company')
+        self.assertEqual([t['name'] for t in tony.process_command('list_tasks')], ['Build suit'])
+        self.assertEqual(pepper.process_command('complete_task', 1), "Task not found, Sir.")
+
+    def test_lru_and_idle_eviction_rehydrate_from_database(self):
+        self.pool.get('tony').process_command('add_task', 'Build suit')
+        self.pool.get('pepper')
+        self.pool.get('rhodey')
+        self.assertNotIn('tony', self.pool)
+        self.assertEqual(len(self.services.task_manager.tasks), 0)
+        self.now = 61
+        self.pool.get('pepper')
+        self.assertEqual(self.pool.evict_idle(), 1)
+        self.assertEqual(list(self.pool.assistants), ['pepper'])
+        self.assertEqual(self.pool.get('tony').process_command('list_tasks')[0]['name'], 'Build suit')
+        self.pool.get('tony').process_command('add_task', 'Test suit')
+        self.assertEqual([t['id'] for t in self.pool.get('tony').process_command('list_tasks')], [1, 2])
+
+    def test_user_id_comes_from_a_signed_token(self):
+        with mock.patch.multiple(config, ENABLE_AUTHENTICATION=True, AUTH_SECRET='s3cret'):
+            token = issue_token('tony')
+            self.assertEqual(resolve_user_id(None, f'Bearer {token}'), 'tony')
+            self.assertEqual(resolve_user_id('tony', f'bearer {token}'), 'tony')
+            for header, authorization, status in ((None, None, 401), ('tony', None, 401),
+                                                  (None, f'Bearer {issue_token("tony", "guess")}', 401),
+                                                  (None, f'Bearer pepper.{token.partition(".")[2]}', 401),
+                                                  ('pepper', f'Bearer {token}', 403)):
+                with self.assertRaises(UserIdError) as error:
+                    resolve_user_id(header, authorization)
+                self.assertEqual(error.exception.status, status)
+        with mock.patch.multiple(config, ENABLE_AUTHENTICATION=True, AUTH_SECRET=None):
+            with self.assertRaisesRegex(RuntimeError, 'AUTH_SECRET'):
+                check_auth_config()
+            with self.assertRaises(UserIdError) as error:
+                resolve_user_id('tony', 'Bearer tony.x')
+            self.assertEqual(error.exception.status, 500)
+        with mock.patch.object(config, 'ENABLE_AUTHENTICATION', False):
+            self.assertEqual(resolve_user_id('pepper'), 'pepper')
+            self.assertEqual(resolve_user_id(None), config.DEFAULT_USER_ID)
+
+    def test_tokens_are_minted_from_the_command_line(self):
+        env = dict(os.environ, AUTH_SECRET='from-the-environment')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assistant_pool.py')
+        result = subprocess.run([sys.executable, script, 'tony'], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), issue_token('tony', 'from-the-environment'))
+        env.pop('AUTH_SECRET')
+        result = subprocess.run([sys.executable, script, 'tony'], env=env, capture_output=True, text=True,
+                                cwd=tempfile.gettempdir())
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('AUTH_SECRET is not set', result.stderr)
+
+    def test_slow_user_does_not_hold_up_others(self):
+        tony = self.pool.get('tony')
+        release, loading = threading.Event(), threading.Event()
+        load_tasks = self.services.database.load_tasks
+        def slow_load(user_id):
+            if user_id == 'pepper':
+                loading.set()
+                release.wait(5)
+            return load_tasks(user_id)
+        self.services.database.load_tasks = slow_load
+        builds = [threading.Thread(target=self.pool.get, args=('pepper',)) for _ in range(2)]
+        for thread in builds:
+            thread.start()
+        self.assertTrue(loading.wait(1))
+        started = time.perf_counter()
+        self.assertIs(self.pool.get('tony'), tony)
+        self.assertLess(time.perf_counter() - started, 1)
+        release.set()
+        for thread in builds:
+            thread.join()
+        self.assertEqual(len(self.pool), 2)
+
+    def test_status_counts_follow_every_mutation(self):
+        tony = self.pool.get('tony')
+        for name in ('Build suit', 'Test suit', 'Paint suit'):
+            tony.process_command('add_task', name)
+        tony.process_command('complete_task', 1)
+        tony.process_command('delete_task', 2)
+        tony.process_command('send_message', 'Pepper', 'Running late')
+        tony.process_command('send_notification', 'Suit ready')
+        tony.process_command('store_memory', 'learned', 'suit', 'red')
+        tony.process_batch([('add_task', ('Fly',)), ('store_memory', ('learned', 'jet', 'fast')),
+                            ('send_notification', ('Jet ready',)), ('complete_task', ('not a number',))], atomic=True)
+        status = tony.get_status()
+        self.assertEqual((status['active_tasks'], status['pending_messages'], status['notifications'],
+                          status['stored_memories']), (1, 1, 1, 1))
+        self.assertEqual(status['active_tasks'], len(self.services.task_manager.tasks.pending_for('tony')))
+
+    def test_reads_are_cached_until_the_user_writes(self):
+        tony, pepper = self.pool.get('tony'), self.pool.get('pepper')
+        tony.process_command('add_task', 'Build suit')
+        first = tony.process_command('list_tasks')
+        self.assertIs(tony.process_command('list_tasks'), first)
+        pepper.process_command('add_task', 'Run company')
+        self.assertIs(tony.process_command('list_tasks'), first)
+        self.assertEqual(tony.get_status()['active_tasks'], 1)
+        tony.process_command('complete_task', 1)
+        self.assertEqual(tony.process_command('list_tasks'), "You have no pending tasks, Sir.")
+        self.assertEqual(tony.get_status()['active_tasks'], 0)
+        tony.process_command('page_notifications')
+        self.services.communication_manager.send_notification('Reminder', 'tony')
+        self.assertEqual(len(tony.process_command('page_notifications')['items']), 1)
+        self.assertEqual(self.services.responses.hits, 2)
+
+    def test_uncacheable_reads_keep_the_cache(self):
+        tony = self.pool.get('tony')
+        tony.process_command('add_task', 'Build suit')
+        first = tony.process_command('list_tasks')
+        tony.process_command('get_overdue_tasks')
+        tony.process_command('get_upcoming_tasks', 3)
+        self.assertIs(tony.process_command('list_tasks'), first)
+        self.assertEqual(self.services.responses.hits, 1)
+        self.assertTrue(self.services.commands.describe()['get_overdue_tasks']['read_only'])
+
+    def test_expired_memories_leave_the_cache(self):
+        tony = self.pool.get('tony')
+        tony.process_command('store_memory', 'learned', 'suit', 'red')
+        self.assertEqual(tony.process_command('retrieve_memory', 'learned'), {'suit': 'red'})
+        self.services.memory_manager.cleanup_expired(now=time.time() + self.services.memory_manager.ttl + 1)
+        self.assertEqual(tony.process_command('retrieve_memory', 'learned'), "No memories found in this category, Sir.")
+        self.assertEqual(tony.get_status()['stored_memories'], 0)
+
+class TestReminderScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ReminderScheduler()
+        self.fired = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def notify(self, message, user_id, notification_type):
+        self.fired.append((message, user_id, notification_type))
+        self.done.set()
+
+    def test_jobs_fire_in_due_order_and_cancel(self):
+        now = time.time()
+        self.scheduler.schedule(now + 0.05, self.fired.append, 'second')
+        cancelled = self.scheduler.schedule(now + 0.02, self.fired.append, 'cancelled')
+        self.scheduler.schedule(now + 0.01, self.fired.append, 'first')
+        self.scheduler.schedule(now + 0.06, self.done.set)
+        self.scheduler.cancel(cancelled)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ['first', 'second'])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_bad_jobs_do_not_stop_the_worker(self):
+        with self.assertRaises(TypeError):
+            self.scheduler.schedule(None, self.fired.append, 'never')
+        self.scheduler.start()
+        with self.assertLogs('scheduler', 'ERROR'):
+            with self.scheduler._condition:
+                self.scheduler._heap.append(ScheduledJob(None, -1, self.fired.append, ('broken',), None))
+                self.scheduler._condition.notify()
+            deadline = time.monotonic() + 2
+            while self.scheduler._heap and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.scheduler.schedule(time.time() + 0.01, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual((self.fired, len(self.scheduler)), ([], 0))
+        manager = TaskManager(self.scheduler, self.notify)
+        manager.add_task('Pay rent', 'alice')
+        for reminder_time in (None, ''):
+            with self.assertRaises(CommandError):
+                manager.set_reminder(1, reminder_time)
+        self.assertNotIn(1, manager.reminder_jobs)
+
+    def test_task_reminder_notifies_and_respects_completion(self):
+        manager = TaskManager(self.scheduler, self.notify)
+        manager.add_task('Done already', 'alice')
+        manager.add_task('Pay rent', 'alice')
+        manager.set_reminder(1, datetime.now() + timedelta(milliseconds=10))
+        manager.set_reminder(2, datetime.now() + timedelta(milliseconds=20))
+        manager.complete_task(1)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, [("Reminder: 'Pay rent', Sir.", 'alice', 'reminder')])
+
+    def test_due_date_schedules_reminder_lead_time_ahead(self):
+        manager = TaskManager(self.scheduler, self.notify)
+        due_date = datetime.now() + timedelta(days=1)
+        manager.add_task('Submit taxes', 'alice', due_date)
+        job = manager.reminder_jobs[1]
+        self.assertAlmostEqual(job.when, due_date.timestamp() - 3600, places=3)
+
+    def test_medication_reminder_repeats_daily(self):
+        monitor = HealthMonitor(self.scheduler, self.notify, 'alice')
+        monitor.add_medication_reminder('Aspirin', '08:00')
+        job = monitor.medication_reminders[0]['job']
+        self.assertEqual(job.interval, 24 * 60 * 60)
+        self.assertEqual(job.when, next_daily_occurrence('08:00').timestamp())
+        monitor.remove_medication_reminder('Aspirin')
+        self.assertEqual(len(self.scheduler), 0)
+
+class TestCommandRegistry(unittest.TestCase):
+    def test_dispatch_checks_schema_and_counts_calls(self):
+        registry = CommandRegistry()
+        manager = TaskManager()
+        manager.register_commands(registry)
+        registry.dispatch('add_task', 'tony', ('Build suit',))
+        self.assertEqual(registry.dispatch('complete_task', 'tony', ('1',)), "Task 'Build suit' marked as completed, Sir.")
+        with self.assertRaises(CommandError):
+            registry.dispatch('complete_task', 'tony', ())
+        with self.assertRaises(CommandError):
+            registry.dispatch('complete_task', 'tony', ('one',))
+        with self.assertRaises(CommandError):
+            registry.dispatch('list_tasks', 'tony', ('extra',))
+        stats = registry.describe()['complete_task']['stats']
+        self.assertEqual((stats['calls'], stats['errors']), (1, 0))
+
+    def test_handler_errors_are_counted(self):
+        registry = CommandRegistry()
+        registry.register('explode', lambda user_id, reason: 1 / 0, [Arg('reason', required=False)])
+        with self.assertRaises(ZeroDivisionError):
+            registry.dispatch('explode', 'tony')
+        self.assertEqual(registry.describe()['explode']['stats']['errors'], 1)
+
+    def _batch_registry(self):
+        registry = CommandRegistry()
+        self.tasks, self.memory, self.comms = TaskManager(), MemoryManager(max_items=1), CommunicationManager()
+        for manager in (self.tasks, self.memory, self.comms):
+            manager.register_commands(registry)
+        registry.register('explode', lambda user_id: 1 / 0)
+        self.tasks.add_task('Calibrate repulsors', 'tony')
+        self.memory.store_memory('tony', 'learned', 'suit', 'Mark III')
+        return registry
+
+    def test_batch_reports_each_call(self):
+        registry = self._batch_registry()
+        results = registry.dispatch_batch('tony', [('add_task', ('Build suit',)), ('complete_task', ()),
+                                                   ('explode', ()), ('send_message', ('Pepper', 'Late again'))])
+        self.assertEqual([r['status'] for r in results], ['success', 'error', 'error', 'success'])
+        self.assertEqual(len(self.tasks.list_tasks('tony')), 2)
+        self.assertEqual(len(self.comms.get_messages('tony')), 1)
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+        registry = self._batch_registry()
+        results = registry.dispatch_batch('tony', [
+            ('add_task', ('Build suit',)), ('complete_task', (1,)), ('delete_task', (1,)),
+            ('store_memory', ('learned', 'armor', 'Mark IV')), ('send_message', ('Pepper', 'Late again')),
+            ('explode', ()), ('send_notification', ('never sent',))
+        ], atomic=True)
+        self.assertEqual([r['status'] for r in results], ['rolled_back'] * 5 + ['error', 'skipped'])
+        self.assertEqual([t['name'] for t in self.tasks.list_tasks('tony')], ['Calibrate repulsors'])
+        self.assertEqual(self.memory.retrieve_memory('tony', 'learned'), {'suit': 'Mark III'})
+        self.assertEqual(self.memory.count('tony'), 1)
+        self.assertEqual(self.memory.search_memories('tony', 'armor'), "No memories found matching the query, Sir.")
+        self.assertEqual(self.comms.get_messages('tony'), [])
+
+    def test_atomic_batch_checks_every_call_first(self):
+        registry = self._batch_registry()
+        results = registry.dispatch_batch('tony', [('add_task', ('Build suit',)), ('no_such_command', ())],
+                                          atomic=True)
+        self.assertEqual([r['status'] for r in results], ['skipped', 'error'])
+        self.assertEqual(len(self.tasks.list_tasks('tony')), 1)
+
 class TestCommunication(unittest.TestCase):
     def test_send_message(self):
         # Add test for sending messages
@@ -18,6 +614,200 @@ class TestCommunication(unittest.TestCase):
         # Add test for receiving messages
         pass
 
+    def test_page_messages_by_id_and_since(self):
+        manager = CommunicationManager()
+        for i in range(5):
+            manager.send_message('bob', f'message {i}', 'alice')
+        manager.send_notification('ping', 'alice')
+        first = manager.page_messages('alice', limit=3, fields=('id', 'message'))
+        self.assertEqual([m['message'] for m in first['items']], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(set(first['items'][0]), {'id', 'message'})
+        rest = manager.page_messages('alice', limit=3, after=first['items'][-1]['id'])
+        self.assertEqual([m['message'] for m in rest['items']], ['message 3', 'message 4'])
+        self.assertIsNone(rest['next_cursor'])
+        since = manager.get_messages('alice')[4]['sent_at']
+        self.assertEqual([m['id'] for m in manager.page_messages('alice', since=since)['items']], [5])
+        self.assertEqual(manager.page_notifications('alice')['items'][0]['id'], 6)
+
+class TestResponseCache(unittest.TestCase):
+    def test_versions_and_lru_bound(self):
+        cache = ResponseCache(max_entries=2)
+        calls = []
+
+        def compute(value):
+            return lambda: calls.append(value) or value
+
+        self.assertEqual(cache.get_or_compute('alice', 'a', compute(1)), 1)
+        self.assertEqual(cache.get_or_compute('alice', 'a', compute(2)), 1)
+        cache.invalidate('alice')
+        self.assertEqual(cache.get_or_compute('alice', 'a', compute(3)), 3)
+        cache.get_or_compute('bob', 'a', compute(4))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_or_compute('alice', ['unhashable'], compute(5)), 5)
+        self.assertEqual(calls, [1, 3, 4, 5])
+        self.assertEqual({k: cache.stats()[k] for k in ('hits', 'misses', 'evictions')},
+                         {'hits': 1, 'misses': 3, 'evictions': 1})
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_buckets_refill_per_user_and_route(self):
+        now = [0.0]
+        limiter = RateLimiter({'search': (1, 2)}, default=(10, 1), clock=lambda: now[0])
+        self.assertEqual([limiter.check('alice', 'search') for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.check('alice', 'search'), 1.0)
+        self.assertEqual(limiter.check('bob', 'search'), 0)
+        self.assertEqual(limiter.check('alice', 'list'), 0)
+        now[0] = 0.5
+        self.assertAlmostEqual(limiter.check('alice', 'search'), 0.5)
+        now[0] = 1.0
+        self.assertEqual(limiter.check('alice', 'search'), 0)
+
+    def test_bucket_count_is_bounded(self):
+        limiter = RateLimiter({}, default=(1, 1), max_keys=3, clock=lambda: 0.0)
+        for user in ('a', 'b', 'c', 'a', 'd'):
+            limiter.check(user, 'route')
+        self.assertEqual(len(limiter), 3)
+        self.assertEqual(list(limiter.buckets), [('c', 'route'), ('a', 'route'), ('d', 'route')])
+
+    def test_admission_limit_shrinks_with_latency_and_recovers(self):
+        admission = AdmissionController(max_limit=10, min_limit=2, target_latency=0.1, smoothing=1.0)
+        self.assertTrue(all(admission.enter() for _ in range(10)))
+        self.assertFalse(admission.enter())
+        for _ in range(10):
+            admission.exit(1.0)
+        self.assertEqual(admission.limit, 2)
+        self.assertTrue(admission.enter() and admission.enter())
+        self.assertFalse(admission.enter())
+        admission.exit(0.01)
+        admission.exit(0.01)
+        self.assertEqual((admission.limit, admission.in_flight, admission.rejected), (4, 0, 2))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render_histograms_counters_and_callbacks(self):
+        registry = MetricsRegistry(enabled=True)
+        latency = registry.histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            latency.observe(value, 'list')
+        registry.counter('calls_total', 'Calls', ('route',)).inc('say "hi"', amount=2)
+        registry.callback('queued', 'Queued', lambda: 7)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertEqual([line for line in lines if line.startswith('latency_seconds')],
+                         ['latency_seconds_bucket{route="list",le="0.1"} 1',
+                          'latency_seconds_bucket{route="list",le="1"} 3',
+                          'latency_seconds_bucket{route="list",le="+Inf"} 4',
+                          'latency_seconds_sum{route="list"} 4.05',
+                          'latency_seconds_count{route="list"} 4'])
+        self.assertIn('calls_total{route="say \\"hi\\""} 2', lines)
+        self.assertIn('queued 7', lines)
+
+    def test_disabled_registry_records_nothing(self):
+        registry = MetricsRegistry(enabled=False)
+        registry.counter('calls_total', 'Calls').inc()
+        with registry.histogram('latency_seconds', 'Latency').time():
+            pass
+        self.assertEqual(registry.render(), '\n')
+
+
+    def test_default_registry_follows_the_config_flag(self):
+        registry = MetricsRegistry()
+        calls = registry.counter('calls_total', 'Calls')
+        with mock.patch.object(config, 'ENABLE_ANALYTICS', False):
+            calls.inc()
+        with mock.patch.object(config, 'ENABLE_ANALYTICS', True):
+            calls.inc()
+        self.assertEqual(registry.render().splitlines()[-1], 'calls_total 1')
+
+
+class TestSerialization(unittest.TestCase):
+    def test_records_encode_with_iso_timestamps_and_sorted_keys(self):
+        record = {'name': 'Café run', 'id': 1, 'due_date': datetime(2030, 1, 1, 9, 30), 'created_at': datetime(2024, 1, 1)}
+        expected = ('{"tasks":[{"created_at":"2024-01-01T00:00:00","due_date":"2030-01-01T09:30:00",'
+                    '"id":1,"name":"Café run"}]}').encode('utf-8')
+        self.assertEqual(serialization.dumps({'tasks': [record]}), expected)
+        # The standard library fallback writes the same bytes
+        try:
+            with mock.patch.dict(sys.modules, {'orjson': None}):
+                fallback = importlib.reload(serialization)
+                self.assertIsNone(fallback.orjson)
+                self.assertEqual(fallback.dumps({'tasks': [record]}), expected)
+        finally:
+            importlib.reload(serialization)
+
+    def test_negotiation_and_entity_tags(self):
+        self.assertIsNone(serialization.negotiate_encoding('gzip', 10))
+        self.assertIsNone(serialization.negotiate_encoding('identity', 1 << 20))
+        self.assertEqual(serialization.negotiate_encoding('gzip, deflate', 1 << 20), 'gzip')
+        etag = serialization.entity_tag(b'{}', 'gzip')
+        self.assertNotEqual(etag, serialization.entity_tag(b'{}'))
+        self.assertTrue(serialization.not_modified(f'"other", {etag}', etag))
+        self.assertTrue(serialization.not_modified(f'W/{etag}', etag))
+        self.assertFalse(serialization.not_modified(serialization.entity_tag(b'[]'), etag))
+
+
+class TestEventBroker(unittest.TestCase):
+    def test_cursor_returns_only_newer_events(self):
+        broker = EventBroker(buffer_size=3)
+        comms = CommunicationManager(broker)
+        comms.send_message('Pepper', 'Running late', 'tony')
+        comms.send_notification('Suit ready', 'tony', 'alert')
+        comms.send_message('Happy', 'Bring the car', 'pepper')
+        events, cursor, missed = broker.events_since('tony', 0)
+        self.assertEqual([(e['id'], e['type']) for e in events], [(1, 'message'), (2, 'notification')])
+        self.assertEqual((cursor, missed), (2, False))
+        self.assertEqual(broker.events_since('tony', 2), ([], 2, False))
+        self.assertEqual(broker.events_since('tony', 1, {'message'})[0], [])
+        for i in range(3):
+            comms.send_notification(f'Update {i}', 'tony')
+        events, cursor, missed = broker.events_since('tony', 1)
+        self.assertEqual(([e['id'] for e in events], cursor, missed), ([3, 4, 5], 5, True))
+        self.assertTrue(broker.events_since('tony', 9)[2])
+
+    def test_wait_wakes_on_publish(self):
+        broker = EventBroker()
+        threading.Timer(0.05, broker.publish, ('tony', 'notification', {'notification': 'ping'})).start()
+        start = time.monotonic()
+        events, cursor, _ = broker.wait('tony', 0, timeout=5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual((len(events), cursor), (1, 1))
+        self.assertEqual(broker.wait('tony', 1, timeout=0.01), ([], 1, False))
+        self.assertEqual(broker.subscribers, {})
+
+    def test_failing_subscriber_does_not_stop_the_others(self):
+        broker = EventBroker()
+        received = []
+        broker.subscribe('tony', mock.Mock(side_effect=RuntimeError('event loop is closed')))
+        broker.subscribe('tony', received.append)
+        with self.assertLogs('pubsub', 'ERROR'):
+            event = broker.publish('tony', 'notification', {'notification': 'ping'})
+        self.assertEqual(received, [event])
+
+    def test_idle_users_are_forgotten_without_reusing_cursors(self):
+        broker = EventBroker()
+        for i in range(3):
+            broker.publish('tony', 'notification', {'notification': f'ping {i}'})
+        broker.publish('pepper', 'message', {'message': 'hi'})
+        broker.subscribe('pepper', mock.Mock())
+        self.assertEqual(broker.evict_idle(60), 0)
+        self.assertEqual(broker.evict_idle(0), 1)
+        self.assertEqual((set(broker.buffers), set(broker.sequences)), ({'pepper'}, {'pepper'}))
+        self.assertEqual(broker.events_since('tony', 2), ([], 0, True))
+        broker.publish('tony', 'notification', {'notification': 'back'})
+        events, cursor, missed = broker.events_since('tony', 2)
+        self.assertEqual(([e['id'] for e in events], cursor, missed), ([4], 4, True))
+        self.assertEqual(broker.events_since('tony', 3)[1:], (4, False))
+
+    def test_failed_atomic_batch_publishes_nothing(self):
+        broker = EventBroker()
+        registry = CommandRegistry()
+        CommunicationManager(broker).register_commands(registry)
+        registry.register('explode', lambda user_id: 1 / 0)
+        registry.dispatch_batch('tony', [('send_message', ('Pepper', 'hi')), ('explode', ())], atomic=True)
+        self.assertEqual(broker.cursor('tony'), 0)
+        registry.dispatch_batch('tony', [('send_message', ('Pepper', 'hi'))], atomic=True)
+        self.assertEqual(broker.cursor('tony'), 1)
+
 class TestMemory(unittest.TestCase):
     def test_memory_storage(self):
         # Add test for memory storage
@@ -27,5 +817,384 @@ class TestMemory(unittest.TestCase):
         # Add test for memory retrieval
         pass
 
+    def test_page_memories_orders_by_key(self):
+        manager = MemoryManager()
+        for key in ('b', 'c', 'a', 'd'):
+            manager.store_memory('alice', 'learned', key, key.upper())
+        registry = CommandRegistry()
+        manager.register_commands(registry)
+        first = registry.dispatch('page_memories', 'alice', ('learned', 3, None, None, 'key,value'))
+        self.assertEqual(first['items'], [{'key': 'a', 'value': 'A'}, {'key': 'b', 'value': 'B'},
+                                          {'key': 'c', 'value': 'C'}])
+        rest = registry.dispatch('page_memories', 'alice', ('learned', 3, first['next_cursor']))
+        self.assertEqual([m['key'] for m in rest['items']], ['d'])
+        self.assertEqual(registry.dispatch('page_memories', 'alice', ('personal',))['items'], [])
+
+    def test_search_memories_uses_inverted_index(self):
+        manager = MemoryManager()
+        manager.store_information('favorite_color', 'deep red', 'tony')
+        manager.store_information('birthday', 'May 29', 'tony')
+        manager.store_information('car', 'red Audi R8', 'tony')
+        manager.store_preferences('wine', 'red', 'tony')
+        manager.store_information('car', 'red pickup', 'happy')
+        self.assertEqual(manager.search_memories('tony', 'red'), {
+            'learned': {'car': 'red Audi R8', 'favorite_color': 'deep red'},
+            'preferences': {'wine': 'red'}
+        })
+        self.assertEqual(manager.search_memories('tony', 'RED au'), {'learned': {'car': 'red Audi R8'}})
+        self.assertEqual(manager.search_memories('tony', 'birth'), {'learned': {'birthday': 'May 29'}})
+        manager.update_information('car', 'silver Audi', 'tony')
+        self.assertEqual(list(manager.search_memories('tony', 'red')['learned']), ['favorite_color'])
+        manager.clear_information('tony')
+        self.assertEqual(manager.search_memories('tony', 'au'), "No memories found matching the query, Sir.")
+
+    def test_memory_categories_are_bounded_lru(self):
+        manager = MemoryManager(max_items=2)
+        manager.store_memory('tony', 'personal', 'name', 'Tony')
+        manager.store_memory('tony', 'personal', 'city', 'Malibu')
+        manager.get_memory('tony', 'personal', 'name')
+        manager.store_memory('tony', 'personal', 'suit', 'Mark 42')
+        self.assertEqual(manager.retrieve_memory('tony', 'personal'), {'name': 'Tony', 'suit': 'Mark 42'})
+        self.assertEqual(manager.count('tony'), 2)
+        self.assertEqual(manager.search_memories('tony', 'malibu'), "No memories found matching the query, Sir.")
+        self.assertIn('Unknown memory category', manager.store_memory('tony', 'secrets', 'x'))
+
+    def test_conversation_history_spills_to_rotating_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manager = MemoryManager(history_dir=directory, history_size=3)
+            manager.conversation_log.segment_size = 64
+            for turn in range(10):
+                manager.add_to_conversation_history({'turn': turn, 'text': 'hello'})
+            self.assertEqual(len(manager.conversation_history), 3)
+            self.assertGreater(len(os.listdir(directory)), 1)
+            self.assertEqual([r['turn'] for r in manager.recent_conversation(2)], [8, 9])
+            self.assertEqual([r['turn'] for r in manager.recent_conversation(5)], [5, 6, 7, 8, 9])
+            self.assertEqual([r['turn'] for r in manager.iter_conversation_history()], list(range(10)))
+            manager.conversation_log.close()
+
+            restarted = MemoryManager(history_dir=directory, history_size=3)
+            self.assertEqual([r['turn'] for r in restarted.conversation_history], [7, 8, 9])
+            restarted.conversation_log.close()
+
+    def test_semantic_index_ranks_and_removes(self):
+        index = SemanticIndex(capacity=2)
+        index.add('suit', 'Mark 42 armor suit upgrades')
+        index.add('coffee', 'Pepper prefers her coffee black')
+        index.add('meeting', 'Board meeting reminders every Monday')
+        self.assertEqual(index.search('remind me about the meeting', k=1)[0][0], 'meeting')
+        index.remove('suit')
+        self.assertEqual(sorted(doc for doc, _ in index.search('armor coffee meeting', k=5)), ['coffee', 'meeting'])
+        self.assertEqual(len(index), 2)
+
+    def test_recall_memories_tracks_store_and_eviction(self):
+        manager = MemoryManager(max_items=2)
+        manager.store_memory('tony', 'learned', 'favorite_drink', 'black coffee')
+        manager.store_memory('tony', 'learned', 'suit', 'Mark 42 armor')
+        self.assertEqual(manager.recall_memories('tony', 'coffee drinks', k=1)[0]['key'], 'favorite_drink')
+        manager.store_memory('tony', 'learned', 'meeting', 'board meeting Monday')
+        keys = [result['key'] for result in manager.recall_memories('tony', 'coffee armor meeting')]
+        self.assertNotIn('favorite_drink', keys)
+
+        module = MemoryModule()
+        module.store_memory('tony', 'Visited the homepage')
+        module.store_memory('tony', 'Ordered new armor plating')
+        self.assertEqual(module.retrieve_memories('tony', 'armor', k=1), ['Ordered new armor plating'])
+
+    def test_expired_memories_are_cleaned_up(self):
+        manager = MemoryManager(ttl=60)
+        manager.store_memory('tony', 'learned', 'old', 'fact')
+        manager.store_memory('tony', 'learned', 'new', 'fact')
+        manager.memories['tony']['learned']['old'][1] -= 120
+        self.assertEqual(manager.retrieve_memory('tony', 'learned'), {'new': 'fact'})
+        self.assertEqual(manager.search_memories('tony', 'fact'), {'learned': {'new': 'fact'}})
+        self.assertEqual([item['key'] for item in manager.page_memories('tony', 'learned')['items']], ['new'])
+        self.assertEqual([item['key'] for item in manager.recall_memories('tony', 'fact')], ['new'])
+        self.assertEqual(manager.cleanup_expired(), 1)
+        self.assertEqual(manager.count('tony'), 1)
+        self.assertEqual(manager.count('tony', 'learned'), 1)
+
+
+class TestTracing(unittest.TestCase):
+    def test_trace_spans_nest_and_attribute_self_time(self):
+        class Sink:
+            def __init__(self):
+                self.traces = []
+
+            def write(self, trace):
+                self.traces.append(trace)
+        sink = Sink()
+        tracer = tracing.Tracer(sink, enabled=True, sample_rate=0)
+        self.assertIsNone(tracer.start('api_interface.list_tasks'))
+        handle = tracer.start('api_interface.list_tasks', force=True)
+        with tracing.span('main_controller.process_command'):
+            with tracing.span('database.load_tasks'):
+                pass
+        tracer.finish(handle)
+        trace = sink.traces[0].to_dict()
+        self.assertEqual([span['parent'] for span in trace['spans']],
+                         ['main_controller.process_command', 'api_interface.list_tasks'])
+        self.assertEqual(set(trace['modules_ms']), {'api_interface', 'main_controller', 'database'})
+        with tracing.span('database.load_tasks'):
+            pass
+        self.assertEqual(len(sink.traces[0].spans), 2)
+
+    def test_tracer_follows_the_config_flags(self):
+        tracer = tracing.Tracer(mock.Mock())
+        with mock.patch.multiple(config, ENABLE_TRACING=False, TRACE_SAMPLE_RATE=1.0):
+            self.assertIsNone(tracer.start('api_interface.list_tasks', force=True))
+        with mock.patch.multiple(config, ENABLE_TRACING=True, TRACE_SAMPLE_RATE=1.0):
+            tracer.finish(tracer.start('api_interface.list_tasks'))
+        with mock.patch.multiple(config, ENABLE_TRACING=True, TRACE_SAMPLE_RATE=0.0):
+            self.assertIsNone(tracer.start('api_interface.list_tasks'))
+        self.assertEqual(tracer.sink.write.call_count, 1)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profiling_requires_a_configured_admin_token(self):
+        with mock.patch.multiple(config, ENABLE_PROFILING=True, ADMIN_TOKEN=None):
+            with self.assertRaisesRegex(RuntimeError, 'ADMIN_TOKEN'):
+                check_admin_config()
+            with self.assertRaises(ProfilerError) as error:
+                check_admin('anything')
+            self.assertEqual(error.exception.status, 403)
+        with mock.patch.multiple(config, ENABLE_PROFILING=True, ADMIN_TOKEN='s3cret'):
+            check_admin('s3cret')
+            for token in (None, '', 'wrong'):
+                with self.assertRaises(ProfilerError) as error:
+                    check_admin(token)
+                self.assertEqual(error.exception.status, 403)
+        with mock.patch.multiple(config, ENABLE_PROFILING=False, ADMIN_TOKEN='s3cret'):
+            with self.assertRaises(ProfilerError) as error:
+                check_admin('s3cret')
+            self.assertEqual(error.exception.status, 404)
+
+    def test_sampling_profiler_collapses_stacks_one_at_a_time(self):
+        profiler = SamplingProfiler(interval=0.001)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(profiler.sample(0.2)))
+        thread.start()
+        time.sleep(0.05)
+        with self.assertRaises(ProfilerError) as error:
+            profiler.sample(0.01)
+        self.assertEqual(error.exception.status, 409)
+        thread.join()
+        samples = dict(line.rsplit(' ', 1) for line in result[0].splitlines())
+        main = [stack for stack in samples if stack.startswith('MainThread;')]
+        self.assertTrue(main)
+        self.assertTrue(all(int(samples[stack]) > 0 for stack in main))
+
+
+class TestLogging(unittest.TestCase):
+    def test_logging_writes_rotated_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stark.log')
+            logging_setup.configure('INFO', path, max_bytes=2000, backup_count=10)
+            try:
+                logger = logging.getLogger('stark.test')
+                logger.debug('filtered %s', 'out')
+                logger.info('Logged %s: %s', 'Heart Rate', 72, extra={'user_id': 'tony'})
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    logger.exception('Flush failed; %d changes requeued', 3)
+                for number in range(20):
+                    logger.warning('filler %d', number)
+            finally:
+                logging_setup.shutdown()
+            # Oldest backup first, the live file last
+            files = [name for name in (f'{path}.{number}' for number in range(10, 0, -1)) if os.path.exists(name)]
+            self.assertTrue(files)
+            entries = []
+            for name in files + [path]:
+                self.assertLessEqual(os.path.getsize(name), 2000)
+                with open(name, encoding='utf-8') as file:
+                    entries.extend(json.loads(line) for line in file)
+        self.assertEqual(entries[0]['message'], 'Logged Heart Rate: 72')
+        self.assertEqual((entries[0]['level'], entries[0]['logger'], entries[0]['user_id']), ('INFO', 'stark.test', 'tony'))
+        self.assertIn('ZeroDivisionError', entries[1]['exception'])
+        self.assertEqual(entries[1]['message'], 'Flush failed; 3 changes requeued')
+        self.assertEqual([entry['message'] for entry in entries[2:]], [f'filler {number}' for number in range(20)])
+
+def load_app(name):
+    """Import an HTTP front end without touching the working directory's database or log file"""
+    with mock.patch.multiple(config, DATABASE_NAME=':memory:', LOG_FILE=os.devnull, AUTH_SECRET='s3cret'):
+        module = importlib.import_module(name)
+    logging_setup.shutdown()
+    return module
+
+
+class APIContract:
+    """Endpoint behaviour the Flask and ASGI apps share; subclasses send the requests through one of them"""
+
+    module_name = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.module = load_app(cls.module_name)
+
+    def setUp(self):
+        self.services = AssistantServices(MemoryBackend(), ReminderScheduler(), history_dir=None)
+        self.addCleanup(self.services.scheduler.stop)
+        pool = AssistantPool(self.services, max_size=8, idle_timeout=60)
+        self.addCleanup(pool.close)
+        self.patch(self.module, pool=pool, limiter=RateLimiter(), admission=AdmissionController())
+        self.patch(config, ENABLE_AUTHENTICATION=True, AUTH_SECRET='s3cret', RATE_LIMIT_ENABLED=True,
+                   SSE_HEARTBEAT_INTERVAL=0.05)
+        self.auth = {'Authorization': f'Bearer {issue_token("tony")}'}
+
+    def patch(self, target, **values):
+        patcher = mock.patch.multiple(target, **values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, method, path, json_body=None, body=None, headers=None):
+        """Send a request as tony; returns (status, lower-cased headers, body bytes)"""
+        headers = dict(self.auth, **(headers or {}))
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/json')
+        return self.send(method, path, headers, body)
+
+    def test_routing(self):
+        status, _, body = self.request('GET', '/api/health', headers={'Authorization': ''})
+        self.assertEqual((status, json.loads(body)['status']), (200, 'healthy'))
+        status, _, body = self.request('GET', '/api/nowhere')
+        self.assertEqual((status, json.loads(body)['status']), (404, 'error'))
+        self.assertEqual(self.request('DELETE', '/api/health')[0], 405)
+        self.assertEqual(self.request('GET', '/api/task/complete/1')[0], 405)
+
+    def test_requests_need_a_token_for_the_user_they_name(self):
+        self.assertEqual(self.request('GET', '/api/task/list', headers={'Authorization': ''})[0], 401)
+        self.assertEqual(self.request('GET', '/api/task/list', headers={'X-User-Id': 'pepper'})[0], 403)
+        self.assertEqual(self.request('GET', '/api/task/list', headers={'X-User-Id': 'tony'})[0], 200)
+
+    def test_tasks_round_trip_and_malformed_bodies_are_rejected(self):
+        self.assertEqual(self.request('POST', '/api/task/add', {'task_name': 'Build suit'})[0], 201)
+        status, _, body = self.request('GET', '/api/task/list')
+        self.assertEqual([task['name'] for task in json.loads(body)['tasks']], ['Build suit'])
+        for malformed in (b'{"task_name": ', b'["Build suit"]', b''):
+            status, _, body = self.request('POST', '/api/task/add', body=malformed)
+            self.assertEqual((status, json.loads(body)['status']), (400, 'error'))
+        self.assertEqual(self.request('POST', '/api/batch', body=b'not json')[0], 400)
+        for due_date in ('garbage', 20300101):
+            status, _, body = self.request('POST', '/api/task/add', {'task_name': 'Refuel', 'due_date': due_date})
+            self.assertEqual((status, json.loads(body)['status']), (400, 'error'))
+        self.assertEqual(self.request('POST', '/api/task/add', {'task_name': 'Refuel', 'due_date': '2030-01-01T09:30'})[0],
+                         201)
+
+    def test_rejected_arguments_answer_400_on_every_route(self):
+        routes = [('POST', '/api/task/add', {'task_name': 'Refuel'}), ('GET', '/api/task/list', None),
+                  ('PUT', '/api/task/complete/1', None), ('DELETE', '/api/task/delete/1', None),
+                  ('GET', '/api/task/overdue', None),
+                  ('POST', '/api/message/send', {'recipient': 'Pepper', 'message': 'Hi'}), ('GET', '/api/message/list', None),
+                  ('POST', '/api/notification/send', {'notification': 'Ping'}), ('GET', '/api/notification/list', None),
+                  ('POST', '/api/memory/store', {'category': 'learned', 'key': 'suit', 'value': 'red'}),
+                  ('GET', '/api/memory/retrieve/learned', None), ('POST', '/api/memory/search', {'keyword': 'suit'}),
+                  ('POST', '/api/command', {'command': 'list_tasks'})]
+        invalid = CommandError("Argument 'task_id' of complete_task must be int, Sir.")
+        with mock.patch.object(Command, 'bind', side_effect=invalid):
+            for method, path, json_body in routes:
+                with self.subTest(path=path):
+                    status, _, body = self.request(method, path, json_body)
+                    self.assertEqual((status, json.loads(body)), (400, {'error': str(invalid), 'status': 'error'}))
+        status, _, body = self.request('POST', '/api/command', {'command': 'complete_task', 'args': ['one']})
+        self.assertEqual((status, json.loads(body)['status']), (400, 'error'))
+
+    def test_semantic_search_validates_its_limit(self):
+        self.assertEqual(self.request('POST', '/api/memory/store',
+                                      {'category': 'learned', 'key': 'suit', 'value': 'red'})[0], 201)
+        status, _, body = self.request('POST', '/api/memory/search', {'keyword': 'suit', 'semantic': True, 'limit': 'x'})
+        self.assertEqual((status, json.loads(body)['status']), (400, 'error'))
+        status, _, body = self.request('POST', '/api/memory/search', {'keyword': 'suit', 'semantic': True, 'limit': 1})
+        self.assertEqual([result['key'] for result in json.loads(body)['results']], ['suit'])
+
+    def test_conditional_get_and_compression(self):
+        commands = [{'command': 'add_task', 'args': [f'Task {number} ' + 'x' * 40]} for number in range(30)]
+        self.assertEqual(self.request('POST', '/api/batch', {'commands': commands})[0], 200)
+        status, headers, body = self.request('GET', '/api/task/list', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual((status, headers['content-encoding']), (200, 'gzip'))
+        self.assertEqual(len(json.loads(gzip.decompress(body))['tasks']), 30)
+        status, headers, body = self.request('GET', '/api/task/list', headers={'Accept-Encoding': 'gzip',
+                                                                               'If-None-Match': headers['etag']})
+        self.assertEqual((status, body), (304, b''))
+
+    def test_rate_limit_and_admission(self):
+        self.patch(self.module, limiter=RateLimiter(budgets={}, default=(0.001, 2)))
+        statuses = [self.request('GET', '/api/task/list')[0] for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertGreater(int(self.request('GET', '/api/task/list')[1]['retry-after']), 1)
+        self.patch(self.module, admission=AdmissionController(max_limit=0, min_limit=0))
+        status, headers, _ = self.request('GET', '/api/status')
+        self.assertEqual((status, headers['retry-after']), (503, '1'))
+        self.assertEqual(self.request('GET', '/api/health')[0], 200)
+
+    def test_path_segments_are_decoded_once(self):
+        self.patch(config, MEMORY_CATEGORIES=config.MEMORY_CATEGORIES + ['odd%41'])
+        self.assertEqual(self.request('POST', '/api/memory/store', {'category': 'odd%41', 'key': 'k', 'value': 1})[0],
+                         201)
+        status, _, body = self.request('GET', '/api/memory/retrieve/odd%2541')
+        self.assertEqual([memory['key'] for memory in json.loads(body)['memories']], ['k'])
+
+    def test_events_long_poll_and_stream(self):
+        self.request('POST', '/api/message/send', {'recipient': 'Pepper', 'message': 'Running late'})
+        status, _, body = self.request('GET', '/api/events?cursor=0&timeout=0')
+        events = json.loads(body)['events']
+        self.assertEqual((status, len(events), events[0]['type']), (200, 1, 'message'))
+        self.assertEqual(self.request('GET', '/api/events?cursor=-1')[0], 400)
+        stream = self.read_stream('/api/events/stream?cursor=0')
+        self.assertTrue(stream.startswith('id: 1\nevent: message\n'))
+        self.assertIn('Running late', stream)
+
+
+class TestFlaskAPI(APIContract, unittest.TestCase):
+    module_name = 'api_interface'
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.module.app.test_client()
+
+    def send(self, method, path, headers, body):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        return response.status_code, {name.lower(): value for name, value in response.headers.items()}, \
+            response.get_data()
+
+    def read_stream(self, path):
+        response = self.client.get(path, headers=self.auth)
+        try:
+            return next(iter(response.response)).decode()
+        finally:
+            response.close()
+
+
+class TestASGIAPI(APIContract, unittest.TestCase):
+    module_name = 'asgi_interface'
+
+    def send(self, method, path, headers, body, linger=0.0):
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': unquote(path), 'raw_path': path.encode(),
+                 'query_string': query.encode(),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()]}
+        messages = []
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': body or b'', 'more_body': False}
+            await asyncio.sleep(linger)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.module.app(scope, receive, send))
+        start = messages[0]
+        headers = {name.decode(): value.decode() for name, value in start['headers']}
+        return start['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+    def read_stream(self, path):
+        return self.send('GET', path, self.auth, None, linger=0.2)[2].decode()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""Per-request trace spans written to a local JSON-lines file.
+
+A traced request gets a Trace whose root span covers the whole request;
+code on its path opens child spans with
+
+    with tracing.span('database.load_tasks'):
+        ...
+
+The current span lives in a context variable, so spans nest correctly
+across threads and coroutines that inherit the request's context. Outside
+a traced request span() only reads that variable. When the request ends
+the trace, with its spans and the self time of each module (the part of a
+span's name before the first dot), is handed to a background writer, so
+requests never wait on the file.
+
+Tracing is off unless config.ENABLE_TRACING is set; then
+TRACE_SAMPLE_RATE of requests are traced, plus any request that carries
+the TRACE_HEADER header. Both settings are read as each request starts.
+"""
+import atexit
+import contextvars
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+import config
+from serialization import dumps
+
+_current = contextvars.ContextVar('trace_span', default=None)
+_trace_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'parent', 'start', 'duration')
+
+    def __init__(self, trace, name, parent=None):
+        self.trace = trace
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.duration = None
+
+
+class Trace:
+    def __init__(self, name):
+        self.id = f'{os.getpid():x}-{next(_trace_ids):x}'
+        self.started_at = datetime.now()
+        self.root = Span(self, name)
+        self.spans = []
+
+    def to_dict(self):
+        origin = self.root.start
+        children = {}
+        for span in self.spans:
+            if span.parent is not None:
+                children[span.parent] = children.get(span.parent, 0.0) + span.duration
+        modules = {self.root.name.split('.', 1)[0]: self.root.duration - children.get(self.root, 0.0)}
+        for span in self.spans:
+            module = span.name.split('.', 1)[0]
+            modules[module] = modules.get(module, 0.0) + span.duration - children.get(span, 0.0)
+        return {
+            'trace_id': self.id,
+            'name': self.root.name,
+            'started_at': self.started_at,
+            'duration_ms': _ms(self.root.duration),
+            'modules_ms': {module: _ms(seconds) for module, seconds in modules.items()},
+            'spans': [{'name': span.name, 'parent': span.parent.name if span.parent is not None else None,
+                       'start_ms': _ms(span.start - origin), 'duration_ms': _ms(span.duration)}
+                      for span in self.spans]
+        }
+
+
+class FileSink:
+    """Appends one JSON document per trace to `path` from a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='trace-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, trace):
+        self.queue.put(trace)
+
+    def close(self):
+        """Write out everything queued so far and stop the thread"""
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        with open(self.path, 'ab') as file:
+            while True:
+                trace = self.queue.get()
+                if trace is None:
+                    return
+                file.write(dumps(trace.to_dict()) + b'\n')
+                if self.queue.empty():
+                    file.flush()
+
+
+class Tracer:
+    """Starts and finishes traces; `enabled` and `sample_rate` left as None follow config"""
+
+    def __init__(self, sink=None, enabled=None, sample_rate=None):
+        self.sink = sink
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+
+    def start(self, name, force=False):
+        """Begin a trace for the current context if it is sampled; returns a handle for finish(), or None"""
+        enabled = config.ENABLE_TRACING if self.enabled is None else self.enabled
+        if not enabled:
+            return None
+        sample_rate = config.TRACE_SAMPLE_RATE if self.sample_rate is None else self.sample_rate
+        if not (force or random.random() < sample_rate):
+            return None
+        trace = Trace(name)
+        return trace, _current.set(trace.root)
+
+    def finish(self, handle):
+        if handle is None:
+            return
+        trace, token = handle
+        trace.root.duration = time.perf_counter() - trace.root.start
+        _current.reset(token)
+        if self.sink is None:
+            with self.lock:
+                if self.sink is None:
+                    self.sink = FileSink(config.TRACE_FILE)
+        self.sink.write(trace)
+
+
+@contextmanager
+def span(name):
+    """Record the with block as a span of the current trace, if there is one"""
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    current = Span(parent.trace, name, parent)
+    token = _current.set(current)
+    try:
+        yield
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current.reset(token)
+        parent.trace.spans.append(current)
+
+def traced(name):
+    """Decorator form of span()"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+tracer = Tracer()
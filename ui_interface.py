@@ -1,6 +1,8 @@
+import queue
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 from main_controller import StarkAssistant
+from commands import CommandError
 import config
 
 class StarkAssistantUI:
@@ -10,6 +12,21 @@ class StarkAssistantUI:
         self.root.geometry("800x600")
         self.assistant = StarkAssistant(config.DEFAULT_USER_ID)
         self.setup_ui()
+        # Notifications arrive on other threads (reminders fire on the scheduler), so they are queued
+        # here and shown from the Tk event loop
+        self.notifications = queue.SimpleQueue()
+        self.assistant.services.events.subscribe(self.assistant.user_id, self.on_event)
+        self.root.after(config.UI_EVENT_POLL_INTERVAL, self.show_notifications)
+
+    def on_event(self, event):
+        if event['type'] == 'notification':
+            self.notifications.put(event['data'])
+
+    def show_notifications(self):
+        while not self.notifications.empty():
+            notification = self.notifications.get()
+            self.messages_text.insert(tk.END, f"[{notification['type']}] {notification['notification']}\n")
+        self.root.after(config.UI_EVENT_POLL_INTERVAL, self.show_notifications)
 
     def setup_ui(self):
         # Header
@@ -148,7 +165,10 @@ class StarkAssistantUI:
             parts = command.split()
             cmd = parts[0]
             args = parts[1:] if len(parts) > 1 else []
-            result = self.assistant.process_command(cmd, *args)
+            try:
+                result = self.assistant.process_command(cmd, *args)
+            except CommandError as e:
+                result = str(e)
             self.console_text.insert(tk.END, f">> {command}\n{result}\n\n")
             self.command_entry.delete(0, tk.END)
 
@@ -1,5 +1,11 @@
+import time
 import speech_recognition as sr
 import pyttsx3
+import metrics
+
+RECOGNITION_SECONDS = metrics.histogram('stark_speech_recognition_duration_seconds',
+                                        'Speech recognition latency by outcome', ('outcome',))
+SPEECH_SECONDS = metrics.histogram('stark_tts_duration_seconds', 'Time spent speaking a response')
 
 class VoiceModule:
     def __init__(self):
@@ -7,21 +13,26 @@ class VoiceModule:
         self.engine = pyttsx3.init()
 
     def speak(self, text):
-        self.engine.say(text)
-        self.engine.runAndWait()
+        with SPEECH_SECONDS.time():
+            self.engine.say(text)
+            self.engine.runAndWait()
 
     def listen(self):
         with sr.Microphone() as source:
             print("Listening...")
             audio = self.recognizer.listen(source)
+            start = time.perf_counter()
             try:
                 command = self.recognizer.recognize_google(audio)
+                RECOGNITION_SECONDS.observe(time.perf_counter() - start, 'recognized')
                 print(f"You said: {command}")
                 return command
             except sr.UnknownValueError:
+                RECOGNITION_SECONDS.observe(time.perf_counter() - start, 'unintelligible')
                 print("Sorry, I did not understand that.")
                 return None
             except sr.RequestError:
+                RECOGNITION_SECONDS.observe(time.perf_counter() - start, 'service_error')
                 print("Could not request results from Google Speech Recognition service.")
                 return None
 
@@ -30,4 +41,4 @@ if __name__ == '__main__':
     voice_module.speak("Hello, I am your assistant. How can I help you today?")
     command = voice_module.listen()
     if command:
-        voice_module.speak(f"You said: {command}").
\ No newline at end of file
+        voice_module.speak(f"You said: {command}")
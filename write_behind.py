@@ -0,0 +1,121 @@
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = metrics.histogram('stark_write_behind_flush_size', 'Changes written per write-behind flush',
+                               buckets=metrics.SIZE_BUCKETS)
+
+class WriteBehindQueue:
+    """Buffers record changes and writes them to storage in batches.
+
+    Changes are coalesced per key, so a record touched many times between
+    flushes is written once. A background thread hands everything buffered
+    to `apply_changes(records, deleted_keys)` every `flush_interval` seconds,
+    or sooner once `batch_size` keys are pending, so storage sees one
+    transaction per flush instead of one per change.
+
+    Changes a thread makes inside staging() are collected apart from the
+    queue and added to it together when the block exits, so a flush never
+    writes part of them, and nobody else's changes wait on the block.
+    """
+
+    def __init__(self, apply_changes, key='id', flush_interval=config.TASK_FLUSH_INTERVAL,
+                 batch_size=config.TASK_FLUSH_BATCH_SIZE):
+        self.apply_changes = apply_changes
+        self.key = key
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def save(self, record):
+        """Queue an insert or update of the record"""
+        self._queue(record[self.key], record)
+
+    def delete(self, key):
+        """Queue a delete of the record with the given key"""
+        self._queue(key, None)
+
+    def flush(self):
+        """Write everything queued so far in one call to apply_changes"""
+        with self._flush_lock:
+            with self._condition:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            FLUSH_SIZE.observe(len(batch))
+            records = [record for record in batch.values() if record is not None]
+            deleted = [key for key, record in batch.items() if record is None]
+            try:
+                self.apply_changes(records, deleted)
+            except Exception:
+                logger.exception('Write-behind flush failed; %d changes requeued', len(batch))
+                with self._condition:
+                    batch.update(self.pending)
+                    self.pending = batch
+                raise
+
+    @contextmanager
+    def staging(self):
+        """Queue the changes this thread makes in the block all at once when it exits"""
+        if getattr(self._local, 'staged', None) is not None:
+            yield
+            return
+        self._local.staged = staged = {}
+        try:
+            yield
+        finally:
+            # Even when the block fails, what it staged (including any undo) is the records' current state
+            self._local.staged = None
+            if staged:
+                with self._condition:
+                    self.pending.update(staged)
+                    if len(self.pending) >= self.batch_size:
+                        self._condition.notify()
+
+    def close(self):
+        """Stop the flush thread and write out whatever is still queued"""
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def _queue(self, key, record):
+        staged = getattr(self._local, 'staged', None)
+        if staged is not None:
+            staged[key] = record
+            return
+        with self._condition:
+            self.pending[key] = record
+            if len(self.pending) >= self.batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self.pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                if not self._running:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                pass